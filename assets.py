@@ -0,0 +1,226 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+from typing import Dict, NamedTuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.responses import Response
+
+import http_cache
+
+try:
+    import brotli
+except ImportError:  # optional: without it only .gz variants are built
+    brotli = None
+
+# static/ is published through a small build step (at startup, or ahead of
+# time with `python manage.py build-static`) into STATIC_BUILD_DIR:
+#   - .js/.css get content-hashed names (js/app.3f2a9c01d4.js) served as
+#     immutable, and the HTML pages are rewritten to point at them
+#   - every compressible file gets .br/.gz variants next to it, picked per
+#     request from Accept-Encoding
+#   - sw.js gets the app shell (pages + hashed assets) to precache, under a
+#     version that changes whenever any of them does
+# Pages, sw.js and the unhashed names stay at their URLs and are revalidated
+# on every use (cheap 304s through their ETags).
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.getenv("STATIC_DIR", os.path.join(BASE_DIR, "static"))
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", os.path.join(BASE_DIR, "static_build"))
+STATIC_URL = "/static/"
+SERVICE_WORKER = "sw.js"
+FINGERPRINTED = (".js", ".css")
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/manifest+json", "image/svg+xml")
+# Files smaller than this aren't worth a compressed variant
+COMPRESS_MIN_SIZE = 256
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Types of the files static/ has; others fall back to mimetypes, whose
+# first lookup reads the system type tables (slow on a cold worker)
+MEDIA_TYPES = {
+    ".html": "text/html", ".js": "text/javascript", ".css": "text/css", ".json": "application/json",
+    ".webmanifest": "application/manifest+json", ".svg": "image/svg+xml", ".png": "image/png", ".ico": "image/x-icon",
+}
+_REFERENCE = re.compile(r'(?P<attr>src|href)="(?P<url>[^":?#]+)(?:\?[^"]*)?"')
+_SHELL_VERSION = re.compile(r"^const SHELL_VERSION = [^;\n]*;", re.M)
+_SHELL_ASSETS = re.compile(r"^const SHELL_ASSETS = [^;\n]*;", re.M)
+
+
+class Asset(NamedTuple):
+    media_type: str
+    cache_control: str
+    digest: str
+    bodies: Dict[str, bytes]  # content-coding ("identity", "gzip", "br") -> body
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashed_name(rel: str, data: bytes) -> str:
+    root, ext = posixpath.splitext(rel)
+    return f"{root}.{_digest(data)[:10]}{ext}"
+
+
+def _media_type(rel: str) -> str:
+    media_type = MEDIA_TYPES.get(posixpath.splitext(rel)[1])
+    return media_type or mimetypes.guess_type(rel)[0] or "application/octet-stream"
+
+
+def _rewrite(rel: str, html: bytes, renamed: Dict[str, str]) -> bytes:
+    # Points src/href attributes at the hashed names (query strings dropped)
+    base = posixpath.dirname(rel)
+
+    def replace(match):
+        url = match.group("url")
+        absolute = url.startswith(STATIC_URL)
+        if absolute:
+            target = url[len(STATIC_URL):]
+        elif url.startswith("/"):
+            return match.group(0)
+        else:
+            target = posixpath.normpath(posixpath.join(base, url))
+        if target not in renamed:
+            return match.group(0)
+        hashed = renamed[target]
+        new_url = STATIC_URL + hashed if absolute else posixpath.relpath(hashed, base or ".")
+        return f'{match.group("attr")}="{new_url}"'
+
+    return _REFERENCE.sub(replace, html.decode()).encode()
+
+
+def _fill_shell(worker: bytes, shell: Dict[str, bytes]) -> bytes:
+    version = _digest(b"".join(_digest(data).encode() for _, data in sorted(shell.items())))[:16]
+    urls = ", ".join(f"'{STATIC_URL}{rel}'" for rel in sorted(shell))
+    text = _SHELL_VERSION.sub(f"const SHELL_VERSION = '{version}';", worker.decode(), count=1)
+    text = _SHELL_ASSETS.sub(f"const SHELL_ASSETS = [{urls}];", text, count=1)
+    return text.encode()
+
+
+def _write(path: str, data: bytes) -> bool:
+    # Atomic, and skipped when unchanged (workers booting together build the same files)
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+
+def _variants(path: str, data: bytes, changed: bool) -> Dict[str, bytes]:
+    # Compressed variants kept only when smaller; reused from disk when the file didn't change
+    bodies = {"identity": data}
+    compressors = {"gzip": (".gz", lambda d: gzip.compress(d, 9, mtime=0))}
+    if brotli is not None:
+        compressors["br"] = (".br", lambda d: brotli.compress(d, quality=11))
+    for coding, (suffix, compress) in compressors.items():
+        variant = None
+        if not changed:
+            try:
+                with open(path + suffix, "rb") as f:
+                    variant = f.read()
+            except FileNotFoundError:
+                pass
+        if variant is None:
+            variant = compress(data)
+            if len(variant) < len(data):
+                _write(path + suffix, variant)
+        if len(variant) < len(data):
+            bodies[coding] = variant
+    return bodies
+
+
+def build(source: str = STATIC_DIR, target: str = STATIC_BUILD_DIR) -> Dict[str, Asset]:
+    # Returns {path under /static/: Asset}
+    files: Dict[str, bytes] = {}
+    for root, dirs, names in os.walk(source):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, source).replace(os.sep, "/")] = f.read()
+
+    renamed = {
+        rel: _hashed_name(rel, data) for rel, data in files.items()
+        if rel.endswith(FINGERPRINTED) and rel != SERVICE_WORKER
+    }
+    outputs: Dict[str, bytes] = {}
+    for rel, data in files.items():
+        if rel.endswith(".html"):
+            data = _rewrite(rel, data, renamed)
+        outputs[rel] = data
+        if rel in renamed:
+            outputs[renamed[rel]] = data
+    if SERVICE_WORKER in outputs:
+        shell = {rel: outputs[rel] for rel in outputs
+                 if rel.endswith(".html") or rel in renamed.values() or rel == "manifest.json"}
+        outputs[SERVICE_WORKER] = _fill_shell(outputs[SERVICE_WORKER], shell)
+
+    hashed = set(renamed.values())
+    manifest = {}
+    for rel, data in outputs.items():
+        path = os.path.join(target, *rel.split("/"))
+        changed = _write(path, data)
+        media_type = _media_type(rel)
+        if len(data) >= COMPRESS_MIN_SIZE and media_type.startswith(COMPRESSIBLE):
+            bodies = _variants(path, data, changed)
+        else:
+            bodies = {"identity": data}
+        manifest[rel] = Asset(media_type, IMMUTABLE if rel in hashed else REVALIDATE, _digest(data)[:32], bodies)
+    return manifest
+
+
+def _accepted(header: str) -> set:
+    codings = set()
+    for part in header.lower().split(","):
+        coding, _, params = part.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        codings.add(coding.strip())
+    return codings
+
+
+class StaticAssets(StaticFiles):
+    # Serves the built files from memory with negotiated encodings; anything
+    # not in the build falls through to plain StaticFiles on the build dir
+    def __init__(self, source: str = STATIC_DIR, target: str = STATIC_BUILD_DIR):
+        self.manifest = build(source, target)
+        super().__init__(directory=target)
+
+    async def get_response(self, path: str, scope) -> Response:
+        asset = self.manifest.get(path.replace(os.sep, "/"))
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        accepted = set()
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accepted |= _accepted(value.decode("latin-1"))
+        coding = next((c for c in ("br", "gzip") if c in asset.bodies and (c in accepted or "*" in accepted)), "identity")
+        etag = f'"{asset.digest}"' if coding == "identity" else f'"{asset.digest}-{coding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if len(asset.bodies) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+
+        if_none_match = next((v.decode("latin-1") for n, v in scope["headers"] if n == b"if-none-match"), None)
+        if if_none_match and http_cache.etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(asset.bodies[coding], headers=headers, media_type=asset.media_type)
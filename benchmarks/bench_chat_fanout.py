@@ -0,0 +1,111 @@
+"""Chat fan-out across workers, with one slow client in the room.
+
+Two ConnectionManagers stand in for two worker processes, sharing a
+FakeAsyncRedis backplane (or a real one via --broker redis://...). A room has
+--clients sockets split between them, one of which takes --slow-ms per send.
+Reports delivery latency for the healthy sockets and whether the slow one was
+evicted, next to the old sequential broadcast for comparison.
+
+    python benchmarks/bench_chat_fanout.py [--clients 200] [--messages 200] [--slow-ms 250]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "fanout.db"))
+
+
+class FakeSocket:
+    def __init__(self, delay: float, latencies: list):
+        self.delay = delay
+        self.latencies = latencies
+        self.received = 0
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+        if not self.delay:
+            self.latencies.append(time.perf_counter() - float(message))
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+def report(name, latencies, sent, healthy, slow):
+    ms = sorted(x * 1000 for x in latencies)
+    p = lambda q: ms[min(len(ms) - 1, int(q * len(ms)))] if ms else float("nan")
+    print(f"{name:<32} delivered {len(latencies):>6}/{sent * healthy:<6} "
+          f"p50 {p(0.5):>8.2f}ms  p99 {p(0.99):>8.2f}ms  slow client: "
+          f"{'evicted (code %s)' % slow.closed_with if slow.closed_with else 'still connected'}")
+
+
+async def run_backplane(args):
+    from broker import FakeAsyncRedis, RedisBroker, create_broker
+    from routers.chat import ConnectionManager
+
+    if args.broker:
+        brokers = [create_broker(args.broker), create_broker(args.broker)]
+    else:
+        shared = FakeAsyncRedis()
+        brokers = [RedisBroker(shared), RedisBroker(shared)]
+    workers = [ConnectionManager(b, queue_size=args.queue) for b in brokers]
+
+    latencies = []
+    slow = FakeSocket(args.slow_ms / 1000, [])
+    sockets = [slow] + [FakeSocket(0, latencies) for _ in range(args.clients - 1)]
+    for i, ws in enumerate(sockets):
+        await workers[i % 2].connect(ws, 1)
+    await asyncio.sleep(0.05)
+
+    for i in range(args.messages):
+        # Publish from alternating workers, as senders would be spread across them
+        await workers[i % 2].broadcast(repr(time.perf_counter()), 1)
+        await asyncio.sleep(args.interval_ms / 1000)
+    await asyncio.sleep(0.5)
+
+    report("broker + per-socket queues", latencies, args.messages, args.clients - 1, slow)
+    for w in workers:
+        for ws in list(w.active_connections.get(1, {})):
+            await w.disconnect(ws, 1)
+    for b in brokers:
+        await b.stop()
+
+
+async def run_sequential(args):
+    # The previous ConnectionManager.broadcast: await each socket in turn, one worker
+    latencies = []
+    slow = FakeSocket(args.slow_ms / 1000, [])
+    sockets = [slow] + [FakeSocket(0, latencies) for _ in range(args.clients - 1)]
+    messages = max(1, min(args.messages, int(2000 / max(args.slow_ms, 1))))
+    for _ in range(messages):
+        message = repr(time.perf_counter())
+        for ws in sockets:
+            await ws.send_text(message)
+        await asyncio.sleep(args.interval_ms / 1000)
+    report("sequential (before)", latencies, messages, args.clients - 1, slow)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=5)
+    parser.add_argument("--slow-ms", type=float, default=250)
+    parser.add_argument("--queue", type=int, default=64)
+    parser.add_argument("--broker", default="", help="BROKER_URL to use instead of the in-process stand-in")
+    args = parser.parse_args()
+    asyncio.run(run_sequential(args))
+    asyncio.run(run_backplane(args))
+
+
+if __name__ == "__main__":
+    main()
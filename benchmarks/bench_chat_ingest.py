@@ -0,0 +1,128 @@
+"""Chat ingestion throughput per worker: commit-per-message vs write-behind.
+
+Runs --senders concurrent chat sessions on one event loop (one uvicorn worker),
+each sending --messages frames through the same path as the WebSocket handler
+(routers.chat.ingest_message), into rooms with two listening sockets. Reports
+messages/sec, per-message ingest latency and the rows actually persisted for:
+
+  commit per message  - the previous handler (add + commit + broadcast)
+  write-behind async  - broadcast first, batched INSERT within CHAT_FLUSH_MS
+  write-behind group  - broadcast once the message's batch has committed
+
+    python benchmarks/bench_chat_ingest.py [--senders 50] [--messages 100] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "ingest.db"))
+
+from sqlalchemy import func, select, text
+
+
+class NullSocket:
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+async def run(mode, args, chat, database, models):
+    from broker import InProcessBroker
+    from chat_writer import MessageWriter
+
+    async with database.async_engine.begin() as conn:
+        await conn.execute(text("DELETE FROM messages"))
+
+    chat.manager = chat.ConnectionManager(InProcessBroker())
+    for room in range(args.senders):
+        for _ in range(2):
+            await chat.manager.connect(NullSocket(), room)
+
+    if mode == "commit per message":
+        async def ingest(order_id, sender_id, data):
+            msg_in = json.loads(data)
+            async with database.AsyncSessionLocal() as db:
+                message = models.Message(order_id=order_id, sender_id=sender_id,
+                                         content=msg_in["content"], message_type=msg_in["type"])
+                db.add(message)
+                await db.commit()
+                await chat.manager.broadcast(json.dumps({
+                    "id": message.id, "content": message.content, "sender_id": message.sender_id,
+                    "message_type": message.message_type, "created_at": str(message.created_at),
+                }), order_id)
+        writer = None
+    else:
+        writer = chat.writer = MessageWriter(
+            database.async_engine, batch_size=args.batch, flush_interval=args.flush_ms / 1000,
+            durability=mode.split()[-1],
+        )
+        await writer.start()
+        ingest = chat.ingest_message
+
+    latencies = []
+
+    async def sender(room):
+        for i in range(args.messages):
+            t0 = time.perf_counter()
+            await ingest(room, 1, json.dumps({"content": f"message {i}", "type": "text"}))
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(sender(room) for room in range(args.senders)))
+    elapsed = time.perf_counter() - t0
+    if writer:
+        await writer.stop()
+    async with database.async_engine.connect() as conn:
+        stored = await conn.scalar(select(func.count()).select_from(models.Message.__table__))
+    for room, sockets in list(chat.manager.active_connections.items()):
+        for ws in list(sockets):
+            await chat.manager.disconnect(ws, room)
+
+    total = args.senders * args.messages
+    print(f"{mode:<22} {total / elapsed:>9.0f} msg/s   p50 {pct(latencies, 0.5):>7.2f}ms   "
+          f"p99 {pct(latencies, 0.99):>7.2f}ms   persisted {stored}/{total}"
+          + (f"   ({writer.stats['batches']} batches)" if writer else ""))
+
+
+async def main_async(args):
+    import database
+    import migrations
+    import models
+    from routers import chat
+
+    migrations.upgrade(database.engine)
+    for mode in ("commit per message", "write-behind async", "write-behind group"):
+        await run(mode, args, chat, database, models)
+    await database.async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--flush-ms", type=float, default=50)
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
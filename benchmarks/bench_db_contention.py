@@ -0,0 +1,99 @@
+"""Write throughput under concurrent writers, before and after engine tuning.
+
+Runs the same mix (driver position updates, order inserts, order reads) from
+several threads against two fresh SQLite files: one opened the way database.py
+used to (plain create_engine, rollback journal) and one through
+database.make_engine (pool sizing, WAL, synchronous=NORMAL, busy_timeout, mmap).
+
+    python benchmarks/bench_db_contention.py [--threads 16] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.exc import OperationalError
+
+
+def run(engine, models, threads: int, seconds: float, drivers: int = 200):
+    models.Base.metadata.create_all(bind=engine)
+    profiles = models.DriverProfile.__table__
+    orders = models.Order.__table__
+    with engine.begin() as conn:
+        conn.execute(profiles.insert(), [
+            {"user_id": i, "truck_type": "Standard", "capacity": 10000, "price": 50.0} for i in range(1, drivers + 1)
+        ])
+
+    counts = {"writes": 0, "reads": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        writes = reads = locked = 0
+        while time.monotonic() < deadline:
+            try:
+                op = rnd.random()
+                with engine.begin() as conn:
+                    if op < 0.5:
+                        conn.execute(
+                            update(profiles)
+                            .where(profiles.c.user_id == rnd.randint(1, drivers))
+                            .values(current_lat=rnd.uniform(31, 32), current_lng=rnd.uniform(12, 13))
+                        )
+                        writes += 1
+                    elif op < 0.7:
+                        # Completed: a driver may hold only one open order (ix_orders_open_driver)
+                        conn.execute(orders.insert().values(
+                            customer_id=1, driver_id=rnd.randint(1, drivers), status="completed", amount=50.0,
+                            delivery_lat=31.9, delivery_lng=12.2,
+                        ))
+                        writes += 1
+                    else:
+                        conn.execute(select(orders).where(orders.c.driver_id == rnd.randint(1, drivers)).limit(20)).all()
+                        reads += 1
+            except OperationalError:
+                locked += 1
+        with lock:
+            counts["writes"] += writes
+            counts["reads"] += reads
+            counts["locked"] += locked
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    engine.dispose()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    import database, models
+
+    tmp = tempfile.mkdtemp()
+    before_url = "sqlite:///" + os.path.join(tmp, "before.db")
+    after_url = "sqlite:///" + os.path.join(tmp, "after.db")
+
+    results = {
+        "before": run(create_engine(before_url, connect_args={"check_same_thread": False}), models, args.threads, args.seconds),
+        "after": run(database.make_engine(after_url), models, args.threads, args.seconds),
+    }
+    print(f"{'engine':>7} {'writes/s':>10} {'reads/s':>10} {'locked errors':>14}")
+    for name, c in results.items():
+        print(f"{name:>7} {c['writes'] / args.seconds:>10.0f} {c['reads'] / args.seconds:>10.0f} {c['locked']:>14}")
+
+
+if __name__ == "__main__":
+    main()
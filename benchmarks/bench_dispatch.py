@@ -0,0 +1,118 @@
+"""Dispatch matching latency with thousands of simultaneous pending orders.
+
+Seeds --drivers available drivers and --orders pending dispatch orders spread
+over a --spread-km square, plus --remote-drivers available drivers in another
+city ~300 km away, then runs DispatchEngine cycles: the first offers
+as many orders as there are free drivers, then every offer is declined (or
+left to expire with --expire) and the next cycle cascades to other drivers.
+Reports each cycle's wall time, how many offers it made and how many driver
+rows it loaded as candidates (remote drivers should never be among them).
+
+    python benchmarks/bench_dispatch.py [--drivers 2000] [--orders 5000] [--remote-drivers 0] [--cycles 4] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "dispatch.db"))
+
+from sqlalchemy import insert, select, update
+
+KM_PER_DEG = 111.32
+
+
+def seed(args):
+    import database
+    import geo
+    import migrations
+    import models
+
+    migrations.upgrade(database.engine)
+    random.seed(3)
+    spread = args.spread_km / KM_PER_DEG / 2
+    point = lambda: (31.93 + random.uniform(-spread, spread), 12.25 + random.uniform(-spread, spread))
+    with database.engine.begin() as conn:
+        fleet = args.drivers + args.remote_drivers
+        users = [{"phone": f"d{i}", "full_name": f"Driver {i}", "hashed_password": "x", "role": models.UserRole.DRIVER}
+                 for i in range(fleet)]
+        users.append({"phone": "c0", "full_name": "Customer", "hashed_password": "x", "role": models.UserRole.CUSTOMER})
+        conn.execute(insert(models.User.__table__), users)
+        ids = dict(conn.execute(select(models.User.phone, models.User.id)).all())
+        profiles = []
+        for i in range(fleet):
+            lat, lng = point()
+            if i >= args.drivers:
+                lat, lng = lat + 2.0, lng + 2.0
+            profiles.append({
+                "user_id": ids[f"d{i}"], "truck_type": "Standard", "capacity": random.choice([5000, 10000, 12000]),
+                "price": random.uniform(30, 80), "is_available": True, "current_lat": lat, "current_lng": lng,
+                "geohash": geo.encode(lat, lng),
+                "rating_sum": random.randint(30, 50), "rating_count": 10,
+            })
+        conn.execute(insert(models.DriverProfile.__table__), profiles)
+        now = datetime.utcnow()
+        orders = []
+        for i in range(args.orders):
+            lat, lng = point()
+            orders.append({
+                "customer_id": ids["c0"], "status": models.OrderStatus.PENDING, "liters": random.choice([3000, 5000, 10000]),
+                "delivery_lat": lat, "delivery_lng": lng, "created_at": now - timedelta(milliseconds=args.orders - i),
+                "approach_notified": False, "arrival_notified": False,
+            })
+        conn.execute(insert(models.Order.__table__), orders)
+
+
+async def run(args):
+    import database
+    import dispatch
+    import live_locations
+    import models
+
+    engine = dispatch.DispatchEngine(
+        batch_size=args.orders, max_offers=args.cycles + 1,
+        notify=lambda *a: None, live=live_locations.InMemoryLocationStore(),
+    )
+    now = datetime.utcnow()
+    print(f"{args.drivers} drivers (+{args.remote_drivers} remote), {args.orders} pending orders over {args.spread_km:g} km")
+    for cycle in range(args.cycles):
+        loaded = engine.stats["candidates"]
+        t0 = time.perf_counter()
+        offered = await engine.run_cycle(now)
+        elapsed = time.perf_counter() - t0
+        print(f"  cycle {cycle + 1}: {elapsed * 1000:8.1f} ms   {offered:>6} offers   {engine.stats['candidates'] - loaded:>6} candidates")
+        async with database.AsyncSessionLocal() as db:
+            offer = models.OrderOffer
+            if args.expire:
+                now += timedelta(seconds=engine.offer_timeout + 1)
+            else:
+                await db.execute(update(offer).where(offer.status == models.OfferStatus.OFFERED)
+                                 .values(status=models.OfferStatus.DECLINED))
+                await db.commit()
+    print(f"  stats: {dict(engine.stats)}")
+    await database.async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--remote-drivers", type=int, default=0, help="available drivers far from every order")
+    parser.add_argument("--cycles", type=int, default=4)
+    parser.add_argument("--spread-km", type=float, default=40)
+    parser.add_argument("--expire", action="store_true", help="let offers time out instead of declining them")
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    seed(args)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
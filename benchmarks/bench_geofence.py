@@ -0,0 +1,110 @@
+"""Geofence evaluation for many concurrent en-route orders.
+
+Seeds --orders en-route orders (one driver each) in a temporary database, then
+drives every truck from --start-m metres straight to its delivery point over
+--rounds ping rounds, with --jitter metres of GPS noise. Each round submits all
+positions and runs one GeofenceEngine batch (target load, evaluation, flag
+UPDATEs). Reports batch latency and the alerts sent, next to what the previous
+per-ping check would have sent (one alert on every ping within 500 m).
+
+    python benchmarks/bench_geofence.py [--orders 10000] [--rounds 60] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "geofence.db"))
+
+from sqlalchemy import func, insert, select
+
+METERS_PER_DEG = 111320.0
+
+
+def seed(n):
+    import database
+    import migrations
+    import models
+
+    migrations.upgrade(database.engine)
+    random.seed(7)
+    users = [{"phone": f"gf{i}", "full_name": f"User {i}", "hashed_password": "x",
+              "role": models.UserRole.DRIVER if i % 2 == 0 else models.UserRole.CUSTOMER} for i in range(2 * n)]
+    with database.engine.begin() as conn:
+        conn.execute(insert(models.User.__table__), users)
+        first = conn.scalar(select(func.min(models.User.id)))
+        orders = []
+        for i in range(n):
+            orders.append({
+                "driver_id": first + 2 * i, "customer_id": first + 2 * i + 1,
+                "status": models.OrderStatus.EN_ROUTE, "amount": 50.0,
+                "delivery_lat": 31.93 + random.uniform(-0.1, 0.1),
+                "delivery_lng": 12.25 + random.uniform(-0.1, 0.1),
+                "approach_notified": False, "arrival_notified": False,
+            })
+        conn.execute(insert(models.Order.__table__), orders)
+    return [(o["driver_id"], o["delivery_lat"], o["delivery_lng"]) for o in orders]
+
+
+async def run(args, targets):
+    import database
+    import geofence
+
+    sent = []
+    engine = geofence.GeofenceEngine(notify=lambda user_id, title, body: sent.append(user_id))
+    headings = [random.uniform(0, 2 * math.pi) for _ in targets]
+    legacy_alerts = 0
+    timings = []
+    for r in range(args.rounds + 1):
+        # Distance left shrinks linearly to zero, then the truck idles at the door
+        left = args.start_m * max(0.0, 1 - r / (args.rounds * 0.8))
+        for (driver_id, lat, lng), h in zip(targets, headings):
+            d = left + random.gauss(0, args.jitter)
+            plat = lat + d * math.cos(h) / METERS_PER_DEG
+            plng = lng + d * math.sin(h) / (METERS_PER_DEG * math.cos(math.radians(lat)))
+            engine.submit(driver_id, plat, plng)
+            if abs(d) < 500:
+                legacy_alerts += 1
+        t0 = time.perf_counter()
+        await engine.run_batch()
+        timings.append(time.perf_counter() - t0)
+
+    first, steady = timings[0], sorted(timings[1:])
+    print(f"{len(targets)} en-route orders, {args.rounds + 1} rounds")
+    print(f"  first batch (loads targets)  {first * 1000:8.1f} ms")
+    print(f"  steady batch p50 / max       {steady[len(steady) // 2] * 1000:8.1f} / {steady[-1] * 1000:.1f} ms")
+    print(f"  evaluate() alone             {bench_evaluate(engine, targets) * 1000:8.1f} ms per {len(targets)} positions")
+    print(f"  alerts sent                  {len(sent):8d}  (expected {3 * len(targets)}: approach + arrival x2)")
+    print(f"  per-ping check would send    {legacy_alerts:8d}")
+    await database.async_engine.dispose()
+
+
+def bench_evaluate(engine, targets):
+    positions = {d: (lat, lng) for d, lat, lng in targets}
+    t0 = time.perf_counter()
+    for _ in range(10):
+        engine.evaluate(positions)
+    return (time.perf_counter() - t0) / 10
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=60)
+    parser.add_argument("--start-m", type=float, default=4000)
+    parser.add_argument("--jitter", type=float, default=30)
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    targets = seed(args.orders)
+    asyncio.run(run(args, targets))
+
+
+if __name__ == "__main__":
+    main()
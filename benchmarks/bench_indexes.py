@@ -0,0 +1,163 @@
+"""Query plans and latency of the hot-path lookups, with and without the indexes
+added by migrations 3 and 4.
+
+Builds a database through migrations.upgrade(), seeds it, then for each lookup
+the routers issue prints the planner's choice and the median latency. The
+indexes are then dropped and the same lookups are timed again for comparison.
+Exits non-zero if a plan does not use the index it is meant to.
+
+    python benchmarks/bench_indexes.py [--orders 200000] [--url postgresql://...]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select, text
+
+# Lookup name -> index it should use
+EXPECTED = {
+    "active order (customer)": "ix_orders_customer_id_status",
+    "active order (driver)": "ix_orders_driver_id_status",
+    "my orders (driver)": "ix_orders_driver_id_created_at",
+    "my orders (customer)": "ix_orders_customer_id_created_at",
+    "chat history": "ix_messages_order_id_created_at",
+    "driver reviews": "ix_reviews_driver_id_created_at",
+    "review for order": "ix_reviews_order_id",
+    "driver profile": "ix_driver_profiles_user_id",
+    "push subscriptions": "ix_notification_subscriptions_user_id",
+    "notification history": "ix_notifications_user_id_created_at",
+}
+
+
+def seed(engine, models, orders: int, users: int):
+    rnd = random.Random(7)
+    statuses = [s.value for s in models.OrderStatus]
+    closed = [models.OrderStatus.COMPLETED.value, models.OrderStatus.CANCELLED.value]
+    # A driver has at most one open order (ix_orders_open_driver); further ones are closed
+    busy = set()
+
+    def order_row():
+        driver_id, status = rnd.randint(1, users), rnd.choice(statuses)
+        if status not in closed:
+            if driver_id in busy:
+                status = rnd.choice(closed)
+            busy.add(driver_id)
+        return {
+            "customer_id": rnd.randint(1, users), "driver_id": driver_id,
+            "status": status, "amount": 50.0, "delivery_lat": 31.9, "delivery_lng": 12.2,
+        }
+
+    with engine.begin() as conn:
+        conn.execute(models.DriverProfile.__table__.insert(), [
+            {"user_id": i, "truck_type": "Standard", "capacity": 10000, "price": 50.0} for i in range(1, users + 1)
+        ])
+        conn.execute(models.NotificationSubscription.__table__.insert(), [
+            {"user_id": i, "endpoint": f"https://push.example/{i}", "p256dh": "k", "auth": "a"}
+            for i in range(1, users + 1)
+        ])
+    chunk = 20000
+    for start in range(0, orders, chunk):
+        n = min(chunk, orders - start)
+        with engine.begin() as conn:
+            conn.execute(models.Order.__table__.insert(), [order_row() for _ in range(n)])
+            conn.execute(models.Message.__table__.insert(), [
+                {"order_id": rnd.randint(1, start + n), "sender_id": 1, "content": "hi"} for _ in range(n)
+            ])
+            conn.execute(models.Review.__table__.insert(), [
+                {"order_id": start + i + 1, "driver_id": rnd.randint(1, users), "rating": 5} for i in range(n // 4)
+            ])
+            conn.execute(models.Notification.__table__.insert(), [
+                {"user_id": rnd.randint(1, users), "title": "t", "body": "b"} for _ in range(n)
+            ])
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+
+def lookups(models, rnd, users: int, orders: int):
+    # The statements the routers issue, with fresh parameters each call
+    active = [models.OrderStatus.PENDING, models.OrderStatus.ACCEPTED, models.OrderStatus.EN_ROUTE]
+    O, M, R, P = models.Order, models.Message, models.Review, models.DriverProfile
+    S, N = models.NotificationSubscription, models.Notification
+    return {
+        "active order (customer)": lambda: select(O).where(O.customer_id == rnd.randint(1, users), O.status.in_(active)).limit(1),
+        "active order (driver)": lambda: select(O).where(O.driver_id == rnd.randint(1, users), O.status.in_(active)).limit(1),
+        "my orders (driver)": lambda: select(O).where(O.driver_id == rnd.randint(1, users)).order_by(O.created_at.desc(), O.id.desc()).limit(51),
+        "my orders (customer)": lambda: select(O).where(O.customer_id == rnd.randint(1, users)).order_by(O.created_at.desc(), O.id.desc()).limit(51),
+        "chat history": lambda: select(M).where(M.order_id == rnd.randint(1, orders)).order_by(M.created_at.desc(), M.id.desc()).limit(51),
+        "driver reviews": lambda: select(R).where(R.driver_id == rnd.randint(1, users)).order_by(R.created_at.desc(), R.id.desc()).limit(51),
+        "review for order": lambda: select(R).where(R.order_id == rnd.randint(1, orders)).limit(1),
+        "driver profile": lambda: select(P).where(P.user_id == rnd.randint(1, users)),
+        "push subscriptions": lambda: select(S).where(S.user_id.in_(rnd.sample(range(1, users + 1), 20))),
+        "notification history": lambda: select(N).where(N.user_id == rnd.randint(1, users)).order_by(N.created_at.desc(), N.id.desc()).limit(51),
+    }
+
+
+def plan(conn, stmt) -> str:
+    compiled = stmt.compile(conn, compile_kwargs={"literal_binds": True})
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+        return "; ".join(r[-1] for r in rows)
+    return " / ".join(r[0].strip() for r in conn.execute(text(f"EXPLAIN {compiled}")).all())
+
+
+def measure(engine, queries, repeat: int):
+    results = {}
+    with engine.connect() as conn:
+        for name, make in queries.items():
+            timings = []
+            for _ in range(repeat):
+                stmt = make()
+                t0 = time.perf_counter()
+                conn.execute(stmt).all()
+                timings.append(time.perf_counter() - t0)
+            results[name] = (statistics.median(timings) * 1000, plan(conn, make()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--url", default=None, help="empty database to use (default: a temporary SQLite file)")
+    args = parser.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "indexes.db")
+    os.environ["DATABASE_URL"] = url
+    import database
+    import migrations
+    import models
+
+    engine = database.make_engine(url)
+    migrations.upgrade(engine)
+    t0 = time.perf_counter()
+    seed(engine, models, args.orders, args.users)
+    print(f"seeded {args.orders} orders in {time.perf_counter() - t0:.1f}s ({engine.dialect.name})\n")
+
+    queries = lookups(models, random.Random(1), args.users, args.orders)
+    indexed = measure(engine, queries, args.repeat)
+
+    with engine.begin() as conn:
+        for index in set(EXPECTED.values()):
+            conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+        conn.execute(text("ANALYZE"))
+    bare = measure(engine, queries, max(args.repeat // 10, 5))
+
+    failures = 0
+    print(f"{'lookup':<26} {'no index':>10} {'indexed':>10}  plan")
+    for name, index in EXPECTED.items():
+        ms, indexed_plan = indexed[name]
+        ok = index in indexed_plan
+        failures += not ok
+        print(f"{name:<26} {bare[name][0]:>8.2f}ms {ms:>8.3f}ms  {indexed_plan}{'' if ok else '  <-- expected ' + index}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
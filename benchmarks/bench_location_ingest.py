@@ -0,0 +1,93 @@
+"""Driver location ingest: how many pings still cost a store write and an order lookup.
+
+Simulates --drivers clients for --minutes of GPS pings on a synthetic clock and
+feeds them through live_locations.LocationIngest. A --parked share of drivers
+stand still (with a few metres of GPS jitter), the rest drive at --speed m/s,
+and an --eager share of clients ping every --eager-interval seconds instead of
+every --interval. Before admission every ping was written and looked up its
+EN_ROUTE order; now only accepted ones are.
+
+    python benchmarks/bench_location_ingest.py [--drivers 2000] [--minutes 10] [--parked 0.5]
+"""
+import argparse
+import heapq
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import live_locations
+
+METERS_PER_DEG = 111320.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--parked", type=float, default=0.5)
+    parser.add_argument("--speed", type=float, default=8.0, help="metres/second of moving drivers")
+    parser.add_argument("--jitter", type=float, default=3.0, help="GPS noise in metres")
+    parser.add_argument("--interval", type=float, default=2.0)
+    parser.add_argument("--eager", type=float, default=0.1)
+    parser.add_argument("--eager-interval", type=float, default=0.3)
+    parser.add_argument("--min-interval", type=float, default=live_locations.LOCATION_MIN_INTERVAL)
+    parser.add_argument("--min-meters", type=float, default=live_locations.LOCATION_MIN_METERS)
+    parser.add_argument("--max-silence", type=float, default=live_locations.LOCATION_MAX_SILENCE)
+    args = parser.parse_args()
+
+    random.seed(1)
+    ingest = live_locations.LocationIngest(
+        live_locations.InMemoryLocationStore(),
+        min_interval=args.min_interval, min_meters=args.min_meters, max_silence=args.max_silence,
+    )
+    start = datetime(2024, 1, 1)
+    end = args.minutes * 60
+
+    drivers = []
+    for i in range(args.drivers):
+        heading = random.uniform(0, 2 * math.pi)
+        drivers.append({
+            "lat": 31.93 + random.uniform(-0.05, 0.05),
+            "lng": 12.25 + random.uniform(-0.05, 0.05),
+            "v": 0.0 if random.random() < args.parked else args.speed,
+            "dir": (math.cos(heading), math.sin(heading)),
+            "interval": args.eager_interval if random.random() < args.eager else args.interval,
+            "t": 0.0,
+        })
+    pings = [(random.uniform(0, d["interval"]), i) for i, d in enumerate(drivers)]
+    heapq.heapify(pings)
+
+    total = 0
+    t0 = time.perf_counter()
+    while pings:
+        now, i = heapq.heappop(pings)
+        if now > end:
+            continue
+        d = drivers[i]
+        step = d["v"] * (now - d["t"]) / METERS_PER_DEG
+        d["lat"] += step * d["dir"][0]
+        d["lng"] += step * d["dir"][1]
+        d["t"] = now
+        noise = args.jitter / METERS_PER_DEG
+        ingest.offer(i, d["lat"] + random.gauss(0, noise / 2), d["lng"] + random.gauss(0, noise / 2),
+                     start + timedelta(seconds=now))
+        total += 1
+        heapq.heappush(pings, (now + d["interval"], i))
+    elapsed = time.perf_counter() - t0
+
+    stats = ingest.stats
+    print(f"{total} pings from {args.drivers} drivers over {args.minutes:g} min "
+          f"({total / elapsed:,.0f} pings/s through admission)")
+    for outcome in (live_locations.ACCEPTED, live_locations.COALESCED, live_locations.REJECTED):
+        print(f"  {outcome:<10} {stats[outcome]:>9}  {100 * stats[outcome] / total:5.1f}%")
+    print(f"store writes + order lookups: {total} -> {stats[live_locations.ACCEPTED]} "
+          f"({100 * stats[live_locations.ACCEPTED] / total:.1f}% of before)")
+
+
+if __name__ == "__main__":
+    main()
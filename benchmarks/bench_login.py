@@ -0,0 +1,104 @@
+"""Login throughput through the hashing pool, and shedding under a burst.
+
+Seeds --users users (a quarter of them hashed at a lower cost, to exercise
+re-hashing), then through the ASGI app:
+
+  1. throughput: --logins concurrent logins with no queue limit; reports
+     logins/s overall and per hashing worker (one worker per core)
+  2. burst: 4x the queue limit at once with the configured limit; reports
+     200 vs 503 and the latency of a sync endpoint (GET /reviews/driver/{id})
+     while the burst is running, next to its idle latency
+
+    python benchmarks/bench_login.py [--workers 1] [--rounds 12] [--users 200] [--logins 200] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "login.db"))
+
+PASSWORD = "correct horse battery staple"
+
+
+def seed(args):
+    from passlib.context import CryptContext
+    from sqlalchemy import insert
+    import database, migrations, models, security
+
+    migrations.upgrade(database.engine)
+    current = security.get_password_hash(PASSWORD)
+    outdated = CryptContext(schemes=["bcrypt"], bcrypt__rounds=max(4, args.rounds - 1)).hash(PASSWORD)
+    with database.engine.begin() as conn:
+        conn.execute(insert(models.User.__table__), [
+            {"phone": f"u{i}", "full_name": f"User {i}", "role": models.UserRole.CUSTOMER,
+             "hashed_password": outdated if i % 4 == 0 else current, "is_active": True}
+            for i in range(args.users)
+        ])
+
+
+async def timed_get(client, url, n=20):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await client.get(url)
+    return (time.perf_counter() - t0) / n
+
+
+async def run(args):
+    import httpx
+    import hashing
+    import main as app_main
+    from database import async_engine
+
+    def login(client, i):
+        return client.post("/auth/login", data={"username": f"u{i % args.users}", "password": PASSWORD})
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://test") as client:
+        pool = hashing.pool
+        pool.start()
+        # Warm the workers up (process start, imports)
+        await asyncio.gather(*(login(client, i) for i in range(pool.workers)))
+
+        limit, pool.queue_limit = pool.queue_limit, 10 ** 9
+        t0 = time.perf_counter()
+        codes = Counter(r.status_code for r in await asyncio.gather(*(login(client, i) for i in range(args.logins))))
+        elapsed = time.perf_counter() - t0
+        rate = args.logins / elapsed
+        print(f"{pool.workers} hashing workers, bcrypt cost {args.rounds}")
+        print(f"  throughput   {rate:8.1f} logins/s   {rate / pool.workers:8.1f} per core   {dict(codes)}")
+
+        pool.queue_limit = limit
+        idle = await timed_get(client, "/reviews/driver/1")
+        burst = asyncio.gather(*(login(client, i) for i in range(4 * limit)))
+        await asyncio.sleep(0)
+        during = await timed_get(client, "/reviews/driver/1")
+        codes = Counter(r.status_code for r in await burst)
+        print(f"  burst of {4 * limit} (queue limit {limit}): {dict(sorted(codes.items()))}")
+        print(f"  GET /reviews/driver/1   idle {idle * 1000:6.1f} ms   during burst {during * 1000:6.1f} ms")
+        print(f"  pool stats: {dict(pool.stats)}")
+        pool.stop()
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    os.environ["HASH_WORKERS"] = str(args.workers)
+    os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    seed(args)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Latency of GET /drivers/nearby's query as the fleet grows.
+
+Seeds a throwaway database with N drivers scattered over north-west Libya and
+times geo.nearby_profiles around Zintan.
+
+    python benchmarks/bench_nearby.py [--sizes 100,1000,10000,100000] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ZINTAN = (31.9317, 12.2536)
+# Region drivers are scattered over (lat_lo, lat_hi, lng_lo, lng_hi)
+REGION = (30.0, 33.0, 10.0, 15.0)
+
+
+def seed(engine, models, geo, n):
+    rnd = random.Random(n)
+    with engine.begin() as conn:
+        conn.execute(models.DriverProfile.__table__.delete())
+        conn.execute(models.User.__table__.delete())
+        users, profiles = [], []
+        for i in range(1, n + 1):
+            lat = rnd.uniform(REGION[0], REGION[1])
+            lng = rnd.uniform(REGION[2], REGION[3])
+            users.append({"id": i, "full_name": f"Driver {i}", "phone": f"09{i:08d}", "role": "driver"})
+            profiles.append({
+                "user_id": i, "truck_type": "Standard", "capacity": 10000, "price": 50.0,
+                "is_available": rnd.random() < 0.6, "current_lat": lat, "current_lng": lng,
+                "geohash": geo.encode(lat, lng),
+            })
+        conn.execute(models.User.__table__.insert(), users)
+        conn.execute(models.DriverProfile.__table__.insert(), profiles)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000,100000")
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--radius", type=float, default=25.0)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = url
+
+    import models, geo
+    from database import engine, AsyncSessionLocal
+
+    models.Base.metadata.create_all(bind=engine)
+    print(f"{'drivers':>8} {'found':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    async def measure():
+        timings = []
+        found = 0
+        for _ in range(args.repeat):
+            lat = ZINTAN[0] + random.uniform(-0.05, 0.05)
+            lng = ZINTAN[1] + random.uniform(-0.05, 0.05)
+            async with AsyncSessionLocal() as db:
+                start = time.perf_counter()
+                found = len(await geo.nearby_profiles(db, lat, lng, args.radius, args.limit, available_only=True))
+                timings.append((time.perf_counter() - start) * 1000)
+        return timings, found
+
+    for n in [int(s) for s in args.sizes.split(",")]:
+        seed(engine, models, geo, n)
+        timings, found = asyncio.run(measure())
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        print(f"{n:>8} {found:>6} {p50:>8.2f} {p99:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Web Push delivery throughput against a local stub push service.
+
+Starts a stub HTTP endpoint that answers like a push service (201, or 410 for
+"gone" subscriptions) after a simulated round-trip, seeds subscriptions and
+compares inline delivery (the old request-path behaviour) with the
+background dispatcher.
+
+    python benchmarks/bench_push.py [--users 200] [--rtt-ms 80] [--gone 0.05]
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import tempfile
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().strip("=")
+
+
+def make_keys():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    p256dh = key.public_key().public_bytes(
+        encoding=serialization.Encoding.X962, format=serialization.PublicFormat.UncompressedPoint
+    )
+    return b64(p256dh), b64(os.urandom(16))
+
+
+def serve_stub(rtt: float, port_queue):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(rtt)
+            self.send_response(410 if self.path.startswith("/gone") else 201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_stub(rtt: float):
+    # Separate process so the stub does not compete with the dispatcher for the GIL
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stub, args=(rtt, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=10)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rtt-ms", type=float, default=80.0)
+    parser.add_argument("--gone", type=float, default=0.05, help="fraction of expired subscriptions")
+    parser.add_argument("--workers", type=int, default=32)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    import models
+    from database import engine, SessionLocal
+    from push_queue import PushDispatcher
+    from routers import notifications
+
+    models.Base.metadata.create_all(bind=engine)
+    stub, port = start_stub(args.rtt_ms / 1000)
+    base = f"http://127.0.0.1:{port}"
+
+    db = SessionLocal()
+    p256dh, auth = make_keys()
+    for i in range(1, args.users + 1):
+        path = "/gone" if random.random() < args.gone else "/push"
+        db.add(models.NotificationSubscription(user_id=i, endpoint=f"{base}{path}/{i}", p256dh=p256dh, auth=auth))
+    db.commit()
+    subs = db.query(models.NotificationSubscription).all()
+    db.close()
+
+    # Inline: what a request handler used to wait for, one push per call
+    sample = subs[: min(20, len(subs))]
+    start = time.perf_counter()
+    for sub in sample:
+        info = {"endpoint": sub.endpoint, "keys": {"p256dh": sub.p256dh, "auth": sub.auth}}
+        try:
+            notifications._webpush_sender(info, '{"title": "t", "body": "b"}')
+        except Exception:
+            pass
+    inline = (time.perf_counter() - start) / len(sample)
+    print(f"inline:     {inline * 1000:8.2f} ms per notification in the request path")
+
+    dispatcher = PushDispatcher(sender=notifications._webpush_sender, workers=args.workers)
+    dispatcher.start()
+    enqueue_times = []
+    start = time.perf_counter()
+    for i in range(1, args.users + 1):
+        t = time.perf_counter()
+        dispatcher.enqueue(i, "t", "b")
+        enqueue_times.append(time.perf_counter() - t)
+    dispatcher.join()
+    elapsed = time.perf_counter() - start
+    dispatcher.stop()
+
+    print(f"enqueue:    {percentile(enqueue_times, 0.5) * 1e6:8.1f} us p50, {percentile(enqueue_times, 0.99) * 1e6:.1f} us p99 in the request path")
+    print(f"delivered:  {dispatcher.stats['sent']} sent, {dispatcher.stats['pruned']} pruned, {dispatcher.stats['failed']} failed in {elapsed:.2f}s")
+    print(f"throughput: {args.users / elapsed:8.1f} notifications/s")
+    print(f"latency:    {percentile(dispatcher.latencies, 0.5) * 1000:8.1f} ms p50, {percentile(dispatcher.latencies, 0.99) * 1000:.1f} ms p99 enqueue-to-delivered")
+    stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Worker cold start: how long `import main` and the startup handlers take.
+
+Migrates a throwaway SQLite database, then --runs times in a fresh interpreter
+(after one unmeasured run that warms the bytecode cache) imports the app under
+`python -X importtime` and runs its startup and shutdown handlers. Reports the
+median import and startup times and the packages that cost the most to import
+(self time, grouped by top-level package).
+
+Exits non-zero when the median import time exceeds --budget-ms, or when a
+module in --forbid is imported at boot (heavy optional dependencies must stay
+lazy), so it can gate a build.
+
+    python benchmarks/bench_startup.py [--runs 5] [--budget-ms 1000] [--forbid pywebpush,aiohttp,requests] [--top 15]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOOT = """
+import asyncio, json, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+
+async def boot():
+    await main.app.router.startup()
+    t2 = time.perf_counter()
+    await main.app.router.shutdown()
+    return t2
+
+t2 = asyncio.run(boot())
+print(json.dumps({"import": t1 - t0, "startup": t2 - t1}))
+"""
+
+
+def parse_importtime(stderr: str):
+    # -> (cumulative us of `main`, {module: self us})
+    modules = {}
+    total = None
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        modules[name] = int(self_us)
+        if name == "main":
+            total = int(cumulative_us)
+    return total, modules
+
+
+def boot_once(env):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", BOOT], cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr[-4000:])
+        raise SystemExit("app failed to boot")
+    total, modules = parse_importtime(proc.stderr)
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    return total / 1000, timings["startup"] * 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "1000")))
+    parser.add_argument("--forbid", default="pywebpush,aiohttp,requests",
+                        help="Comma-separated modules that must not be imported at boot")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "startup.db"))
+    env.setdefault("STATIC_BUILD_DIR", os.path.join(tempfile.mkdtemp(), "static"))
+    subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, capture_output=True)
+    subprocess.run([sys.executable, "manage.py", "build-static"], cwd=ROOT, env=env, check=True, capture_output=True)
+
+    boot_once(env)
+    runs = [boot_once(env) for _ in range(args.runs)]
+    imports = [r[0] for r in runs]
+    startups = [r[1] for r in runs]
+    median_import = statistics.median(imports)
+    print(f"import main   median {median_import:8.1f} ms   min {min(imports):8.1f} ms   ({args.runs} runs)")
+    print(f"startup       median {statistics.median(startups):8.1f} ms   min {min(startups):8.1f} ms")
+
+    # Breakdown from the median run
+    _, _, modules = sorted(runs, key=lambda r: r[0])[len(runs) // 2]
+    packages = Counter()
+    for name, self_us in modules.items():
+        packages[name.split(".")[0]] += self_us
+    print(f"\nslowest packages to import (self time, {len(modules)} modules):")
+    for package, self_us in packages.most_common(args.top):
+        print(f"  {package:<28} {self_us / 1000:8.1f} ms")
+
+    failures = []
+    if median_import > args.budget_ms:
+        failures.append(f"import main took {median_import:.1f} ms, budget {args.budget_ms:.0f} ms")
+    forbidden = [name for name in filter(None, args.forbid.split(",")) if name in modules]
+    if forbidden:
+        failures.append(f"imported at boot: {', '.join(forbidden)}")
+    print()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: within {args.budget_ms:.0f} ms, nothing forbidden imported")
+
+
+if __name__ == "__main__":
+    main()
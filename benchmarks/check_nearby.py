@@ -0,0 +1,70 @@
+"""Fail when GET /drivers/nearby misses drivers it should return.
+
+Seeds a throwaway database with an unavailable driver at the search center
+and an available one 2.2 km away, both positioned through the live location
+store, and searches with available_only=true and limit=1 before and after
+the positions are flushed to driver_profiles. The unavailable driver must not
+use up the limit and stop the search from widening to the available one.
+Exits non-zero on any wrong result.
+
+    python benchmarks/check_nearby.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "nearby.db"))
+os.environ.setdefault("NEARBY_CACHE_TTL", "0")
+
+CENTER = (31.93, 12.25)
+# About 2.2 km north of CENTER
+NORTH = (31.95, 12.25)
+
+
+def main():
+    from fastapi.testclient import TestClient
+    import main as app_main
+    import live_locations, migrations, models
+    from database import SessionLocal, engine
+
+    migrations.upgrade(engine)
+
+    db = SessionLocal()
+    drivers = {}
+    for name, available in (("busy", False), ("free", True)):
+        user = models.User(full_name=name, phone=name, role=models.UserRole.DRIVER, hashed_password="x")
+        db.add(user)
+        db.flush()
+        db.add(models.DriverProfile(
+            user_id=user.id, truck_type="Standard", capacity=10000, price=50.0, is_available=available
+        ))
+        drivers[name] = user.id
+    db.commit()
+    db.close()
+    live_locations.store.set(drivers["busy"], *CENTER)
+    live_locations.store.set(drivers["free"], *NORTH)
+
+    cases = [
+        ("available_only", "true", [drivers["free"]]),
+        ("any", "false", [drivers["busy"]]),
+    ]
+    failures = 0
+    with TestClient(app_main.app) as client:
+        for stage in ("live only", "flushed"):
+            if stage == "flushed":
+                live_locations.flush_now()
+            for name, available_only, expected in cases:
+                response = client.get(
+                    f"/drivers/nearby?lat={CENTER[0]}&lng={CENTER[1]}&radius_km=10&limit=1&available_only={available_only}"
+                )
+                assert response.status_code == 200, response.text
+                found = [d["user_id"] for d in response.json()]
+                ok = found == expected
+                failures += not ok
+                print(f"{stage:<10} {name:<15} expected {expected} got {found}  {'ok' if ok else 'WRONG'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Fail when an endpoint's SQL statement count grows with the size of its result.
+
+Seeds a throwaway database, calls each listing endpoint with one row behind it
+and again with many, and compares the number of statements executed
+(database.count_queries). Exits non-zero on any N+1 regression.
+
+    python benchmarks/check_query_counts.py [--rows 25]
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "queries.db"))
+os.environ.setdefault("USER_CACHE_TTL", "0")
+for ttl in ("NEARBY_CACHE_TTL", "REVIEWS_CACHE_TTL", "PROFILE_CACHE_TTL"):
+    os.environ.setdefault(ttl, "0")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=25)
+    args = parser.parse_args()
+
+    from fastapi.testclient import TestClient
+    import main as app_main
+    import migrations, models, security
+    from database import SessionLocal, count_queries, engine
+
+    migrations.upgrade(engine)
+
+    db = SessionLocal()
+    next_phone = iter(range(1000, 10 ** 6))
+
+    def add_user(role, **profile):
+        user = models.User(full_name=f"{role} user", phone=str(next(next_phone)), role=role, hashed_password="x")
+        db.add(user)
+        db.flush()
+        if role == models.UserRole.DRIVER:
+            db.add(models.DriverProfile(
+                user_id=user.id, truck_type="Standard", capacity=10000, price=50.0, is_available=True, **profile
+            ))
+        return user
+
+    def token(user):
+        return {"Authorization": "Bearer " + security.create_access_token(
+            {"sub": user.phone, "role": user.role, "user_id": user.id, "full_name": user.full_name}
+        )}
+
+    customer = add_user(models.UserRole.CUSTOMER)
+    driver = add_user(models.UserRole.DRIVER, current_lat=31.93, current_lng=12.25)
+    first_order = None
+
+    def add_rows(n):
+        # n more orders (each with a review and a chat message) and nearby drivers,
+        # every one with its own counterpart user
+        nonlocal first_order
+        for i in range(n):
+            other_customer = add_user(models.UserRole.CUSTOMER)
+            order = models.Order(
+                customer_id=other_customer.id if i % 2 else customer.id, driver_id=driver.id,
+                status=models.OrderStatus.COMPLETED, amount=50.0, delivery_lat=31.93, delivery_lng=12.25,
+            )
+            db.add(order)
+            db.flush()
+            first_order = first_order or order
+            db.add(models.Review(order_id=order.id, driver_id=driver.id, rating=5))
+            db.add(models.Message(order_id=first_order.id, sender_id=customer.id, content="hi"))
+            add_user(models.UserRole.DRIVER, current_lat=31.93 + i * 0.001, current_lng=12.25)
+        db.commit()
+
+    endpoints = [
+        ("GET /orders/my (customer)", lambda: ("/orders/my?limit=200", token(customer))),
+        ("GET /orders/my (driver)", lambda: ("/orders/my?limit=200", token(driver))),
+        ("GET /reviews/driver/{id}", lambda: (f"/reviews/driver/{driver.id}?limit=200", {})),
+        ("GET /drivers/nearby", lambda: ("/drivers/nearby?lat=31.93&lng=12.25&limit=200", {})),
+        ("GET /chat/{order_id}", lambda: (f"/chat/{first_order.id}?limit=200", token(customer))),
+    ]
+
+    failures = 0
+    with TestClient(app_main.app) as client:
+        def measure():
+            counts = {}
+            for name, target in endpoints:
+                url, headers = target()
+                with count_queries() as counter:
+                    response = client.get(url, headers=headers)
+                assert response.status_code == 200, (name, response.text)
+                body = response.json()
+                counts[name] = (counter.count, len(body["items"] if isinstance(body, dict) else body))
+            return counts
+
+        add_rows(1)
+        small = measure()
+        add_rows(args.rows)
+        large = measure()
+
+    print(f"{'endpoint':<28} {'rows':>9} {'statements':>12}")
+    for name, _ in endpoints:
+        (q1, n1), (q2, n2) = small[name], large[name]
+        ok = q2 <= q1
+        failures += not ok
+        print(f"{name:<28} {n1:>4}->{n2:<4} {q1:>5}->{q2:<5} {'ok' if ok else 'GROWS WITH RESULT SIZE'}")
+    db.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""Fleet traffic load test against a real server, with a baseline to compare runs.
+
+Starts uvicorn on a fresh database (a temporary SQLite file, or --url, e.g. a
+local Postgres) unless --target points at a running server, then:
+
+  - registers --customers customers and --drivers drivers through /auth/register
+    and logs them in; drivers go available at random points around Zintan
+  - drivers ping POST /drivers/location every --ping seconds, poll
+    GET /orders/offers and GET /orders/active, accept offers and move their
+    order through PUT /orders/{id}/status (en_route, then completed)
+  - customers poll GET /drivers/nearby and GET /orders/active every --poll
+    seconds, and place a dispatched order (POST /orders/) now and then
+  - while an order is active, its customer and driver hold /chat/ws sockets;
+    the customer sends a message every --chat seconds and times its echo
+
+Every simulated user has its own seeded RNG, so a run is repeatable for a given
+--seed and sizes. Reports requests, throughput, p50/p99 and errors per
+endpoint. --save-baseline writes those numbers to a JSON file; --baseline
+compares against one and exits non-zero when an endpoint's p50 (or, past
+--min-samples requests, p99) grew by more than --tolerance plus --floor-ms of
+slack, or its error rate went up.
+
+    python benchmarks/loadtest.py [--customers 50] [--drivers 50] [--duration 60]
+        [--url postgresql://localhost/boti_load] [--target http://127.0.0.1:8000]
+        [--save-baseline benchmarks/baseline.json | --baseline benchmarks/baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CENTER = (31.93, 12.25)
+METERS_PER_DEG = 111320.0
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        result = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[endpoint] = {
+                "requests": len(values),
+                "rps": round(len(values) / elapsed, 2),
+                "p50_ms": round(_percentile(values, 50) * 1000, 2),
+                "p99_ms": round(_percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+                "error_rate": round(self.errors[endpoint] / len(values), 4),
+            }
+        return result
+
+
+def _percentile(values, p):
+    # Nearest rank on sorted values
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Fleet:
+    def __init__(self, args, client, recorder: Recorder):
+        self.args = args
+        self.client = client
+        self.rec = recorder
+        self.run_id = uuid.uuid4().hex[:6]
+        self.deadline = 0.0
+        # Registration and login hash passwords; the server sheds past a few at once
+        self.seeding = asyncio.Semaphore(4)
+
+    async def call(self, endpoint: str, method: str, url: str, token=None, expect=(200,), **kwargs):
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        start = time.perf_counter()
+        try:
+            r = await self.client.request(method, url, headers=headers, **kwargs)
+            ok = r.status_code in expect
+        except Exception:
+            r, ok = None, False
+        self.rec.add(endpoint, time.perf_counter() - start, ok)
+        return r if ok else None
+
+    async def seed_call(self, url: str, **kwargs):
+        async with self.seeding:
+            for _ in range(30):
+                r = await self.client.post(url, **kwargs)
+                if r.status_code != 503:
+                    return r
+                await asyncio.sleep(float(r.headers.get("Retry-After", 1)))
+        return r
+
+    async def register(self, i: int, role: str) -> dict:
+        phone = f"lt{self.run_id}{role[0]}{i}"
+        await self.seed_call("/auth/register", json={"phone": phone, "full_name": f"{role} {i}", "password": "load-test", "role": role})
+        r = await self.seed_call("/auth/login", data={"username": phone, "password": "load-test"})
+        if r.status_code != 200:
+            raise RuntimeError(f"could not log in {phone}: {r.status_code} {r.text}")
+        data = r.json()
+        return {"id": data["user_id"], "token": data["access_token"]}
+
+    def running(self) -> bool:
+        return time.monotonic() < self.deadline
+
+    async def sleep(self, rng, interval):
+        # Jittered interval, so users don't move in lock step
+        await asyncio.sleep(interval * rng.uniform(0.8, 1.2))
+
+    # --- Drivers ---
+    async def driver(self, user, rng):
+        token = user["token"]
+        spread = 5000 / METERS_PER_DEG
+        lat, lng = CENTER[0] + rng.uniform(-spread, spread), CENTER[1] + rng.uniform(-spread, spread)
+        await self.call("POST /drivers/location", "POST", "/drivers/location", token, json={"lat": lat, "lng": lng})
+        await self.call("POST /drivers/status", "POST", "/drivers/status", token, params={"is_available": True})
+        chat = None
+        await asyncio.sleep(rng.uniform(0, self.args.ping))
+        while self.running():
+            lat += rng.gauss(0, 150) / METERS_PER_DEG
+            lng += rng.gauss(0, 150) / METERS_PER_DEG
+            await self.call("POST /drivers/location", "POST", "/drivers/location", token,
+                            expect=(200, 429), json={"lat": lat, "lng": lng})
+            r = await self.call("GET /orders/active", "GET", "/orders/active", token)
+            order = r.json() if r is not None else None
+            if order is None:
+                if chat:
+                    chat.cancel()
+                    chat = None
+                r = await self.call("GET /orders/offers", "GET", "/orders/offers", token)
+                offers = r.json() if r is not None else []
+                if offers:
+                    await self.call("POST /orders/{id}/accept", "POST", f"/orders/{offers[0]['order_id']}/accept",
+                                    token, expect=(200, 409))
+            else:
+                if chat is None:
+                    chat = asyncio.create_task(self.chat_listener(order["id"], user["id"]))
+                step = {"accepted": "en_route", "en_route": "completed"}.get(order["status"])
+                if step:
+                    await self.call("PUT /orders/{id}/status", "PUT", f"/orders/{order['id']}/status", token,
+                                    expect=(200, 409), json={"status": step, "version": order["version"]})
+            await self.sleep(rng, self.args.ping)
+        if chat:
+            chat.cancel()
+
+    # --- Customers ---
+    async def customer(self, user, rng):
+        token = user["token"]
+        spread = 8000 / METERS_PER_DEG
+        home = (CENTER[0] + rng.uniform(-spread, spread), CENTER[1] + rng.uniform(-spread, spread))
+        chat = None
+        await asyncio.sleep(rng.uniform(0, self.args.poll))
+        while self.running():
+            await self.call("GET /drivers/nearby", "GET", "/drivers/nearby", token,
+                            params={"lat": home[0], "lng": home[1], "available_only": True})
+            r = await self.call("GET /orders/active", "GET", "/orders/active", token)
+            order = r.json() if r is not None else None
+            if order is None:
+                if chat:
+                    chat.cancel()
+                    chat = None
+                if rng.random() < self.args.order_rate:
+                    await self.call("POST /orders/", "POST", "/orders/", token, json={
+                        "liters": rng.choice([3000, 5000, 10000]), "delivery_lat": home[0], "delivery_lng": home[1],
+                    })
+            elif order["driver_id"] and chat is None:
+                chat = asyncio.create_task(self.chat_sender(order["id"], user["id"], rng))
+            await self.sleep(rng, self.args.poll)
+        if chat:
+            chat.cancel()
+
+    # --- Chat ---
+    def _ws_url(self, order_id, user_id):
+        return self.args.ws_base + f"/chat/ws/{order_id}/{user_id}"
+
+    async def chat_listener(self, order_id, user_id):
+        import websockets
+        try:
+            async with websockets.connect(self._ws_url(order_id, user_id)) as ws:
+                async for _ in ws:
+                    pass
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def chat_sender(self, order_id, user_id, rng):
+        import websockets
+        try:
+            async with websockets.connect(self._ws_url(order_id, user_id)) as ws:
+                while self.running():
+                    marker = uuid.uuid4().hex
+                    start = time.perf_counter()
+                    await ws.send(json.dumps({"content": marker, "type": "text"}))
+                    ok = False
+                    try:
+                        async with asyncio.timeout(5):
+                            while not ok:
+                                ok = marker in await ws.recv()
+                    except TimeoutError:
+                        pass
+                    self.rec.add("WS /chat/ws echo", time.perf_counter() - start, ok)
+                    await self.sleep(rng, self.args.chat)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.rec.add("WS /chat/ws echo", 0.0, False)
+
+
+def start_server(args):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "load.db"),
+        # Seeding is not what's measured; keep bcrypt cheap and tokens valid for the run
+        "BCRYPT_ROUNDS": env.get("BCRYPT_ROUNDS", "4"),
+        "ACCESS_TOKEN_EXPIRE_MINUTES": env.get("ACCESS_TOKEN_EXPIRE_MINUTES", "600"),
+    })
+    subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    return server
+
+
+async def wait_ready(client, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become healthy")
+
+
+async def run(args) -> dict:
+    import httpx
+
+    server = None if args.target else start_server(args)
+    base = args.target or f"http://127.0.0.1:{args.port}"
+    args.ws_base = "ws" + base[len("http"):]
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    try:
+        async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+            await wait_ready(client, server)
+            fleet = Fleet(args, client, recorder)
+            rng = random.Random(args.seed)
+            drivers = await asyncio.gather(*(fleet.register(i, "driver") for i in range(args.drivers)))
+            customers = await asyncio.gather(*(fleet.register(i, "customer") for i in range(args.customers)))
+            print(f"seeded {len(drivers)} drivers, {len(customers)} customers; running {args.duration:g}s against {base}")
+
+            fleet.deadline = time.monotonic() + args.duration
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(fleet.driver(u, random.Random(rng.random())) for u in drivers),
+                *(fleet.customer(u, random.Random(rng.random())) for u in customers),
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+    return recorder.summary(elapsed)
+
+
+def report(summary: dict):
+    print(f"{'endpoint':30} {'requests':>9} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for endpoint, s in summary.items():
+        print(f"{endpoint:30} {s['requests']:9d} {s['rps']:8.2f} {s['p50_ms']:9.2f} {s['p99_ms']:9.2f} "
+              f"{s['max_ms']:9.2f} {s['error_rate']:7.2%}")
+
+
+def compare(summary: dict, baseline: dict, tolerance: float, floor_ms: float, min_samples: int) -> list:
+    failures = []
+    for endpoint, base in baseline["endpoints"].items():
+        now = summary.get(endpoint)
+        if now is None:
+            failures.append(f"{endpoint}: no requests this run")
+            continue
+        # A p99 over a handful of requests is just the slowest one
+        keys = ("p50_ms", "p99_ms") if min(base["requests"], now["requests"]) >= min_samples else ("p50_ms",)
+        for key in keys:
+            limit = base[key] * (1 + tolerance) + floor_ms
+            if now[key] > limit:
+                failures.append(f"{endpoint}: {key} {now[key]:.2f} > {limit:.2f} (baseline {base[key]:.2f})")
+        if now["error_rate"] > base["error_rate"] + 0.01:
+            failures.append(f"{endpoint}: error rate {now['error_rate']:.2%} (baseline {base['error_rate']:.2%})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--customers", type=int, default=50)
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--ping", type=float, default=5, help="driver location ping interval, seconds")
+    parser.add_argument("--poll", type=float, default=5, help="customer polling interval, seconds")
+    parser.add_argument("--chat", type=float, default=3, help="chat message interval, seconds")
+    parser.add_argument("--order-rate", type=float, default=0.2, help="chance per idle poll that a customer orders")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--url", default=None, help="DATABASE_URL for the spawned server (default: a temporary SQLite file)")
+    parser.add_argument("--target", default=None, help="base URL of an already running server; nothing is spawned")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--save-baseline", default=None, metavar="PATH")
+    parser.add_argument("--baseline", default=None, metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p50/p99 growth")
+    parser.add_argument("--floor-ms", type=float, default=2.0, help="absolute slack added to every limit")
+    parser.add_argument("--min-samples", type=int, default=100, help="requests needed before p99 is compared")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    report(summary)
+    config = {k: getattr(args, k) for k in ("customers", "drivers", "duration", "ping", "poll", "chat", "order_rate", "seed", "workers")}
+    config["database"] = "postgresql" if (args.url or "").startswith("postgres") else "sqlite" if not args.target else "external"
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"config": config, "endpoints": summary}, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"warning: baseline was recorded with {baseline.get('config')}")
+        failures = compare(summary, baseline, args.tolerance, args.floor_ms, args.min_samples)
+        for failure in failures:
+            print("  REGRESSION", failure)
+        print("FAILED" if failures else "OK: within baseline")
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
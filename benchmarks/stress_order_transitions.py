@@ -0,0 +1,127 @@
+"""Concurrent status changes on the same orders: check the transitions stay consistent.
+
+Seeds --orders direct-booked orders (one driver each), then for every order
+fires --copies of each status request (driver: accepted, en_route, completed;
+customer: cancelled) all at once, in random order, through the ASGI app. Exits
+non-zero unless, for every order:
+
+  - no request failed with a 5xx
+  - the successful requests equal the order's version bumps
+  - the successful requests, in version order, form a legal path from pending
+  - a completed order was counted once in driver_daily_stats
+
+    python benchmarks/stress_order_transitions.py [--orders 200] [--copies 3] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "stress.db"))
+os.environ.setdefault("USER_CACHE_TTL", "0")
+
+
+def seed(n):
+    import models, security
+    from database import SessionLocal
+
+    db = SessionLocal()
+    # One driver per order: a driver has at most one open order (ix_orders_open_driver)
+    drivers = [models.User(full_name=f"Driver {i}", phone=f"d{i}", role=models.UserRole.DRIVER, hashed_password="x")
+               for i in range(n)]
+    customer = models.User(full_name="Customer", phone="c0", role=models.UserRole.CUSTOMER, hashed_password="x")
+    db.add_all(drivers + [customer])
+    db.flush()
+    db.add_all(models.DriverProfile(user_id=d.id, capacity=10000, price=50.0, is_available=True) for d in drivers)
+    orders = [models.Order(customer_id=customer.id, driver_id=d.id, amount=50.0,
+                           delivery_lat=31.93, delivery_lng=12.25) for d in drivers]
+    db.add_all(orders)
+    db.commit()
+
+    def token(user):
+        return {"Authorization": "Bearer " + security.create_access_token(
+            {"sub": user.phone, "role": user.role, "user_id": user.id, "full_name": user.full_name}
+        )}
+    result = {o.id: token(d) for o, d in zip(orders, drivers)}, token(customer), [d.id for d in drivers]
+    db.close()
+    return result
+
+
+async def run(args):
+    import httpx
+    import main as app_main
+    import migrations, models, transitions
+    from database import SessionLocal, async_engine, engine
+
+    migrations.upgrade(engine)
+
+    driver_auths, customer_auth, driver_ids = seed(args.orders)
+    order_ids = list(driver_auths)
+    requests = [("accepted", None), ("en_route", None), ("completed", None), ("cancelled", customer_auth)] * args.copies
+    outcomes = Counter()
+    wins = {}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://test") as client:
+        async def change(order_id, status, auth):
+            r = await client.put(f"/orders/{order_id}/status", json={"status": status}, headers=auth)
+            outcomes[r.status_code] += 1
+            if r.status_code == 200:
+                wins.setdefault(order_id, []).append((r.json()["version"], status))
+
+        calls = [(o, s, a or driver_auths[o]) for o in order_ids for s, a in requests]
+        random.shuffle(calls)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(change(o, s, a) for o, s, a in calls))
+        elapsed = time.perf_counter() - t0
+
+    db = SessionLocal()
+    orders = {o.id: o for o in db.query(models.Order).filter(models.Order.id.in_(order_ids))}
+    counted = sum(r.orders_count for r in db.query(models.DriverDailyStats).filter(models.DriverDailyStats.driver_id.in_(driver_ids)))
+    db.close()
+    await async_engine.dispose()
+
+    errors = []
+    for order_id, order in orders.items():
+        path = [s for _, s in sorted(wins.get(order_id, []))]
+        if len(path) != order.version - 1:
+            errors.append(f"order {order_id}: {len(path)} successful updates but version {order.version}")
+        state = models.OrderStatus.PENDING.value
+        for step in path:
+            if not transitions.allowed(state, step, models.UserRole.DRIVER) and not transitions.allowed(state, step, models.UserRole.CUSTOMER):
+                errors.append(f"order {order_id}: illegal {state} -> {step} in {path}")
+            state = step
+        if state != order.status:
+            errors.append(f"order {order_id}: ended {order.status}, path says {state}")
+    completed = sum(1 for o in orders.values() if o.status == models.OrderStatus.COMPLETED)
+    if counted != completed:
+        errors.append(f"driver_daily_stats counts {counted} orders, {completed} completed")
+    if any(code >= 500 for code in outcomes):
+        errors.append(f"server errors: {outcomes}")
+
+    print(f"{len(calls)} concurrent status requests on {args.orders} orders in {elapsed:.2f}s")
+    print(f"  responses: {dict(sorted(outcomes.items()))}")
+    print(f"  final: {dict(Counter(o.status for o in orders.values()))}")
+    for e in errors[:20]:
+        print("  FAIL", e)
+    print("FAILED" if errors else "OK: every order followed a legal path, each transition applied once")
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--copies", type=int, default=3)
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
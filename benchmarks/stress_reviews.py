@@ -0,0 +1,122 @@
+"""Concurrent reviews for the same drivers: check no rating update is lost.
+
+Seeds --drivers drivers and --orders completed orders spread over them, then
+posts every order's review --copies times at once, in random order, through
+the ASGI app. Exits non-zero unless:
+
+  - no request failed with a 5xx
+  - each order got exactly one review (the copies were turned away with 400)
+  - every driver's rating_sum / rating_count match their reviews
+  - reconcile() finds nothing to fix, and repairs aggregates broken on purpose
+
+    python benchmarks/stress_reviews.py [--drivers 5] [--orders 300] [--copies 3] [--url sqlite:///...]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "reviews.db"))
+os.environ.setdefault("USER_CACHE_TTL", "0")
+
+from sqlalchemy import func, select, update
+
+
+def seed(args):
+    import models, security
+    from database import SessionLocal
+
+    db = SessionLocal()
+    drivers = [models.User(full_name=f"Driver {i}", phone=f"d{i}", role=models.UserRole.DRIVER, hashed_password="x")
+               for i in range(args.drivers)]
+    customer = models.User(full_name="Customer", phone="c0", role=models.UserRole.CUSTOMER, hashed_password="x")
+    db.add_all([*drivers, customer])
+    db.flush()
+    db.add_all([models.DriverProfile(user_id=d.id, capacity=10000, price=50.0) for d in drivers])
+    orders = [models.Order(customer_id=customer.id, driver_id=random.choice(drivers).id, amount=50.0,
+                           status=models.OrderStatus.COMPLETED, delivery_lat=31.93, delivery_lng=12.25)
+              for _ in range(args.orders)]
+    db.add_all(orders)
+    db.commit()
+    auth = {"Authorization": "Bearer " + security.create_access_token(
+        {"sub": customer.phone, "role": customer.role, "user_id": customer.id, "full_name": customer.full_name}
+    )}
+    result = [o.id for o in orders], auth
+    db.close()
+    return result
+
+
+async def run(args):
+    import httpx
+    import main as app_main
+    import migrations, models, ratings
+    from database import engine, async_engine
+
+    migrations.upgrade(engine)
+
+    order_ids, auth = seed(args)
+    outcomes = Counter()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://test") as client:
+        async def review(order_id, rating):
+            r = await client.post(f"/reviews/{order_id}", json={"rating": rating}, headers=auth)
+            outcomes[r.status_code] += 1
+
+        calls = [(o, random.randint(1, 5)) for o in order_ids for _ in range(args.copies)]
+        random.shuffle(calls)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(review(o, r) for o, r in calls))
+        elapsed = time.perf_counter() - t0
+
+    errors = []
+    R, P = models.Review, models.DriverProfile
+    with engine.begin() as conn:
+        reviewed = dict(conn.execute(select(R.order_id, func.count()).group_by(R.order_id)).all())
+        expected = dict((d, (s, n)) for d, s, n in conn.execute(
+            select(R.driver_id, func.sum(R.rating), func.count()).group_by(R.driver_id)))
+        stored = dict((d, (s, n)) for d, s, n in conn.execute(select(P.user_id, P.rating_sum, P.rating_count)))
+        drifted = ratings.reconcile(conn)
+        conn.execute(update(P).values(rating_sum=P.rating_sum + 1))
+        repaired = ratings.reconcile(conn)
+    await async_engine.dispose()
+
+    for order_id in order_ids:
+        if reviewed.get(order_id) != 1:
+            errors.append(f"order {order_id}: {reviewed.get(order_id, 0)} reviews")
+    for driver_id, aggregates in stored.items():
+        if aggregates != expected.get(driver_id, (0, 0)):
+            errors.append(f"driver {driver_id}: stored {aggregates}, reviews say {expected.get(driver_id)}")
+    if drifted:
+        errors.append(f"reconcile fixed {drifted} drivers after the run")
+    if repaired != len(stored):
+        errors.append(f"reconcile repaired {repaired} of {len(stored)} broken drivers")
+    if any(code >= 500 for code in outcomes) or outcomes[200] != len(order_ids):
+        errors.append(f"responses: {outcomes}")
+
+    print(f"{len(calls)} concurrent reviews on {args.orders} orders, {args.drivers} drivers in {elapsed:.2f}s")
+    print(f"  responses: {dict(sorted(outcomes.items()))}")
+    for e in errors[:20]:
+        print("  FAIL", e)
+    print("FAILED" if errors else "OK: one review per order, no rating update lost")
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drivers", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=300)
+    parser.add_argument("--copies", type=int, default=3)
+    parser.add_argument("--url", default=None, help="DATABASE_URL to load (default: a temporary SQLite file)")
+    args = parser.parse_args()
+    if args.url:
+        os.environ["DATABASE_URL"] = args.url
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
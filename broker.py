@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# handler(channel, message). Called on the event loop for every message
+# published on a subscribed channel, by any worker; must not block.
+Handler = Callable[[str, str], None]
+
+
+class Broker(ABC):
+    # Pub/sub backplane so every worker process sees every published message.
+    # Local handlers are registered per channel; the backend subscription is
+    # taken when a channel gets its first handler and dropped with its last.
+
+    def __init__(self):
+        self._handlers: Dict[str, Set[Handler]] = {}
+        self._started = False
+        self._start_lock: Optional[asyncio.Lock] = None
+
+    async def start(self):
+        if self._started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not self._started:
+                await self._connect()
+                self._started = True
+
+    async def stop(self):
+        if self._started:
+            self._started = False
+            await self._close()
+        self._handlers.clear()
+
+    async def publish(self, channel: str, message: str):
+        await self.start()
+        await self._publish(channel, message)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        await self.start()
+        handlers = self._handlers.setdefault(channel, set())
+        first = not handlers
+        handlers.add(handler)
+        if first:
+            await self._listen(channel)
+
+    async def unsubscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self._handlers[channel]
+            if self._started:
+                await self._unlisten(channel)
+
+    def _dispatch(self, channel: str, message: str):
+        for handler in list(self._handlers.get(channel, ())):
+            try:
+                handler(channel, message)
+            except Exception:
+                logger.exception("Broker handler failed on %s", channel)
+
+    # --- Backend hooks (only _publish is required) ---
+    async def _connect(self):
+        pass
+
+    async def _close(self):
+        pass
+
+    @abstractmethod
+    async def _publish(self, channel: str, message: str):
+        ...
+
+    async def _listen(self, channel: str):
+        pass
+
+    async def _unlisten(self, channel: str):
+        pass
+
+
+class InProcessBroker(Broker):
+    # Single worker: publishing is a direct call into the local handlers
+
+    async def _publish(self, channel, message):
+        self._dispatch(channel, message)
+
+
+class RedisBroker(Broker):
+    # Redis PUBLISH / SUBSCRIBE. Only needs publish() and pubsub() with
+    # subscribe/unsubscribe/get_message/aclose, so FakeAsyncRedis can stand in.
+
+    def __init__(self, client, prefix: str = "boti:"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def _connect(self):
+        self._pubsub = self.client.pubsub()
+        self._reader = asyncio.create_task(self._read())
+
+    async def _close(self):
+        self._reader.cancel()
+        try:
+            await self._reader
+        except asyncio.CancelledError:
+            pass
+        await self._pubsub.aclose()
+
+    async def _publish(self, channel, message):
+        await self.client.publish(self.prefix + channel, message)
+
+    async def _listen(self, channel):
+        await self._pubsub.subscribe(self.prefix + channel)
+
+    async def _unlisten(self, channel):
+        await self._pubsub.unsubscribe(self.prefix + channel)
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Redis pub/sub read failed")
+                await asyncio.sleep(1.0)
+                continue
+            if not msg or msg.get("type") != "message":
+                continue
+            channel, data = msg["channel"], msg["data"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            self._dispatch(channel[len(self.prefix):], data)
+
+
+class PostgresBroker(Broker):
+    # LISTEN / NOTIFY on the application database, through asyncpg.
+    # Payloads are limited to ~8000 bytes by Postgres.
+
+    def __init__(self, dsn: str, prefix: str = "boti:"):
+        super().__init__()
+        self.dsn = dsn
+        self.prefix = prefix
+        self._listen_conn = None
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+
+    async def _connect(self):
+        import asyncpg
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        self._publish_conn = await asyncpg.connect(self.dsn)
+
+    async def _close(self):
+        for conn in (self._listen_conn, self._publish_conn):
+            await conn.close()
+
+    async def _publish(self, channel, message):
+        async with self._publish_lock:
+            await self._publish_conn.execute("SELECT pg_notify($1, $2)", self.prefix + channel, message)
+
+    async def _listen(self, channel):
+        await self._listen_conn.add_listener(self.prefix + channel, self._on_notify)
+
+    async def _unlisten(self, channel):
+        await self._listen_conn.remove_listener(self.prefix + channel, self._on_notify)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._dispatch(channel[len(self.prefix):], payload)
+
+
+class FakeAsyncRedis:
+    # In-process stand-in for the redis.asyncio pub/sub commands used above.
+    # Several RedisBrokers sharing one instance behave like separate workers.
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set["_FakePubSub"]] = {}
+
+    async def publish(self, channel: str, message: str) -> int:
+        subscribers = list(self._subscribers.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub._queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(subscribers)
+
+    def pubsub(self) -> "_FakePubSub":
+        return _FakePubSub(self)
+
+
+class _FakePubSub:
+    def __init__(self, redis: FakeAsyncRedis):
+        self._redis = redis
+        self._channels: Set[str] = set()
+        self._queue: "asyncio.Queue[dict]" = asyncio.Queue()
+
+    async def subscribe(self, *channels: str):
+        for channel in channels:
+            self._channels.add(channel)
+            self._redis._subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, *channels: str):
+        for channel in channels:
+            self._channels.discard(channel)
+            self._redis._subscribers.get(channel, set()).discard(self)
+
+    async def get_message(self, ignore_subscribe_messages: bool = False, timeout: float = 0.0):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        await self.unsubscribe(*list(self._channels))
+
+
+def create_broker(url: Optional[str] = None) -> Broker:
+    # BROKER_URL: unset -> in-process, memory:// -> FakeAsyncRedis,
+    # redis://... -> Redis, postgresql://... -> LISTEN/NOTIFY
+    url = url if url is not None else os.getenv("BROKER_URL", "")
+    if not url:
+        return InProcessBroker()
+    if url.startswith("memory://"):
+        return RedisBroker(FakeAsyncRedis())
+    if url.startswith(("postgres://", "postgresql://", "postgresql+asyncpg://")):
+        return PostgresBroker("postgresql://" + url.split("://", 1)[1])
+    import redis.asyncio
+    return RedisBroker(redis.asyncio.Redis.from_url(url))
+
+
+broker = create_broker()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+
+import models
+
+logger = logging.getLogger(__name__)
+
+CHAT_BATCH_SIZE = int(os.getenv("CHAT_BATCH_SIZE", "200"))
+CHAT_FLUSH_MS = float(os.getenv("CHAT_FLUSH_MS", "50"))
+# async: broadcast first, persist within CHAT_FLUSH_MS (a crash can lose that window)
+# group: wait for the batch holding the message to commit before broadcasting.
+#        Batches are written back to back without lingering: whatever arrived
+#        while the previous INSERT was running goes into the next one.
+CHAT_DURABILITY = os.getenv("CHAT_DURABILITY", "async")
+CHAT_WRITE_RETRIES = int(os.getenv("CHAT_WRITE_RETRIES", "3"))
+
+DURABILITY_MODES = ("async", "group")
+
+
+def new_message(order_id: int, sender_id: int, content: str, message_type: str) -> dict:
+    # A messages row with its uid and timestamp fixed up front, so it can be
+    # broadcast before it is written. The integer id is assigned on insert.
+    return {
+        "uid": uuid.uuid4().hex,
+        "order_id": order_id,
+        "sender_id": sender_id,
+        "content": content,
+        "message_type": message_type,
+        "is_read": False,
+        "created_at": datetime.utcnow(),
+    }
+
+
+class MessageWriter:
+    # Write-behind for chat messages: submit() queues a row and a single task
+    # writes whatever has accumulated as one multi-row INSERT, every
+    # flush_interval or batch_size rows, whichever comes first.
+
+    def __init__(
+        self,
+        engine=None,
+        batch_size: int = CHAT_BATCH_SIZE,
+        flush_interval: float = CHAT_FLUSH_MS / 1000,
+        durability: str = CHAT_DURABILITY,
+        retries: int = CHAT_WRITE_RETRIES,
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"CHAT_DURABILITY must be one of {DURABILITY_MODES}")
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.retries = retries
+        self.stats = Counter()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            if self.engine is None:
+                from database import async_engine
+                self.engine = async_engine
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Write everything already submitted, then stop
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, row: dict):
+        await self.start()
+        done = asyncio.get_running_loop().create_future() if self.durability == "group" else None
+        self._queue.put_nowait((row, done))
+        self.stats["submitted"] += 1
+        if done is not None:
+            await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch: List[Tuple[dict, Optional[asyncio.Future]]] = [item]
+            linger = self.flush_interval if self.durability == "async" else 0.0
+            deadline = loop.time() + linger
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        rows = [row for row, _ in batch]
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.engine.begin() as conn:
+                    await conn.execute(insert(models.Message.__table__).values(rows))
+                error = None
+                break
+            except Exception as ex:
+                error = ex
+                logger.warning("Chat batch of %d failed (attempt %d): %s", len(rows), attempt + 1, ex)
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        if error is None:
+            self.stats["written"] += len(rows)
+            self.stats["batches"] += 1
+        else:
+            self.stats["failed"] += len(rows)
+            logger.error("Dropped %d chat messages: %s", len(rows), error)
+        for _, done in batch:
+            if done is not None and not done.done():
+                if error is None:
+                    done.set_result(None)
+                else:
+                    done.set_exception(error)
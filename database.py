@@ -1,7 +1,12 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from typing import Callable, List
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import os
+import time
 
 # Get DB URL from env or use local sqlite as fallback
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./boti.db")
@@ -10,14 +15,119 @@ SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./boti.db")
 if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
     SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-# SQLite needs specific args, Postgres does not
-connect_args = {"check_same_thread": False} if "sqlite" in SQLALCHEMY_DATABASE_URL else {}
+# --- Engine settings (override via env) ---
+DB_POOL_SIZE = os.getenv("DB_POOL_SIZE")
+DB_MAX_OVERFLOW = os.getenv("DB_MAX_OVERFLOW")
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # Seconds, Postgres only
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+DB_ECHO = os.getenv("DB_ECHO", "").lower() in ("1", "true", "yes")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args=connect_args
-)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+def engine_options(url: str) -> dict:
+    # create_engine() keyword arguments tuned per backend
+    if is_sqlite(url):
+        # SQLite needs specific args; writers serialize anyway so a small pool is enough
+        options = {
+            "connect_args": {
+                "check_same_thread": False,
+                "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+                "cached_statements": DB_STATEMENT_CACHE_SIZE,
+            },
+            "query_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "echo": DB_ECHO,
+        }
+        if ":memory:" not in url and url.rstrip("/") not in ("sqlite:", "sqlite+aiosqlite:"):
+            # File databases get a QueuePool; in-memory ones keep SQLAlchemy's default
+            options.update(
+                pool_size=int(DB_POOL_SIZE or 5),
+                max_overflow=int(DB_MAX_OVERFLOW or 10),
+                pool_timeout=DB_POOL_TIMEOUT,
+            )
+        return options
+    return {
+        "pool_size": int(DB_POOL_SIZE or 10),
+        "max_overflow": int(DB_MAX_OVERFLOW or 20),
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "query_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "echo": DB_ECHO,
+    }
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+# --- Timed pools ---
+# Called with (pool metrics_name, seconds) after every pooled checkout, i.e.
+# how long the caller waited for a connection (metrics.py records it)
+pool_wait_hooks: List[Callable[[str, float], None]] = []
+
+class _TimedCheckout:
+    metrics_name = ""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            for hook in pool_wait_hooks:
+                hook(self.metrics_name, waited)
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    metrics_name = "sync"
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+def make_engine(url: str):
+    options = engine_options(url)
+    if "pool_size" in options:
+        options["poolclass"] = TimedQueuePool
+    engine = create_engine(url, **options)
+    if is_sqlite(url):
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+def async_url(url: str) -> str:
+    # Same database through its asyncio driver (aiosqlite / asyncpg)
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:") or url.startswith("postgresql+psycopg2:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+def make_async_engine(url: str):
+    options = engine_options(url)
+    if "pool_size" in options:
+        # aiosqlite defaults to NullPool; keep connections (and their PRAGMAs) around
+        options["poolclass"] = TimedAsyncAdaptedQueuePool
+    engine = create_async_engine(url, **options)
+    if is_sqlite(url):
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async path used by the hot request handlers; objects stay usable after commit
+ASYNC_DATABASE_URL = async_url(SQLALCHEMY_DATABASE_URL)
+async_engine = make_async_engine(ASYNC_DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -26,3 +136,39 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def upsert_insert(dialect: str):
+    # insert() with ON CONFLICT support for the given dialect name. Imported
+    # on use: loading the postgresql dialect package costs SQLite workers boot time.
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+# --- Statement counting ---
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+@contextmanager
+def count_queries(*engines):
+    # Counts statements sent through the given engines (default: both app engines)
+    engines = engines or (engine, async_engine.sync_engine)
+    counter = QueryCounter()
+    for e in engines:
+        event.listen(e, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        for e in engines:
+            event.remove(e, "before_cursor_execute", counter)
@@ -0,0 +1,433 @@
+import asyncio
+import logging
+import math
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import exists, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import geo
+import live_locations
+import models
+import realtime
+import transitions
+from database import upsert_insert
+
+logger = logging.getLogger(__name__)
+
+# Orders created without a driver_id are matched here: every cycle takes the
+# pending ones without an open offer, ranks the free drivers around each and
+# offers it to the best one for DISPATCH_OFFER_TIMEOUT seconds. A declined or
+# expired offer sends the order back to the next cycle, which skips every
+# driver it was already offered to.
+DISPATCH_OFFER_TIMEOUT = float(os.getenv("DISPATCH_OFFER_TIMEOUT", "30"))
+DISPATCH_INTERVAL = float(os.getenv("DISPATCH_INTERVAL", "1"))
+DISPATCH_RADIUS_KM = float(os.getenv("DISPATCH_RADIUS_KM", "30"))
+# An order is cancelled after this many offers, or this many seconds, without a taker
+DISPATCH_MAX_OFFERS = int(os.getenv("DISPATCH_MAX_OFFERS", "5"))
+DISPATCH_MAX_WAIT = float(os.getenv("DISPATCH_MAX_WAIT", "900"))
+# Pending orders matched per cycle, oldest first
+DISPATCH_BATCH = int(os.getenv("DISPATCH_BATCH", "5000"))
+# The search around an order stops widening once this many drivers are in range
+DISPATCH_CANDIDATES = 10
+# Straight-line ETA at this average truck speed
+DISPATCH_SPEED_KMH = float(os.getenv("DISPATCH_SPEED_KMH", "30"))
+
+# Ranking cost, lowest wins:
+#   ETA minutes * W_ETA + price * W_PRICE + spare capacity (m3) * W_CAPACITY - rating * W_RATING
+W_ETA = float(os.getenv("DISPATCH_W_ETA", "1"))
+W_PRICE = float(os.getenv("DISPATCH_W_PRICE", "0.1"))
+W_CAPACITY = float(os.getenv("DISPATCH_W_CAPACITY", "0.5"))
+W_RATING = float(os.getenv("DISPATCH_W_RATING", "2"))
+
+# Cell size of the in-memory candidate grid, in degrees (about 4.5km)
+GRID_DEG = 0.04
+# Candidates are read through the geohash index, over the cells around the
+# pending orders (merged down to at most this many ranges). The stored
+# geohash trails live positions by up to a location flush, so each search
+# circle is widened by DISPATCH_LAG_KM to not miss drivers that just drove in.
+DISPATCH_QUERY_CELLS = int(os.getenv("DISPATCH_QUERY_CELLS", "64"))
+DISPATCH_LAG_KM = float(os.getenv("DISPATCH_LAG_KM", "1"))
+# Orders are grouped by geohash cell of this precision (about 5 km) before
+# their search areas are computed, one box per group
+DISPATCH_GROUP_PRECISION = 5
+
+# A driver with an order in one of these is busy: a pending one with their
+# driver_id is a direct booking (see models.OPEN_ORDER_PREDICATE)
+BUSY_STATUSES = (models.OrderStatus.PENDING, models.OrderStatus.ACCEPTED, models.OrderStatus.EN_ROUTE)
+
+
+class Candidate(NamedTuple):
+    driver_id: int
+    lat: float
+    lng: float
+    capacity: int
+    price: float
+    rating: float
+
+
+class PendingOrder(NamedTuple):
+    id: int
+    customer_id: int
+    lat: float
+    lng: float
+    liters: int
+    created_at: datetime
+
+
+def cost(candidate: Candidate, distance_km: float, liters: int) -> float:
+    eta_min = distance_km / DISPATCH_SPEED_KMH * 60
+    spare_m3 = ((candidate.capacity or 0) - liters) / 1000
+    return eta_min * W_ETA + (candidate.price or 0) * W_PRICE + spare_m3 * W_CAPACITY - (candidate.rating or 0) * W_RATING
+
+
+def _cell(lat: float, lng: float) -> Tuple[int, int]:
+    return math.floor(lat / GRID_DEG), math.floor(lng / GRID_DEG)
+
+
+class Matcher:
+    # Grid over one cycle's free drivers, so a whole batch of orders is ranked
+    # against a single candidates query. Each driver is handed out at most once.
+
+    def __init__(self, candidates: Iterable[Candidate], radius_km: float = DISPATCH_RADIUS_KM, wanted: int = DISPATCH_CANDIDATES):
+        self.radius_km = radius_km
+        self.wanted = wanted
+        self._cells: Dict[Tuple[int, int], List[Candidate]] = {}
+        for c in candidates:
+            self._cells.setdefault(_cell(c.lat, c.lng), []).append(c)
+
+    def _cells_around(self, lat: float, lng: float, radius_km: float) -> Iterable[Tuple[int, int]]:
+        lat_lo, lat_hi, lng_lo, lng_hi = geo.bbox(lat, lng, radius_km)
+        (i_lo, j_lo), (i_hi, j_hi) = _cell(lat_lo, lng_lo), _cell(lat_hi, lng_hi)
+        if (i_hi - i_lo + 1) * (j_hi - j_lo + 1) > len(self._cells):
+            # Fewer occupied cells than the circle covers: just look at all of them
+            return list(self._cells)
+        return [(i, j) for i in range(i_lo, i_hi + 1) for j in range(j_lo, j_hi + 1)]
+
+    def take(self, order: PendingOrder, exclude: Set[int] = frozenset()) -> Optional[Tuple[Candidate, float]]:
+        # Best free driver for the order within radius_km, removed from the pool
+        radius = min(2.5, self.radius_km)
+        while self._cells:
+            ranked = []
+            for cell in self._cells_around(order.lat, order.lng, radius):
+                for c in self._cells.get(cell, ()):
+                    if c.driver_id in exclude or (c.capacity or 0) < order.liters:
+                        continue
+                    distance = geo.haversine_km(order.lat, order.lng, c.lat, c.lng)
+                    if distance <= radius:
+                        ranked.append((cost(c, distance, order.liters), distance, cell, c))
+            if ranked and (len(ranked) >= self.wanted or radius >= self.radius_km):
+                _, distance, cell, best = min(ranked, key=lambda r: r[0])
+                self._cells[cell].remove(best)
+                if not self._cells[cell]:
+                    del self._cells[cell]
+                return best, distance
+            if radius >= self.radius_km:
+                break
+            radius = min(radius * 2, self.radius_km)
+        return None
+
+
+# notify(user_id, title, body)
+Notifier = Callable[[int, str, str], None]
+
+
+class DispatchEngine:
+    # Runs one matching cycle every DISPATCH_INTERVAL, or right away after
+    # wake(). All state lives in orders / order_offers: the partial unique
+    # indexes on open offers keep two workers from offering the same order
+    # or driver twice, so the engine can run on every worker.
+
+    def __init__(
+        self,
+        offer_timeout: float = DISPATCH_OFFER_TIMEOUT,
+        interval: float = DISPATCH_INTERVAL,
+        radius_km: float = DISPATCH_RADIUS_KM,
+        max_offers: int = DISPATCH_MAX_OFFERS,
+        max_wait: float = DISPATCH_MAX_WAIT,
+        batch_size: int = DISPATCH_BATCH,
+        session_factory=None,
+        notify: Optional[Notifier] = None,
+        live=None,
+    ):
+        self.offer_timeout = offer_timeout
+        self.interval = interval
+        self.radius_km = radius_km
+        self.max_offers = max_offers
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.notify = notify
+        self.live = live if live is not None else live_locations.store
+        self.stats = Counter()
+        self._wake: Optional[asyncio.Event] = None
+
+    def wake(self):
+        # A new order or a declined offer: match without waiting for the next tick
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.run_cycle()
+            except Exception:
+                logger.exception("Dispatch cycle failed")
+
+    async def run_cycle(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.utcnow()
+        async with self._session() as db:
+            expired = await self._expire(db, now)
+            pending = await self._pending(db)
+            offered_before = await self._offered_before(db, [o.id for o in pending])
+            give_up = {
+                o.id for o in pending
+                if len(offered_before.get(o.id, ())) >= self.max_offers
+                or (now - o.created_at).total_seconds() >= self.max_wait
+            }
+            matches = []
+            if len(give_up) < len(pending):
+                matcher = Matcher(await self._candidates(db, [o for o in pending if o.id not in give_up]), self.radius_km)
+                for o in pending:
+                    if o.id in give_up:
+                        continue
+                    match = matcher.take(o, offered_before.get(o.id, set()))
+                    if match is not None:
+                        matches.append((o, *match))
+            offers = await self._offer(db, matches, now)
+            cancelled = await self._give_up(db, list(give_up))
+            await db.commit()
+
+        self.stats["expired"] += len(expired)
+        self.stats["offered"] += len(offers)
+        self.stats["unmatched"] += len(pending) - len(give_up) - len(matches)
+        self.stats["given_up"] += len(cancelled)
+        for order_id, driver_id in expired:
+            await realtime.publish(driver_id, "order.offer_expired", {"order_id": order_id})
+        for order, candidate, distance, offer_id in offers:
+            await self._announce(order, candidate, distance, offer_id, now)
+        for order_id, customer_id in cancelled:
+            await realtime.publish(customer_id, "order.status_changed", {"order_id": order_id, "status": models.OrderStatus.CANCELLED})
+            self._notify(customer_id, "لم يتم العثور على سائق", "لا يوجد سائق متاح لطلبك حالياً، يرجى المحاولة لاحقاً")
+        return len(offers)
+
+    # --- Internals ---
+    def _session(self):
+        if self.session_factory is None:
+            from database import AsyncSessionLocal
+            self.session_factory = AsyncSessionLocal
+        return self.session_factory()
+
+    def _notify(self, user_id: int, title: str, body: str):
+        notify = self.notify
+        if notify is None:
+            from routers.notifications import send_notification_to_user
+            notify = send_notification_to_user
+        try:
+            notify(user_id, title, body)
+        except Exception:
+            logger.exception("Dispatch notification to %s failed", user_id)
+
+    async def _expire(self, db: AsyncSession, now: datetime) -> List[Tuple[int, int]]:
+        offer = models.OrderOffer
+        rows = await db.execute(
+            update(offer)
+            .where(offer.status == models.OfferStatus.OFFERED, offer.expires_at <= now)
+            .values(status=models.OfferStatus.EXPIRED)
+            .returning(offer.order_id, offer.driver_id)
+        )
+        return [tuple(r) for r in rows]
+
+    async def _pending(self, db: AsyncSession) -> List[PendingOrder]:
+        order, offer = models.Order, models.OrderOffer
+        rows = await db.execute(
+            select(order.id, order.customer_id, order.delivery_lat, order.delivery_lng, order.liters, order.created_at)
+            .where(
+                order.status == models.OrderStatus.PENDING,
+                order.driver_id.is_(None),
+                order.liters.isnot(None),
+                ~exists().where(offer.order_id == order.id, offer.status == models.OfferStatus.OFFERED),
+            )
+            .order_by(order.created_at)
+            .limit(self.batch_size)
+        )
+        return [PendingOrder(*r) for r in rows]
+
+    async def _offered_before(self, db: AsyncSession, order_ids: List[int]) -> Dict[int, Set[int]]:
+        offered: Dict[int, Set[int]] = {}
+        if order_ids:
+            offer = models.OrderOffer
+            rows = await db.execute(select(offer.order_id, offer.driver_id).where(offer.order_id.in_(order_ids)))
+            for order_id, driver_id in rows:
+                offered.setdefault(order_id, set()).add(driver_id)
+        return offered
+
+    def _search_cells(self, orders: List[PendingOrder]) -> Optional[List[str]]:
+        # Geohash cells covering every order's search circle; None when one is
+        # too large to index (the query then isn't bounded spatially)
+        radius = self.radius_km + DISPATCH_LAG_KM
+        cells = set()
+        for group in {geo.encode(o.lat, o.lng, DISPATCH_GROUP_PRECISION) for o in orders}:
+            lat_lo, lat_hi, lng_lo, lng_hi = geo.decode_bounds(group)
+            # The group's cell widened by the radius: union of its corners' search boxes
+            boxes = [geo.bbox(lat, lng, radius) for lat in (lat_lo, lat_hi) for lng in (lng_lo, lng_hi)]
+            around = geo.cells_for_box(
+                min(b[0] for b in boxes), max(b[1] for b in boxes), min(b[2] for b in boxes), max(b[3] for b in boxes)
+            )
+            if not around:
+                return None
+            cells.update(around)
+        return geo.merge_cells(cells, DISPATCH_QUERY_CELLS)
+
+    async def _candidates(self, db: AsyncSession, orders: List[PendingOrder]) -> List[Candidate]:
+        # Available drivers near the orders with no active order and no open offer
+        profile, order, offer = models.DriverProfile, models.Order, models.OrderOffer
+        stmt = (
+            select(profile.user_id, profile.current_lat, profile.current_lng, profile.capacity, profile.price, profile.average_rating)
+            .where(
+                profile.is_available.is_(True),
+                ~exists().where(order.driver_id == profile.user_id, order.status.in_(BUSY_STATUSES)),
+                ~exists().where(offer.driver_id == profile.user_id, offer.status == models.OfferStatus.OFFERED),
+            )
+        )
+        cells = self._search_cells(orders)
+        if cells is not None:
+            # Drivers whose first position hasn't been flushed yet have no
+            # geohash; they're few, and their live fix places them below
+            stmt = stmt.where(or_(geo.geohash_filter(profile.geohash, cells), profile.geohash.is_(None)))
+        rows = (await db.execute(stmt)).all()
+        self.stats["candidates"] += len(rows)
+        fixes = self.live.get_many(r[0] for r in rows)
+        candidates = []
+        for driver_id, lat, lng, capacity, price, rating in rows:
+            fix = fixes.get(driver_id)
+            if fix is not None:
+                lat, lng = fix.lat, fix.lng
+            if lat is not None and lng is not None:
+                candidates.append(Candidate(driver_id, lat, lng, capacity, price, rating))
+        return candidates
+
+    async def _offer(self, db: AsyncSession, matches, now: datetime):
+        if not matches:
+            return []
+        table = models.OrderOffer.__table__
+        insert = upsert_insert(db.get_bind().dialect.name)
+        expires_at = now + timedelta(seconds=self.offer_timeout)
+        rows = [
+            {"order_id": o.id, "driver_id": c.driver_id, "status": models.OfferStatus.OFFERED,
+             "distance_km": round(d, 3), "created_at": now, "expires_at": expires_at}
+            for o, c, d in matches
+        ]
+        # Another worker may have offered the same order or driver meanwhile;
+        # the open-offer unique indexes make those rows no-ops
+        inserted = await db.execute(
+            insert(table).on_conflict_do_nothing().returning(table.c.id, table.c.order_id, table.c.driver_id), rows
+        )
+        ids = {(order_id, driver_id): offer_id for offer_id, order_id, driver_id in inserted}
+        return [(o, c, d, ids[(o.id, c.driver_id)]) for o, c, d in matches if (o.id, c.driver_id) in ids]
+
+    async def _give_up(self, db: AsyncSession, order_ids: List[int]) -> List[Tuple[int, int]]:
+        if not order_ids:
+            return []
+        order = models.Order
+        rows = await db.execute(
+            update(order)
+            .where(order.id.in_(order_ids), order.status == models.OrderStatus.PENDING, order.driver_id.is_(None))
+            .values(status=models.OrderStatus.CANCELLED, version=order.version + 1)
+            .returning(order.id, order.customer_id)
+        )
+        return [tuple(r) for r in rows]
+
+    async def _announce(self, order: PendingOrder, candidate: Candidate, distance: float, offer_id: int, now: datetime):
+        expires_at = now + timedelta(seconds=self.offer_timeout)
+        await realtime.publish(candidate.driver_id, "order.offer", {
+            "id": offer_id,
+            "order_id": order.id,
+            "liters": order.liters,
+            "distance_km": round(distance, 3),
+            "delivery_lat": order.lat,
+            "delivery_lng": order.lng,
+            "expires_at": expires_at.isoformat(),
+        })
+        self._notify(
+            candidate.driver_id,
+            "طلب جديد!",
+            f"طلب {order.liters} لتر على بعد {distance:.1f} كم، لديك {int(self.offer_timeout)} ثانية للقبول"
+        )
+
+
+engine = DispatchEngine()
+
+
+# --- Offer answers (called by the orders router inside its transaction) ---
+async def accept(db: AsyncSession, order_id: int, driver_id: int, now: Optional[datetime] = None) -> Optional[models.Order]:
+    # The order, now assigned to the driver, or None if the offer is no longer
+    # open (the caller should then roll back)
+    now = now or datetime.utcnow()
+    offer = models.OrderOffer
+    taken = await db.scalar(
+        update(offer)
+        .where(
+            offer.order_id == order_id,
+            offer.driver_id == driver_id,
+            offer.status == models.OfferStatus.OFFERED,
+            offer.expires_at > now,
+        )
+        .values(status=models.OfferStatus.ACCEPTED)
+        .returning(offer.id)
+    )
+    if taken is None:
+        return None
+    price = select(models.DriverProfile.price).where(models.DriverProfile.user_id == driver_id).scalar_subquery()
+    try:
+        version = await transitions.apply(
+            db, order_id, models.OrderStatus.PENDING, models.OrderStatus.ACCEPTED,
+            values={"driver_id": driver_id, "amount": func.coalesce(models.Order.amount, price)},
+            where=[models.Order.driver_id.is_(None)],
+        )
+    except IntegrityError:
+        # ix_orders_open_driver: the driver was booked directly since the offer
+        return None
+    if version is None:
+        return None
+    return await db.get(models.Order, order_id, populate_existing=True)
+
+
+async def decline(db: AsyncSession, order_id: int, driver_id: int) -> bool:
+    offer = models.OrderOffer
+    declined = await db.scalar(
+        update(offer)
+        .where(offer.order_id == order_id, offer.driver_id == driver_id, offer.status == models.OfferStatus.OFFERED)
+        .values(status=models.OfferStatus.DECLINED)
+        .returning(offer.id)
+    )
+    return declined is not None
+
+
+async def withdraw(db: AsyncSession, order_id: int):
+    # The order was cancelled or assigned; close its open offer, if any
+    offer = models.OrderOffer
+    await db.execute(
+        update(offer)
+        .where(offer.order_id == order_id, offer.status == models.OfferStatus.OFFERED)
+        .values(status=models.OfferStatus.CANCELLED)
+    )
+
+
+async def driver_is_busy(db: AsyncSession, driver_id: int) -> bool:
+    # Has an open order (booked, accepted or en route) or an open offer
+    order, offer = models.Order, models.OrderOffer
+    return bool(await db.scalar(select(
+        exists().where(order.driver_id == driver_id, order.status.in_(BUSY_STATUSES))
+        | exists().where(offer.driver_id == driver_id, offer.status == models.OfferStatus.OFFERED)
+    )))
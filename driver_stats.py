@@ -0,0 +1,110 @@
+from datetime import date, datetime, time, timedelta
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import upsert_insert
+
+# driver_daily_stats is maintained incrementally: one upsert when an order
+# completes and one when a driver goes offline. Reading today's numbers is a
+# primary-key lookup no matter how long the driver's history is.
+# Days are UTC dates.
+
+_table = models.DriverDailyStats.__table__
+
+
+def _upsert(dialect: str, rows: list, accumulate: bool = True):
+    # INSERT ... ON CONFLICT (driver_id, day) DO UPDATE, adding to (or replacing) the counters
+    insert = upsert_insert(dialect)
+    stmt = insert(_table).values(rows)
+    columns = ("orders_count", "earnings", "online_seconds") if accumulate else ("orders_count", "earnings")
+    return stmt.on_conflict_do_update(
+        index_elements=[_table.c.driver_id, _table.c.day],
+        set_={
+            c: (_table.c[c] + stmt.excluded[c]) if accumulate else stmt.excluded[c]
+            for c in columns
+        },
+    )
+
+
+def _dialect(db) -> str:
+    return db.get_bind().dialect.name
+
+
+def online_spans(start: datetime, end: datetime) -> Iterator[Tuple[date, float]]:
+    # Split [start, end) into (day, seconds) pieces at UTC midnight
+    while start < end:
+        midnight = datetime.combine(start.date() + timedelta(days=1), time.min)
+        piece_end = min(end, midnight)
+        yield start.date(), (piece_end - start).total_seconds()
+        start = piece_end
+
+
+async def record_completed_order(db: AsyncSession, driver_id: int, amount: Optional[float], at: datetime):
+    await db.execute(_upsert(_dialect(db), [{
+        "driver_id": driver_id, "day": at.date(), "orders_count": 1, "earnings": amount or 0.0, "online_seconds": 0.0,
+    }]))
+
+
+async def record_online(db: AsyncSession, driver_id: int, start: datetime, end: datetime):
+    rows = [
+        {"driver_id": driver_id, "day": day, "orders_count": 0, "earnings": 0.0, "online_seconds": seconds}
+        for day, seconds in online_spans(start, end)
+    ]
+    if rows:
+        await db.execute(_upsert(_dialect(db), rows))
+
+
+async def today(db: AsyncSession, profile: models.DriverProfile, now: Optional[datetime] = None) -> dict:
+    now = now or datetime.utcnow()
+    row = await db.get(models.DriverDailyStats, (profile.user_id, now.date()))
+    online_seconds = row.online_seconds if row else 0.0
+    if profile.online_since:
+        # Session still open: count the part of it that falls on today
+        online_seconds += max(0.0, (now - max(profile.online_since, datetime.combine(now.date(), time.min))).total_seconds())
+    return {
+        "orders_today": row.orders_count if row else 0,
+        "earnings_today": row.earnings if row else 0.0,
+        "total_rating": profile.average_rating,
+        "hours_online": round(online_seconds / 3600, 2),
+    }
+
+
+def completed_totals(start: Optional[datetime] = None, end: Optional[datetime] = None, driver_id: Optional[int] = None):
+    # COUNT / SUM of completed orders per (driver, day) over [start, end),
+    # served by the (driver_id, completed_at) index
+    day = func.date(models.Order.completed_at)
+    stmt = (
+        select(models.Order.driver_id, day, func.count(), func.coalesce(func.sum(models.Order.amount), 0.0))
+        .where(models.Order.status == models.OrderStatus.COMPLETED, models.Order.completed_at.isnot(None))
+        .group_by(models.Order.driver_id, day)
+    )
+    if driver_id is not None:
+        stmt = stmt.where(models.Order.driver_id == driver_id)
+    else:
+        stmt = stmt.where(models.Order.driver_id.isnot(None))
+    if start is not None:
+        stmt = stmt.where(models.Order.completed_at >= start)
+    if end is not None:
+        stmt = stmt.where(models.Order.completed_at < end)
+    return stmt
+
+
+def rebuild(conn, start: Optional[datetime] = None, end: Optional[datetime] = None, driver_id: Optional[int] = None) -> int:
+    # Recompute order counts and earnings from the orders table (online time
+    # has no other source and is left alone). Returns the rows written.
+    rows = [
+        {
+            "driver_id": d_id,
+            "day": day if isinstance(day, date) else date.fromisoformat(day),
+            "orders_count": count,
+            "earnings": earnings,
+            "online_seconds": 0.0,
+        }
+        for d_id, day, count, earnings in conn.execute(completed_totals(start, end, driver_id))
+    ]
+    for i in range(0, len(rows), 500):
+        conn.execute(_upsert(conn.dialect.name, rows[i:i + 500], accumulate=False))
+    return len(rows)
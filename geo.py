@@ -0,0 +1,253 @@
+from math import radians, cos, sin, asin, sqrt, floor
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+import models
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEG = 111.32
+
+# Precision stored in driver_profiles.geohash (~4.8m x 4.8m cells)
+GEOHASH_PRECISION = 9
+
+# Upper bound on the number of index range scans issued per search
+MAX_QUERY_CELLS = 32
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
+    dlng = lng2 - lng1
+    dlat = lat2 - lat1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlng / 2) ** 2
+    return 2 * asin(sqrt(a)) * EARTH_RADIUS_KM
+
+
+# --- Geohash ---
+def encode(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bit, ch, even = 0, 0, True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                ch |= 1 << (4 - bit)
+                lng_lo = mid
+            else:
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch |= 1 << (4 - bit)
+                lat_lo = mid
+            else:
+                lat_hi = mid
+        even = not even
+        if bit < 4:
+            bit += 1
+        else:
+            chars.append(_BASE32[ch])
+            bit, ch = 0, 0
+    return "".join(chars)
+
+
+def decode_bounds(geohash: str) -> Tuple[float, float, float, float]:
+    # Returns (lat_lo, lat_hi, lng_lo, lng_hi)
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    even = True
+    for c in geohash:
+        cd = _DECODE[c]
+        for mask in (16, 8, 4, 2, 1):
+            if even:
+                mid = (lng_lo + lng_hi) / 2
+                if cd & mask:
+                    lng_lo = mid
+                else:
+                    lng_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if cd & mask:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+    return lat_lo, lat_hi, lng_lo, lng_hi
+
+
+def cell_size_deg(precision: int) -> Tuple[float, float]:
+    # (height, width) of a cell in degrees
+    bits = precision * 5
+    lat_bits = bits // 2
+    lng_bits = bits - lat_bits
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def covering_cells(lat_lo: float, lat_hi: float, lng_lo: float, lng_hi: float, precision: int) -> List[str]:
+    # Every cell at `precision` that intersects the bounding box
+    h, w = cell_size_deg(precision)
+    lat_lo, lat_hi = max(lat_lo, -90.0), min(lat_hi, 90.0)
+    cells = []
+    i = floor((lat_lo + 90) / h)
+    while i * h - 90 <= lat_hi and i * h < 180:
+        cell_lat = i * h - 90 + h / 2
+        j = floor((lng_lo + 180) / w)
+        while j * w - 180 <= lng_hi:
+            cell_lng = (j * w + w / 2) % 360 - 180
+            cell = encode(cell_lat, cell_lng, precision)
+            if cell not in cells:
+                cells.append(cell)
+            j += 1
+        i += 1
+    return cells
+
+
+def bbox(lat: float, lng: float, radius_km: float) -> Tuple[float, float, float, float]:
+    dlat = radius_km / KM_PER_DEG
+    coslat = cos(radians(lat))
+    dlng = radius_km / (KM_PER_DEG * coslat) if coslat > 1e-9 else 360.0
+    return lat - dlat, lat + dlat, lng - min(dlng, 180.0), lng + min(dlng, 180.0)
+
+
+def _next_prefix(prefix: str) -> Optional[str]:
+    # Smallest string greater than every string starting with prefix
+    while prefix:
+        i = _DECODE[prefix[-1]]
+        if i + 1 < len(_BASE32):
+            return prefix[:-1] + _BASE32[i + 1]
+        prefix = prefix[:-1]
+    return None
+
+
+def cells_for_radius(lat: float, lng: float, radius_km: float) -> List[str]:
+    # Finest set of at most MAX_QUERY_CELLS cells covering the search circle.
+    # An empty list means the circle is too large to be worth indexing.
+    return cells_for_box(*bbox(lat, lng, radius_km))
+
+
+def cells_for_box(lat_lo: float, lat_hi: float, lng_lo: float, lng_hi: float) -> List[str]:
+    # Same, for a box
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        h, w = cell_size_deg(precision)
+        if ((lat_hi - lat_lo) / h + 2) * ((lng_hi - lng_lo) / w + 2) > MAX_QUERY_CELLS * 2:
+            continue
+        cells = covering_cells(lat_lo, lat_hi, lng_lo, lng_hi, precision)
+        if len(cells) <= MAX_QUERY_CELLS:
+            return cells
+    return []
+
+
+def merge_cells(cells: Iterable[str], limit: int = MAX_QUERY_CELLS) -> List[str]:
+    # Union of several searches' cells, coarsened (cells cut to shorter
+    # prefixes) until at most `limit` remain, without cells a shorter one covers
+    cells = set(cells)
+    precision = max(map(len, cells), default=0)
+    while len(cells) > limit and precision > 1:
+        precision -= 1
+        cells = {c[:precision] for c in cells}
+    merged: List[str] = []
+    for cell in sorted(cells):
+        # Sorted, a prefix comes right before the cells it covers
+        if not merged or not cell.startswith(merged[-1]):
+            merged.append(cell)
+    return merged
+
+
+def geohash_filter(column, cells: List[str]):
+    # Prefix match expressed as plain range scans so the B-tree index is used
+    # on both SQLite and Postgres regardless of collation / LIKE support.
+    clauses = []
+    for cell in cells:
+        upper = _next_prefix(cell)
+        if upper is None:
+            clauses.append(column >= cell)
+        else:
+            clauses.append(and_(column >= cell, column < upper))
+    return or_(*clauses)
+
+
+# --- Queries ---
+async def nearby_profiles(
+    db: AsyncSession,
+    lat: float,
+    lng: float,
+    radius_km: float,
+    limit: int,
+    available_only: bool = False,
+    live=None,
+) -> List[Tuple["models.DriverProfile", float]]:
+    # Returns [(profile, distance_km)] sorted by distance.
+    # Searches growing rings so dense areas stop as soon as `limit` drivers
+    # are found and the rows scanned stay bounded by local density, not fleet size.
+    # `live` is an optional live_locations store whose fixes win over the
+    # (periodically flushed) columns.
+    radius = radius_km / 16
+    while True:
+        radius = min(radius * 2, radius_km)
+        # Narrow on light (user_id, lat, lng) rows first, load full profiles only for the winners
+        stmt = select(
+            models.DriverProfile.user_id, models.DriverProfile.current_lat, models.DriverProfile.current_lng
+        )
+        cells = cells_for_radius(lat, lng, radius)
+        if cells:
+            stmt = stmt.where(geohash_filter(models.DriverProfile.geohash, cells))
+        else:
+            stmt = stmt.where(models.DriverProfile.geohash.isnot(None))
+        if available_only:
+            stmt = stmt.where(models.DriverProfile.is_available.is_(True))
+        rows = (await db.execute(stmt)).all()
+
+        fixes = {}
+        hits = {}
+        if live is not None:
+            fixes = live.get_many([row[0] for row in rows])
+            found = live.nearby(lat, lng, radius)
+            # Live hits the query above didn't return (their stored position is
+            # elsewhere) haven't passed its availability filter yet; they must
+            # before they count toward `limit`
+            queried = {row[0] for row in rows}
+            unchecked = [user_id for user_id, _, _ in found if user_id not in queried]
+            excluded = set()
+            if available_only and unchecked:
+                excluded = set(unchecked) - set(await db.scalars(
+                    select(models.DriverProfile.user_id).where(
+                        models.DriverProfile.user_id.in_(unchecked), models.DriverProfile.is_available.is_(True)
+                    )
+                ))
+            for user_id, fix, distance in found:
+                if user_id not in excluded:
+                    fixes[user_id] = fix
+                    hits[user_id] = distance
+        for user_id, d_lat, d_lng in rows:
+            if user_id in fixes:
+                continue
+            distance = haversine_km(lat, lng, d_lat, d_lng)
+            if distance <= radius:
+                hits[user_id] = distance
+        if len(hits) >= limit or radius >= radius_km:
+            break
+
+    if not hits:
+        return []
+    stmt = (
+        select(models.DriverProfile)
+        .options(joinedload(models.DriverProfile.user))
+        .where(models.DriverProfile.user_id.in_(list(hits)))
+    )
+    if available_only:
+        stmt = stmt.where(models.DriverProfile.is_available.is_(True))
+    results = []
+    for profile in (await db.scalars(stmt)).unique():
+        fix = fixes.get(profile.user_id)
+        if fix is not None:
+            profile.current_lat, profile.current_lng = fix.lat, fix.lng
+        results.append((profile, hits[profile.user_id]))
+    results.sort(key=lambda r: r[1])
+    return results[:limit]
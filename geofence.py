@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import math
+import os
+from collections import Counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select, update
+
+import models
+import realtime
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Fence radii around the delivery point of an en-route order
+GEOFENCE_APPROACH_METERS = float(os.getenv("GEOFENCE_APPROACH_METERS", "2000"))
+GEOFENCE_ARRIVE_METERS = float(os.getenv("GEOFENCE_ARRIVE_METERS", "500"))
+# A fence is only left beyond radius * (1 + GEOFENCE_HYSTERESIS), so GPS noise
+# at the edge does not flap between enter and exit
+GEOFENCE_HYSTERESIS = float(os.getenv("GEOFENCE_HYSTERESIS", "0.2"))
+# Seconds between batch evaluations of the positions received meanwhile
+GEOFENCE_INTERVAL = float(os.getenv("GEOFENCE_INTERVAL", "1"))
+# How long a driver without an en-route order is remembered as such, and how
+# long a loaded target is trusted before it is read again (its order may have
+# changed status on another worker)
+GEOFENCE_MISS_TTL = 30
+GEOFENCE_TARGET_TTL = 300
+
+EARTH_RADIUS_M = 6371000.0
+# Drivers per target lookup query
+LOAD_CHUNK = 500
+
+
+class Fence(NamedTuple):
+    name: str
+    radius_m: float
+    # Order column set once the fence has fired; each fence notifies once per order
+    flag: str
+    # (recipient, title, body) with recipient "customer" or "driver"
+    alerts: Tuple[Tuple[str, str, str], ...]
+
+
+FENCES = (
+    Fence("approaching", GEOFENCE_APPROACH_METERS, "approach_notified", (
+        ("customer", "السائق في الطريق", "الشاحنة على بعد أقل من %d متر منك" % GEOFENCE_APPROACH_METERS),
+    )),
+    Fence("arrived", GEOFENCE_ARRIVE_METERS, "arrival_notified", (
+        ("driver", "اقتربت من الوجهة", "أنت على بعد أقل من %d متر من العميل" % GEOFENCE_ARRIVE_METERS),
+        ("customer", "وصل السائق", "الشاحنة على بعد أقل من %d متر منك" % GEOFENCE_ARRIVE_METERS),
+    )),
+)
+
+
+class Target:
+    # Delivery point of a driver's en-route order and where the driver stands
+    # relative to each fence
+    __slots__ = ("order_id", "driver_id", "customer_id", "lat", "lng", "cos_lat", "inside", "fired")
+
+    def __init__(self, order_id, driver_id, customer_id, lat, lng, fired):
+        self.order_id = order_id
+        self.driver_id = driver_id
+        self.customer_id = customer_id
+        self.lat = lat
+        self.lng = lng
+        self.cos_lat = math.cos(math.radians(lat))
+        # A fence that already fired counts as entered, so it cannot fire again
+        self.inside = list(fired)
+        self.fired = list(fired)
+
+
+class Transition(NamedTuple):
+    target: Target
+    fence: int
+    entered: bool
+
+
+# notify(user_id, title, body)
+Notifier = Callable[[int, str, str], None]
+
+
+class GeofenceEngine:
+    # Drivers' positions are submitted per ping and evaluated together every
+    # GEOFENCE_INTERVAL against the delivery points of their en-route orders,
+    # which are loaded on first sight and kept in memory until the order's
+    # status changes (or GEOFENCE_TARGET_TTL). The first entry into a fence
+    # persists its flag with a conditional UPDATE and sends the alerts; only
+    # the worker whose UPDATE matched sends them, so each fires once per order.
+
+    def __init__(
+        self,
+        fences: Tuple[Fence, ...] = FENCES,
+        hysteresis: float = GEOFENCE_HYSTERESIS,
+        interval: float = GEOFENCE_INTERVAL,
+        session_factory=None,
+        notify: Optional[Notifier] = None,
+    ):
+        self.fences = fences
+        self.enter_m = [f.radius_m for f in fences]
+        self.exit_m = [f.radius_m * (1 + hysteresis) for f in fences]
+        self.interval = interval
+        self.session_factory = session_factory
+        self.notify = notify
+        self.stats = Counter()
+        self._targets = TTLCache(maxsize=200000, ttl=GEOFENCE_TARGET_TTL)
+        self._misses = TTLCache(maxsize=100000, ttl=GEOFENCE_MISS_TTL)
+        self._pending: Dict[int, Tuple[float, float]] = {}
+
+    def submit(self, driver_id: int, lat: float, lng: float):
+        # Latest position per driver wins until the next evaluation
+        self._pending[driver_id] = (lat, lng)
+
+    def forget(self, driver_id: int):
+        # The driver's order changed status; reload it on the next position
+        self._targets.pop(driver_id)
+        self._misses.pop(driver_id)
+
+    def evaluate(self, positions: Dict[int, Tuple[float, float]]) -> List[Transition]:
+        # Pure and in-memory: every (driver, fence) pair in one pass over flat
+        # lists. Equirectangular distance is within 0.1% of haversine at fence scale.
+        get = self._targets.get
+        batch, coords = [], []
+        for driver_id, position in positions.items():
+            t = get(driver_id)
+            if t is not None:
+                batch.append(t)
+                coords.append(position)
+        if not batch:
+            return []
+        rad = math.pi / 180 * EARTH_RADIUS_M
+        hypot = math.hypot
+        distances = [rad * hypot(lat - t.lat, (lng - t.lng) * t.cos_lat) for t, (lat, lng) in zip(batch, coords)]
+        transitions = []
+        for k in range(len(self.fences)):
+            enter_m, exit_m = self.enter_m[k], self.exit_m[k]
+            for t, d in zip(batch, distances):
+                if t.inside[k]:
+                    if d > exit_m:
+                        t.inside[k] = False
+                        transitions.append(Transition(t, k, False))
+                elif d <= enter_m:
+                    t.inside[k] = True
+                    transitions.append(Transition(t, k, True))
+        return transitions
+
+    async def run_batch(self) -> int:
+        positions, self._pending = self._pending, {}
+        if not positions:
+            return 0
+        async with self._session() as db:
+            await self._load_targets(db, [d for d in positions if d not in self._targets and d not in self._misses])
+            transitions = self.evaluate(positions)
+            fired = await self._persist(db, [tr for tr in transitions if tr.entered and not tr.target.fired[tr.fence]])
+        self.stats["evaluated"] += len(positions)
+        for tr in transitions:
+            await realtime.publish(tr.target.customer_id, "order.geofence", {
+                "order_id": tr.target.order_id,
+                "fence": self.fences[tr.fence].name,
+                "state": "enter" if tr.entered else "exit",
+            })
+        for tr in fired:
+            self._alert(tr)
+        return len(transitions)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_batch()
+            except Exception:
+                logger.exception("Geofence evaluation failed")
+
+    # --- Internals ---
+    def _session(self):
+        if self.session_factory is None:
+            from database import AsyncSessionLocal
+            self.session_factory = AsyncSessionLocal
+        return self.session_factory()
+
+    async def _load_targets(self, db, driver_ids: List[int]):
+        order = models.Order
+        flags = [getattr(order, f.flag) for f in self.fences]
+        for i in range(0, len(driver_ids), LOAD_CHUNK):
+            chunk = driver_ids[i:i + LOAD_CHUNK]
+            rows = await db.execute(
+                select(order.id, order.driver_id, order.customer_id, order.delivery_lat, order.delivery_lng, *flags)
+                .where(
+                    order.driver_id.in_(chunk),
+                    order.status == models.OrderStatus.EN_ROUTE,
+                    order.delivery_lat.isnot(None),
+                    order.delivery_lng.isnot(None),
+                )
+            )
+            found = set()
+            for order_id, driver_id, customer_id, lat, lng, *fired in rows:
+                self._targets.set(driver_id, Target(order_id, driver_id, customer_id, lat, lng, [bool(f) for f in fired]))
+                found.add(driver_id)
+            for driver_id in chunk:
+                if driver_id not in found:
+                    self._misses.set(driver_id, True)
+            self.stats["loaded"] += len(found)
+
+    async def _persist(self, db, entered: List[Transition]) -> List[Transition]:
+        # Set each fence's flag for the orders that just entered it; the
+        # UPDATE only returns orders that were not flagged yet (by any worker)
+        fired = []
+        for k, fence in enumerate(self.fences):
+            by_order = {tr.target.order_id: tr for tr in entered if tr.fence == k}
+            if not by_order:
+                continue
+            flag = getattr(models.Order, fence.flag)
+            won = set(await db.scalars(
+                update(models.Order)
+                .where(models.Order.id.in_(by_order), flag.is_(False), models.Order.status == models.OrderStatus.EN_ROUTE)
+                .values({fence.flag: True})
+                .returning(models.Order.id)
+            ))
+            for order_id, tr in by_order.items():
+                tr.target.fired[k] = True
+                if order_id in won:
+                    fired.append(tr)
+        if entered:
+            await db.commit()
+        self.stats["fired"] += len(fired)
+        return fired
+
+    def _alert(self, tr: Transition):
+        notify = self.notify
+        if notify is None:
+            from routers.notifications import send_notification_to_user
+            notify = send_notification_to_user
+        for recipient, title, body in self.fences[tr.fence].alerts:
+            user_id = tr.target.customer_id if recipient == "customer" else tr.target.driver_id
+            try:
+                notify(user_id, title, body)
+            except Exception:
+                logger.exception("Geofence alert for order %s failed", tr.target.order_id)
+
+
+engine = GeofenceEngine()
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+import security
+
+logger = logging.getLogger(__name__)
+
+# Password hashing runs in its own small process pool instead of the request
+# threadpool: a burst of logins then costs at most HASH_WORKERS cores and
+# can't starve the other sync endpoints. At most HASH_QUEUE_LIMIT hashes may
+# be in flight (running or queued); beyond that requests are shed at once
+# with Busy (503) rather than queueing behind work they would time out on.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", str(HASH_WORKERS * 8)))
+# Retry-After suggested to shed clients
+HASH_RETRY_AFTER = int(os.getenv("HASH_RETRY_AFTER", "2"))
+
+
+class Busy(Exception):
+    pass
+
+
+class HashingPool:
+    def __init__(self, workers: int = HASH_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self.stats = Counter()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._executor is None:
+            # spawn: the workers don't inherit the app's threads, sockets or DB connections
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.queue_limit:
+            self.stats["shed"] += 1
+            raise Busy()
+        self.start()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        except BrokenProcessPool:
+            # A worker died; the next call starts a fresh pool
+            logger.exception("Hashing pool broke")
+            self._executor = None
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(security.get_password_hash, password)
+        self.stats["hashed"] += 1
+        return hashed
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        # (valid, replacement hash when the stored one is outdated)
+        valid, new_hash = await self._run(security.verify_and_update, password, hashed)
+        self.stats["verified" if valid else "rejected"] += 1
+        if new_hash:
+            self.stats["rehashed"] += 1
+        return valid, new_hash
+
+
+pool = HashingPool()
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Hashable, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from broker import broker
+from cache import TTLCache
+
+# Read-heavy GETs keep their serialized bodies in a short-TTL cache, keyed on
+# the (quantized) parameters, and every response carries a strong ETag; a
+# matching If-None-Match gets an empty 304. Entries belong to a tag ("nearby",
+# "reviews:<driver>", "profile:<user>"): invalidate(tag) bumps the tag's
+# generation, which makes every key built under it unreachable at once, here
+# and (through the broker) in the other workers. The TTLs bound what no write
+# invalidates, e.g. drivers moving.
+#
+# Bodies of GZIP_MIN_SIZE bytes or more leave through GZipMiddleware
+# compressed for clients that accept gzip, so the gzip variant gets its own
+# ETag ("<hash>-gzip") and every variant carries Vary: Accept-Encoding.
+HTTP_CACHE_SIZE = int(os.getenv("HTTP_CACHE_SIZE", "10000"))
+NEARBY_CACHE_TTL = float(os.getenv("NEARBY_CACHE_TTL", "5"))
+# Geohash characters a nearby search is rounded to (7 ~ 150 m cells)
+NEARBY_CACHE_PRECISION = int(os.getenv("NEARBY_CACHE_PRECISION", "7"))
+REVIEWS_CACHE_TTL = float(os.getenv("REVIEWS_CACHE_TTL", "60"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "30"))
+INVALIDATE_CHANNEL = "cache.invalidate"
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+
+entries = TTLCache(maxsize=HTTP_CACHE_SIZE, ttl=NEARBY_CACHE_TTL)
+_generations: Dict[str, int] = {}
+_lock = threading.Lock()
+# Loop that owns the broker, for invalidating from sync handlers
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_pending: set = set()
+
+
+def key(tag: str, *parts: Hashable) -> tuple:
+    return (tag, _generations.get(tag, 0)) + parts
+
+
+def _bump(tag: str):
+    with _lock:
+        _generations[tag] = _generations.get(tag, 0) + 1
+
+
+def _on_invalidate(channel: str, message: str):
+    _bump(message)
+
+
+def invalidate(*tags: str):
+    # Callable from any thread; other workers catch up when the broker delivers
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    for tag in tags:
+        _bump(tag)
+        if loop is not None:
+            task = loop.create_task(broker.publish(INVALIDATE_CHANNEL, tag))
+            _pending.add(task)
+            task.add_done_callback(_pending.discard)
+        elif _loop is not None and _loop.is_running():
+            asyncio.run_coroutine_threadsafe(broker.publish(INVALIDATE_CHANNEL, tag), _loop)
+
+
+async def listen():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    await broker.subscribe(INVALIDATE_CHANNEL, _on_invalidate)
+
+
+def encode(content: Any) -> bytes:
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(header: str, tag: str) -> bool:
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
+
+
+def respond(request: Request, body: bytes, cache_control: str, tag: Optional[str] = None) -> Response:
+    tag = tag or etag(body)
+    headers = {"Cache-Control": cache_control}
+    compressible = len(body) >= GZIP_MIN_SIZE
+    # Same test GZipMiddleware makes before compressing
+    gzipped = compressible and "gzip" in request.headers.get("accept-encoding", "")
+    if gzipped:
+        tag = tag[:-1] + '-gzip"'
+    headers["ETag"] = tag
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, tag):
+        if compressible:
+            headers["Vary"] = "Accept-Encoding"
+        return Response(status_code=304, headers=headers)
+    if compressible and not gzipped:
+        # (the middleware adds it to the responses it compresses)
+        headers["Vary"] = "Accept-Encoding"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def cached(request: Request, cache_key: tuple, cache_control: str) -> Optional[Response]:
+    # Response for a cached body, or None on a miss
+    entry = entries.get(cache_key)
+    return None if entry is None else respond(request, entry[0], cache_control, entry[1])
+
+
+def store(request: Request, cache_key: tuple, content: Any, cache_control: str, ttl: float) -> Response:
+    body = encode(content)
+    tag = etag(body)
+    entries.set(cache_key, (body, tag), ttl=ttl)
+    return respond(request, body, cache_control, tag)
@@ -0,0 +1,369 @@
+import asyncio
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import bindparam, update
+
+import geo
+import models
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Seconds between batched writes of live positions to driver_profiles
+FLUSH_INTERVAL = float(os.getenv("LOCATION_FLUSH_INTERVAL", "10"))
+
+# Geohash precision of the in-store buckets (~4.9km x 4.9km)
+BUCKET_PRECISION = 5
+# Above this many buckets a search just scans every driver
+MAX_BUCKETS = 256
+
+# Ping admission (LocationIngest). Pings closer together than
+# LOCATION_MIN_INTERVAL seconds are rejected with 429; pings within
+# LOCATION_MIN_METERS of the stored fix are coalesced into it unless it is
+# older than LOCATION_MAX_SILENCE seconds.
+LOCATION_MIN_INTERVAL = float(os.getenv("LOCATION_MIN_INTERVAL", "1"))
+LOCATION_MIN_METERS = float(os.getenv("LOCATION_MIN_METERS", "10"))
+LOCATION_MAX_SILENCE = float(os.getenv("LOCATION_MAX_SILENCE", "30"))
+# Ping interval suggested to clients
+LOCATION_PING_INTERVAL = float(os.getenv("LOCATION_PING_INTERVAL", "5"))
+
+
+class LocationFix(NamedTuple):
+    lat: float
+    lng: float
+    ts: datetime
+
+
+class LocationStore(ABC):
+    # Latest GPS fix per driver (keyed by the driver's user id)
+
+    @abstractmethod
+    def set(self, driver_id: int, lat: float, lng: float, ts: Optional[datetime] = None) -> None:
+        ...
+
+    def get(self, driver_id: int) -> Optional[LocationFix]:
+        return self.get_many([driver_id]).get(driver_id)
+
+    @abstractmethod
+    def get_many(self, driver_ids: Iterable[int]) -> Dict[int, LocationFix]:
+        ...
+
+    @abstractmethod
+    def nearby(self, lat: float, lng: float, radius_km: float) -> List[Tuple[int, LocationFix, float]]:
+        # [(driver_id, fix, distance_km)] within radius_km, unsorted
+        ...
+
+    @abstractmethod
+    def drain_dirty(self) -> Dict[int, LocationFix]:
+        # Fixes changed since the last drain; they are no longer dirty afterwards
+        ...
+
+    @abstractmethod
+    def mark_dirty(self, driver_ids: Iterable[int]) -> None:
+        ...
+
+
+def _query_buckets(lat: float, lng: float, radius_km: float) -> Optional[List[str]]:
+    lat_lo, lat_hi, lng_lo, lng_hi = geo.bbox(lat, lng, radius_km)
+    h, w = geo.cell_size_deg(BUCKET_PRECISION)
+    if ((lat_hi - lat_lo) / h + 2) * ((lng_hi - lng_lo) / w + 2) > MAX_BUCKETS:
+        return None
+    return geo.covering_cells(lat_lo, lat_hi, lng_lo, lng_hi, BUCKET_PRECISION)
+
+
+class InMemoryLocationStore(LocationStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fixes: Dict[int, LocationFix] = {}
+        self._bucket_of: Dict[int, str] = {}
+        self._buckets: Dict[str, set] = {}
+        self._dirty: set = set()
+
+    def set(self, driver_id, lat, lng, ts=None):
+        fix = LocationFix(lat, lng, ts or datetime.utcnow())
+        bucket = geo.encode(lat, lng, BUCKET_PRECISION)
+        with self._lock:
+            old = self._bucket_of.get(driver_id)
+            if old != bucket:
+                if old is not None:
+                    self._buckets[old].discard(driver_id)
+                    if not self._buckets[old]:
+                        del self._buckets[old]
+                self._buckets.setdefault(bucket, set()).add(driver_id)
+                self._bucket_of[driver_id] = bucket
+            self._fixes[driver_id] = fix
+            self._dirty.add(driver_id)
+
+    def get_many(self, driver_ids):
+        fixes = self._fixes
+        return {i: fixes[i] for i in driver_ids if i in fixes}
+
+    def nearby(self, lat, lng, radius_km):
+        buckets = _query_buckets(lat, lng, radius_km)
+        with self._lock:
+            if buckets is None:
+                candidates = list(self._fixes.items())
+            else:
+                candidates = [
+                    (i, self._fixes[i]) for b in buckets for i in self._buckets.get(b, ())
+                ]
+        results = []
+        for driver_id, fix in candidates:
+            distance = geo.haversine_km(lat, lng, fix.lat, fix.lng)
+            if distance <= radius_km:
+                results.append((driver_id, fix, distance))
+        return results
+
+    def drain_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return {i: self._fixes[i] for i in dirty}
+
+    def mark_dirty(self, driver_ids):
+        with self._lock:
+            self._dirty.update(i for i in driver_ids if i in self._fixes)
+
+
+class RedisLocationStore(LocationStore):
+    # Shared across worker processes. Only needs hset/hmget/hgetall, sadd/srem,
+    # sunion and spop, so FakeRedis (or any compatible client) can stand in.
+
+    def __init__(self, client, prefix: str = "boti:loc"):
+        self.client = client
+        self.fixes_key = f"{prefix}:fixes"
+        self.dirty_key = f"{prefix}:dirty"
+        self.bucket_prefix = f"{prefix}:cell:"
+
+    @staticmethod
+    def _dump(fix: LocationFix) -> str:
+        return f"{fix.lat},{fix.lng},{fix.ts.isoformat()}"
+
+    @staticmethod
+    def _load(raw) -> LocationFix:
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        lat, lng, ts = raw.split(",")
+        return LocationFix(float(lat), float(lng), datetime.fromisoformat(ts))
+
+    def set(self, driver_id, lat, lng, ts=None):
+        fix = LocationFix(lat, lng, ts or datetime.utcnow())
+        old = self.client.hget(self.fixes_key, driver_id)
+        bucket = geo.encode(lat, lng, BUCKET_PRECISION)
+        if old is not None:
+            old_fix = self._load(old)
+            old_bucket = geo.encode(old_fix.lat, old_fix.lng, BUCKET_PRECISION)
+            if old_bucket != bucket:
+                self.client.srem(self.bucket_prefix + old_bucket, driver_id)
+        self.client.sadd(self.bucket_prefix + bucket, driver_id)
+        self.client.hset(self.fixes_key, driver_id, self._dump(fix))
+        self.client.sadd(self.dirty_key, driver_id)
+
+    def get_many(self, driver_ids):
+        driver_ids = list(driver_ids)
+        if not driver_ids:
+            return {}
+        raws = self.client.hmget(self.fixes_key, driver_ids)
+        return {i: self._load(raw) for i, raw in zip(driver_ids, raws) if raw is not None}
+
+    def nearby(self, lat, lng, radius_km):
+        buckets = _query_buckets(lat, lng, radius_km)
+        if buckets is None:
+            fixes = {int(k): self._load(v) for k, v in self.client.hgetall(self.fixes_key).items()}
+        else:
+            members = self.client.sunion([self.bucket_prefix + b for b in buckets])
+            fixes = self.get_many(int(m) for m in members)
+        results = []
+        for driver_id, fix in fixes.items():
+            distance = geo.haversine_km(lat, lng, fix.lat, fix.lng)
+            if distance <= radius_km:
+                results.append((driver_id, fix, distance))
+        return results
+
+    def drain_dirty(self, batch: int = 10000):
+        ids = []
+        while True:
+            popped = self.client.spop(self.dirty_key, batch) or []
+            ids.extend(popped)
+            if len(popped) < batch:
+                break
+        return self.get_many(int(i) for i in ids)
+
+    def mark_dirty(self, driver_ids):
+        driver_ids = list(driver_ids)
+        if driver_ids:
+            self.client.sadd(self.dirty_key, *driver_ids)
+
+
+class FakeRedis:
+    # Minimal in-process stand-in for the redis-py commands used above
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, object] = {}
+
+    @staticmethod
+    def _s(value) -> str:
+        return value if isinstance(value, str) else str(value)
+
+    def hset(self, key, field, value):
+        with self._lock:
+            self._data.setdefault(key, {})[self._s(field)] = self._s(value)
+
+    def hget(self, key, field):
+        return self._data.get(key, {}).get(self._s(field))
+
+    def hmget(self, key, fields):
+        h = self._data.get(key, {})
+        return [h.get(self._s(f)) for f in fields]
+
+    def hgetall(self, key):
+        return dict(self._data.get(key, {}))
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._data.setdefault(key, set()).update(self._s(m) for m in members)
+
+    def srem(self, key, *members):
+        with self._lock:
+            self._data.get(key, set()).difference_update(self._s(m) for m in members)
+
+    def sunion(self, keys):
+        result = set()
+        for key in keys:
+            result |= self._data.get(key, set())
+        return result
+
+    def spop(self, key, count=None):
+        with self._lock:
+            members = self._data.get(key, set())
+            popped = [members.pop() for _ in range(min(count or 1, len(members)))]
+        return popped if count is not None else (popped[0] if popped else None)
+
+
+# --- Ingest ---
+ACCEPTED = "accepted"
+COALESCED = "coalesced"
+REJECTED = "rejected"
+
+
+class IngestResult(NamedTuple):
+    outcome: str
+    # Seconds the client should wait before its next ping
+    retry_after: float
+
+
+class LocationIngest:
+    # Admission in front of the store: only pings that moved the driver (or
+    # refresh a stale fix) are written and trigger the follow-up work in the
+    # handler. The last-ping times are per worker, so with several workers a
+    # client can get slightly more than one ping per interval through.
+
+    def __init__(
+        self,
+        store: LocationStore,
+        min_interval: float = LOCATION_MIN_INTERVAL,
+        min_meters: float = LOCATION_MIN_METERS,
+        max_silence: float = LOCATION_MAX_SILENCE,
+        ping_interval: float = LOCATION_PING_INTERVAL,
+    ):
+        self.store = store
+        self.min_interval = min_interval
+        self.min_km = min_meters / 1000
+        self.max_silence = max_silence
+        self.ping_interval = ping_interval
+        self.stats = Counter()
+        self._last_ping = TTLCache(maxsize=100000, ttl=max(min_interval, 1.0))
+
+    def offer(self, driver_id: int, lat: float, lng: float, ts: Optional[datetime] = None) -> IngestResult:
+        ts = ts or datetime.utcnow()
+        last = self._last_ping.get(driver_id)
+        if last is not None:
+            elapsed = (ts - last).total_seconds()
+            if elapsed < self.min_interval:
+                self.stats[REJECTED] += 1
+                return IngestResult(REJECTED, self.min_interval - elapsed)
+        self._last_ping.set(driver_id, ts)
+
+        fix = self.store.get(driver_id)
+        if (
+            fix is not None
+            and ts - fix.ts < timedelta(seconds=self.max_silence)
+            and geo.haversine_km(fix.lat, fix.lng, lat, lng) < self.min_km
+        ):
+            self.stats[COALESCED] += 1
+            return IngestResult(COALESCED, self.ping_interval)
+
+        self.store.set(driver_id, lat, lng, ts)
+        self.stats[ACCEPTED] += 1
+        return IngestResult(ACCEPTED, self.ping_interval)
+
+
+def create_store(url: Optional[str] = None) -> LocationStore:
+    # LOCATION_STORE_URL: unset -> in-process, memory:// -> FakeRedis, redis://... -> Redis
+    url = url if url is not None else os.getenv("LOCATION_STORE_URL", "")
+    if not url:
+        return InMemoryLocationStore()
+    if url.startswith("memory://"):
+        return RedisLocationStore(FakeRedis())
+    import redis
+    return RedisLocationStore(redis.Redis.from_url(url, decode_responses=True))
+
+
+store = create_store()
+ingest = LocationIngest(store)
+
+
+# --- Persistence ---
+def flush(db) -> int:
+    # Write every dirty fix to driver_profiles in one executemany UPDATE
+    fixes = store.drain_dirty()
+    if not fixes:
+        return 0
+    table = models.DriverProfile.__table__
+    stmt = (
+        update(table)
+        .where(table.c.user_id == bindparam("b_user_id"))
+        .values(
+            current_lat=bindparam("b_lat"),
+            current_lng=bindparam("b_lng"),
+            geohash=bindparam("b_geohash"),
+            last_location_update=bindparam("b_ts"),
+        )
+    )
+    rows = [
+        {"b_user_id": i, "b_lat": f.lat, "b_lng": f.lng, "b_geohash": geo.encode(f.lat, f.lng), "b_ts": f.ts}
+        for i, f in fixes.items()
+    ]
+    try:
+        db.connection().execute(stmt, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        store.mark_dirty(fixes.keys())
+        raise
+    return len(rows)
+
+
+def flush_now() -> int:
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        return flush(db)
+    finally:
+        db.close()
+
+
+async def run_flusher(interval: float = FLUSH_INTERVAL):
+    from starlette.concurrency import run_in_threadpool
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(flush_now)
+        except Exception:
+            logger.exception("Location flush failed")
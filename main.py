@@ -1,12 +1,26 @@
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+import asyncio
+import os
+from fastapi import FastAPI, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-import models
-from database import engine
-from routers import auth, drivers, orders, reviews, chat, notifications, safety
+import live_locations
+import migrations
+from broker import broker
+from database import engine, async_engine
+import dispatch
+import assets
+import geofence
+import hashing
+import metrics
+import ratings
+import http_cache
+import realtime
+from routers import auth, drivers, orders, reviews, chat, notifications, safety, events
 
-# Create DB Tables
-models.Base.metadata.create_all(bind=engine)
+# The schema is migrated ahead of a rollout (`python manage.py migrate`, the
+# release step in the Procfile); workers only check it's current. Set
+# MIGRATE_ON_STARTUP=1 for local runs that should migrate themselves.
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "0") == "1"
 
 app = FastAPI(title="Boti API", description="Water Truck Ordering System for Zintan")
 
@@ -19,6 +33,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress API responses worth it; static assets carry precompressed variants
+app.add_middleware(GZipMiddleware, minimum_size=http_cache.GZIP_MIN_SIZE, compresslevel=6)
+
+# Metrics (GET /metrics): request latency and DB use per route, plus the
+# counters the background engines keep
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engines({"sync": engine, "async": async_engine.sync_engine})
+metrics.registry.gauge("websocket_connections", "Open WebSocket connections",
+                       lambda: {"chat": chat.manager.connection_count(), "events": events.manager.connection_count()}, ("manager",))
+metrics.registry.counter_from("websocket_evictions_total", "Slow WebSocket consumers dropped",
+                              lambda: {"chat": chat.manager.evicted, "events": events.manager.evicted}, ("manager",))
+metrics.registry.counter_from("push_deliveries_total", "Push notification outcomes", lambda: notifications.dispatcher.stats, ("outcome",))
+metrics.registry.counter_from("location_pings_total", "Driver location pings by admission outcome", lambda: live_locations.ingest.stats, ("outcome",))
+metrics.registry.counter_from("geofence_events_total", "Geofence engine activity", lambda: geofence.engine.stats)
+metrics.registry.counter_from("dispatch_events_total", "Dispatch engine activity", lambda: dispatch.engine.stats)
+metrics.registry.counter_from("chat_messages_total", "Chat message writer activity", lambda: chat.writer.stats)
+metrics.registry.counter_from("password_hashing_total", "Password hashing pool activity", lambda: hashing.pool.stats)
+metrics.registry.gauge("password_hashing_in_flight", "Hashes running or queued", lambda: hashing.pool.in_flight)
+
 # Include Routers
 app.include_router(auth.router)
 app.include_router(drivers.router)
@@ -27,9 +60,45 @@ app.include_router(reviews.router)
 app.include_router(chat.router)
 app.include_router(notifications.router)
 app.include_router(safety.router)
+app.include_router(events.router)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if MIGRATE_ON_STARTUP:
+        migrations.upgrade(engine)
+    elif pending := migrations.pending(engine):
+        raise RuntimeError(f"Database schema is behind (pending migrations {pending}): run `python manage.py migrate`")
+    app.state.location_flusher = asyncio.create_task(live_locations.run_flusher())
+    app.state.geofence = asyncio.create_task(geofence.engine.run())
+    app.state.dispatch = asyncio.create_task(dispatch.engine.run())
+    app.state.rating_reconciler = asyncio.create_task(ratings.run_reconciler())
+    await broker.start()
+    await auth.listen_for_revocations()
+    await http_cache.listen()
+    # Lets the push dispatcher thread publish notification.created events
+    realtime.bind_loop(asyncio.get_running_loop())
+    await chat.writer.start()
+    notifications.dispatcher.start()
+    hashing.pool.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.location_flusher.cancel()
+    app.state.geofence.cancel()
+    app.state.dispatch.cancel()
+    app.state.rating_reconciler.cancel()
+    # Persist the last known positions before the worker exits
+    live_locations.flush_now()
+    # Deliver pushes that are already queued
+    notifications.dispatcher.stop()
+    hashing.pool.stop()
+    # Persist chat messages still buffered
+    await chat.writer.stop()
+    await broker.stop()
+    await async_engine.dispose()
 
-# Mount static files (Frontend)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Mount static files (Frontend): fingerprinted, precompressed (see assets.py)
+app.mount("/static", assets.StaticAssets(), name="static")
 
 from fastapi.responses import RedirectResponse
 
@@ -38,8 +107,27 @@ async def root():
     return RedirectResponse(url="/static/index.html")
 
 @app.get("/health")
-async def health_check():
-    return {"status": "ok"}
+async def health_check(response: Response):
+    # Unhealthy when the database can't be reached or a background loop died
+    checks = {}
+    try:
+        async with async_engine.connect() as conn:
+            await asyncio.wait_for(conn.exec_driver_sql("SELECT 1"), timeout=2)
+        checks["database"] = "ok"
+    except Exception as e:
+        checks["database"] = f"error: {e.__class__.__name__}"
+    for name in ("location_flusher", "geofence", "dispatch", "rating_reconciler"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            checks[name] = "stopped" if task.done() else "ok"
+    healthy = all(v == "ok" for v in checks.values())
+    if not healthy:
+        response.status_code = 503
+    return {"status": "ok" if healthy else "error", **checks}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/db-test")
 async def db_test():
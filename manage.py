@@ -0,0 +1,44 @@
+import argparse
+import logging
+import sys
+
+# Deployment tasks, kept out of worker boot:
+#
+#   python manage.py migrate [--target N]   apply pending schema migrations
+#   python manage.py status                 list migrations and whether they're applied
+#   python manage.py build-static           build static/ into STATIC_BUILD_DIR (see assets.py)
+
+
+def migrate(args):
+    import migrations
+    print(f"Applied: {migrations.upgrade(target=args.target) or 'nothing to do'}")
+
+
+def status(args):
+    import migrations
+    for version, name, done in migrations.status():
+        print(f"{version:>4}  {'applied' if done else 'pending'}  {name}")
+
+
+def build_static(args):
+    import assets
+    for rel, asset in sorted(assets.build().items()):
+        sizes = "  ".join(f"{coding} {len(body):>7}" for coding, body in asset.bodies.items())
+        print(f"{rel:<40} {asset.cache_control:<36} {sizes}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Boti management commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="Apply pending database migrations")
+    migrate_parser.add_argument("--target", type=int, default=None, help="Stop after this version")
+    migrate_parser.set_defaults(func=migrate)
+    commands.add_parser("status", help="List migrations").set_defaults(func=status)
+    commands.add_parser("build-static", help="Fingerprint and precompress static assets").set_defaults(func=build_static)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
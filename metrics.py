@@ -0,0 +1,259 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics in the Prometheus text format (GET /metrics), with no
+# client library: histograms and counters are plain dicts behind a lock, and
+# everything the app already counts (the engines' stats Counters, socket
+# managers, pool state) is read at scrape time. Each worker process reports
+# its own numbers; scrape every worker (or run one) for totals.
+#
+# Per request: latency by route, plus the DB statements it ran and the time
+# they took (SQLAlchemy cursor events on both engines, attributed through a
+# context variable). With SLOW_REQUEST_MS set, requests slower than that are
+# logged together with their statements.
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+# Longest SQL text kept per statement in the slow-request log
+SLOW_STATEMENT_CHARS = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, list] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        key = tuple(zip(self.labelnames, labelvalues))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, values):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(key, (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(key, (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(key)} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1):
+        key = tuple(zip(self.labelnames, labelvalues))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + [
+            f"{self.name}{_labels(k)} {v}" for k, v in values
+        ]
+
+
+class Collector:
+    # Values read at scrape time: fn() -> number, or {label value(s): number}
+    def __init__(self, name: str, help: str, kind: str, fn: Callable, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception:
+            logger.exception("Metric %s failed", self.name)
+            return lines
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{self.name}{_labels(tuple(zip(self.labelnames, key)))} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()):
+        return self.add(Collector(name, help, "gauge", fn, labelnames))
+
+    def counter_from(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ("event",)):
+        # Exposes an existing stats Counter (or a function returning a dict) as a counter
+        return self.add(Collector(name, help, "counter", lambda: dict(fn()), labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_latency = registry.add(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")))
+request_statements = registry.add(Histogram(
+    "http_request_db_statements", "DB statements run per HTTP request", ("route",), COUNT_BUCKETS))
+request_db_time = registry.add(Histogram(
+    "http_request_db_seconds", "Time spent in DB statements per HTTP request", ("route",)))
+statement_latency = registry.add(Histogram(
+    "db_statement_duration_seconds", "DB statement latency", ("engine",)))
+pool_wait = registry.add(Histogram(
+    "db_pool_checkout_wait_seconds", "Time waited for a pooled DB connection", ("engine",),
+    (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)))
+slow_requests = registry.add(Counter(
+    "http_slow_requests_total", "Requests slower than SLOW_REQUEST_MS", ("route",)))
+
+
+# --- Per-request attribution ---
+class RequestStats:
+    __slots__ = ("statements", "db_time", "log")
+
+    def __init__(self, log: bool):
+        self.statements = 0
+        self.db_time = 0.0
+        self.log: Optional[list] = [] if log else None
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def _route(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: times HTTP requests end to end (until the last
+    # body chunk is sent) without buffering responses
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(log=SLOW_REQUEST_MS > 0)
+        token = _current.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - start
+            route = _route(scope)
+            request_latency.observe(elapsed, scope["method"], route, str(status))
+            request_statements.observe(stats.statements, route)
+            request_db_time.observe(stats.db_time, route)
+            if stats.log is not None and elapsed * 1000 >= SLOW_REQUEST_MS:
+                slow_requests.inc(route)
+                logger.warning(
+                    "Slow request %s %s -> %s: %.1f ms, %d statements (%.1f ms in DB)%s",
+                    scope["method"], scope["path"], status, elapsed * 1000, stats.statements, stats.db_time * 1000,
+                    "".join(f"\n  {ms:8.1f} ms  {sql}" for sql, ms in stats.log),
+                )
+
+
+# --- SQLAlchemy hooks ---
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(name: str):
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "metrics_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        statement_latency.observe(elapsed, name)
+        stats = _current.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += elapsed
+            if stats.log is not None:
+                stats.log.append((" ".join(statement.split())[:SLOW_STATEMENT_CHARS], elapsed * 1000))
+    return after
+
+
+def _pool_state(engines: Dict[str, object]) -> Dict[Tuple[str, str], float]:
+    state = {}
+    for name, engine in engines.items():
+        for key in ("checkedout", "checkedin", "overflow", "size"):
+            fn = getattr(engine.pool, key, None)
+            if fn is not None:
+                state[(name, key)] = fn()
+    return state
+
+
+def instrument_engines(engines: Dict[str, object]):
+    # engines: {label: sync Engine}, labels matching the pools' metrics_name.
+    # Statement timing and pool gauges; checkout waits are reported by the
+    # timed pool classes in database.py.
+    import database
+    for name, engine in engines.items():
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute(name))
+    registry.gauge("db_pool_connections", "DB pool connections by state", lambda: _pool_state(engines), ("engine", "state"))
+    database.pool_wait_hooks.append(lambda name, seconds: pool_wait.observe(seconds, name))
@@ -0,0 +1,266 @@
+import logging
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, text
+from sqlalchemy.exc import DBAPIError
+
+import driver_stats
+import geo
+import models
+import ratings
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema changes, applied in order by `python manage.py migrate` before
+# a release rolls out (workers only check that nothing is pending).
+# Version 1 creates whatever tables are missing from the current models, so a
+# fresh database already has every later column and index: later steps must be
+# idempotent (add column if missing, CREATE INDEX IF NOT EXISTS) and only do
+# real work on databases that predate them.
+
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+# Arbitrary key for the Postgres advisory lock serializing concurrent runners
+_LOCK_KEY = 0x626F7469
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    def register(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version, "migrations must be declared in order"
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return register
+
+
+# --- Helpers ---
+def _add_column(conn, table: str, column: str, ddl: str) -> bool:
+    if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def _drop_column(conn, table: str, column: str) -> bool:
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+    return True
+
+
+def _create_index(conn, name: str, table: str, columns: str, unique: bool = False, where: Optional[str] = None):
+    where = f" WHERE {where}" if where else ""
+    conn.execute(text(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns}){where}"))
+
+
+# --- Migrations ---
+@migration(1, "baseline")
+def _baseline(conn):
+    models.Base.metadata.create_all(conn)
+
+
+@migration(2, "driver profile rating and geohash columns")
+def _driver_profile_columns(conn):
+    # (average_rating is no longer added here: migration 10 replaced it with rating_sum)
+    _add_column(conn, "driver_profiles", "rating_count", "INTEGER DEFAULT 0")
+    if _add_column(conn, "driver_profiles", "geohash", "VARCHAR"):
+        rows = conn.execute(text(
+            "SELECT id, current_lat, current_lng FROM driver_profiles "
+            "WHERE current_lat IS NOT NULL AND current_lng IS NOT NULL"
+        )).all()
+        if rows:
+            conn.execute(
+                text("UPDATE driver_profiles SET geohash = :geohash WHERE id = :id"),
+                [{"id": i, "geohash": geo.encode(lat, lng)} for i, lat, lng in rows],
+            )
+    _create_index(conn, "ix_driver_profiles_geohash", "driver_profiles", "geohash")
+
+
+@migration(3, "hot path indexes")
+def _hot_path_indexes(conn):
+    duplicates = conn.execute(text(
+        "SELECT user_id FROM driver_profiles WHERE user_id IS NOT NULL "
+        "GROUP BY user_id HAVING COUNT(*) > 1"
+    )).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            f"driver_profiles has several rows for user_id {sorted(duplicates)}; "
+            "remove the extras before adding the unique index"
+        )
+    _create_index(conn, "ix_driver_profiles_user_id", "driver_profiles", "user_id", unique=True)
+    _create_index(conn, "ix_orders_driver_id_status", "orders", "driver_id, status")
+    _create_index(conn, "ix_orders_customer_id_status", "orders", "customer_id, status")
+    _create_index(conn, "ix_messages_order_id_created_at", "messages", "order_id, created_at")
+    _create_index(conn, "ix_reviews_driver_id", "reviews", "driver_id")
+    _create_index(conn, "ix_reviews_order_id", "reviews", "order_id")
+    _create_index(conn, "ix_notifications_user_id_created_at", "notifications", "user_id, created_at")
+    _create_index(conn, "ix_notification_subscriptions_user_id", "notification_subscriptions", "user_id")
+
+
+@migration(4, "keyset pagination indexes")
+def _pagination_indexes(conn):
+    _create_index(conn, "ix_orders_driver_id_created_at", "orders", "driver_id, created_at")
+    _create_index(conn, "ix_orders_customer_id_created_at", "orders", "customer_id, created_at")
+    _create_index(conn, "ix_reviews_driver_id_created_at", "reviews", "driver_id, created_at")
+    # Covered by the composite above
+    conn.execute(text("DROP INDEX IF EXISTS ix_reviews_driver_id"))
+
+
+@migration(5, "driver daily stats rollup")
+def _driver_daily_stats(conn):
+    _add_column(conn, "driver_profiles", "online_since", "TIMESTAMP")
+    if _add_column(conn, "orders", "completed_at", "TIMESTAMP"):
+        # Completion time was never recorded; creation time is the closest we have
+        conn.execute(text("UPDATE orders SET completed_at = created_at WHERE status = 'completed'"))
+    _create_index(conn, "ix_orders_driver_id_completed_at", "orders", "driver_id, completed_at")
+    models.DriverDailyStats.__table__.create(conn, checkfirst=True)
+    driver_stats.rebuild(conn)
+
+
+@migration(6, "chat message uid")
+def _message_uid(conn):
+    _add_column(conn, "messages", "uid", "VARCHAR")
+    _create_index(conn, "ix_messages_uid", "messages", "uid", unique=True)
+
+
+@migration(7, "order geofence flags")
+def _geofence_flags(conn):
+    _add_column(conn, "orders", "approach_notified", "BOOLEAN NOT NULL DEFAULT FALSE")
+    _add_column(conn, "orders", "arrival_notified", "BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+@migration(8, "order dispatch")
+def _order_dispatch(conn):
+    _add_column(conn, "orders", "liters", "INTEGER")
+    _create_index(conn, "ix_orders_status_created_at", "orders", "status, created_at")
+    models.OrderOffer.__table__.create(conn, checkfirst=True)
+
+
+@migration(9, "order version")
+def _order_version(conn):
+    _add_column(conn, "orders", "version", "INTEGER NOT NULL DEFAULT 1")
+
+
+@migration(10, "integer rating aggregates, one review per order")
+def _rating_aggregates(conn):
+    if _add_column(conn, "driver_profiles", "rating_sum", "INTEGER NOT NULL DEFAULT 0"):
+        conn.execute(text("UPDATE driver_profiles SET rating_count = 0 WHERE rating_count IS NULL"))
+    # Averages are derived from the sums now; the float column only drifted.
+    # Dropped whichever path created the table, so no schema keeps it.
+    _drop_column(conn, "driver_profiles", "average_rating")
+    ratings.reconcile(conn)
+    unique = {i["name"]: i["unique"] for i in inspect(conn).get_indexes("reviews")}
+    if not unique.get("ix_reviews_order_id"):
+        duplicates = conn.execute(text(
+            "SELECT order_id FROM reviews WHERE order_id IS NOT NULL "
+            "GROUP BY order_id HAVING COUNT(*) > 1"
+        )).scalars().all()
+        if duplicates:
+            raise RuntimeError(
+                f"reviews has several rows for order_id {sorted(duplicates)}; "
+                "remove the extras before adding the unique index"
+            )
+        conn.execute(text("DROP INDEX IF EXISTS ix_reviews_order_id"))
+        _create_index(conn, "ix_reviews_order_id", "reviews", "order_id", unique=True)
+
+
+@migration(11, "refresh tokens")
+def _refresh_tokens(conn):
+    models.RefreshToken.__table__.create(conn, checkfirst=True)
+
+
+@migration(12, "drop leftover average_rating")
+def _drop_average_rating(conn):
+    # Databases created fresh before migration 10 dropped the column unconditionally still have it
+    _drop_column(conn, "driver_profiles", "average_rating")
+
+
+@migration(13, "one open order per driver")
+def _open_order_per_driver(conn):
+    # Needs partial indexes; elsewhere bookings are only checked, not enforced
+    if conn.dialect.name not in ("sqlite", "postgresql"):
+        return
+    duplicates = conn.execute(text(
+        f"SELECT driver_id FROM orders WHERE {models.OPEN_ORDER_PREDICATE} "
+        "GROUP BY driver_id HAVING COUNT(*) > 1"
+    )).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            f"drivers {sorted(duplicates)} have several open orders; "
+            "complete or cancel the extras before adding the unique index"
+        )
+    _create_index(conn, "ix_orders_open_driver", "orders", "driver_id", unique=True, where=models.OPEN_ORDER_PREDICATE)
+
+
+# --- Runner ---
+def applied_versions(conn) -> List[int]:
+    schema_migrations.create(conn, checkfirst=True)
+    return list(conn.execute(select(schema_migrations.c.version).order_by(schema_migrations.c.version)).scalars())
+
+
+def upgrade(bind=None, target: Optional[int] = None) -> List[int]:
+    # Apply pending migrations up to `target` (default: latest), each in its own
+    # transaction. Returns the versions applied.
+    if bind is None:
+        from database import engine as bind
+    applied = []
+    with bind.connect() as conn:
+        postgres = conn.dialect.name == "postgresql"
+        if postgres:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _LOCK_KEY})
+        try:
+            done = set(applied_versions(conn))
+            conn.commit()
+            for m in MIGRATIONS:
+                if m.version in done or (target is not None and m.version > target):
+                    continue
+                logger.info("Applying migration %d: %s", m.version, m.name)
+                m.upgrade(conn)
+                conn.execute(insert(schema_migrations).values(version=m.version, name=m.name))
+                conn.commit()
+                applied.append(m.version)
+        finally:
+            conn.rollback()
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+                conn.commit()
+    return applied
+
+
+def pending(bind=None) -> List[int]:
+    # Versions not applied yet, in one query (all of them when the schema
+    # was never migrated); doesn't create anything
+    if bind is None:
+        from database import engine as bind
+    try:
+        with bind.connect() as conn:
+            done = set(conn.execute(select(schema_migrations.c.version)).scalars())
+    except DBAPIError:
+        done = set()
+    return [m.version for m in MIGRATIONS if m.version not in done]
+
+
+def status(bind=None) -> List[tuple]:
+    # [(version, name, applied)]
+    if bind is None:
+        from database import engine as bind
+    with bind.connect() as conn:
+        done = set(applied_versions(conn))
+        conn.commit()
+    return [(m.version, m.name, m.version in done) for m in MIGRATIONS]
@@ -1,7 +1,9 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, DateTime, Enum as SQLEnum
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, Date, DateTime, Enum as SQLEnum, Index, LargeBinary, case, cast, event, text
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
-from database import Base
+from database import Base, engine
 import enum
+import geo
 from datetime import datetime
 
 class UserRole(str, enum.Enum):
@@ -16,6 +18,13 @@ class OrderStatus(str, enum.Enum):
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+class OfferStatus(str, enum.Enum):
+    OFFERED = "offered"
+    ACCEPTED = "accepted"
+    DECLINED = "declined"
+    EXPIRED = "expired"
+    CANCELLED = "cancelled"
+
 class User(Base):
     __tablename__ = "users"
 
@@ -35,7 +44,7 @@ class DriverProfile(Base):
     __tablename__ = "driver_profiles"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True) # One profile per driver
     truck_type = Column(String) # e.g., "12000 Liters", "Small"
     capacity = Column(Integer) # In Liters
     price = Column(Float) # Per Trip or Unit
@@ -43,33 +52,120 @@ class DriverProfile(Base):
     current_lat = Column(Float, nullable=True)
     current_lng = Column(Float, nullable=True)
     last_location_update = Column(DateTime, nullable=True)
-    average_rating = Column(Float, default=0.0)
-    rating_count = Column(Integer, default=0)
+    online_since = Column(DateTime, nullable=True) # Start of the current availability session
+    geohash = Column(String, nullable=True, index=True) # Spatial index key for current_lat/current_lng
+    # Rating aggregates, incremented atomically per review (see ratings.py)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_count = Column(Integer, nullable=False, default=0)
 
     user = relationship("User", back_populates="driver_profile")
 
+    @hybrid_property
+    def average_rating(self) -> float:
+        return self.rating_sum / self.rating_count if self.rating_count else 0.0
+
+    @average_rating.expression
+    def average_rating(cls):
+        return case((cls.rating_count > 0, cast(cls.rating_sum, Float) / cls.rating_count), else_=0.0)
+
+@event.listens_for(DriverProfile, "before_insert")
+@event.listens_for(DriverProfile, "before_update")
+def _sync_driver_geohash(mapper, connection, target):
+    # Keep the geohash in step with the coordinates it indexes
+    if target.current_lat is not None and target.current_lng is not None:
+        target.geohash = geo.encode(target.current_lat, target.current_lng)
+    else:
+        target.geohash = None
+
+# Partial-index predicate for the dialect in use only: naming another dialect's
+# option (postgresql_where on SQLite) makes SQLAlchemy import that dialect at boot
+def _partial(predicate: str) -> dict:
+    dialect = engine.dialect.name
+    return {f"{dialect}_where": text(predicate)} if dialect in ("sqlite", "postgresql") else {}
+
+# A driver's open order: booked (pending with driver_id set), accepted or en route
+OPEN_ORDER_PREDICATE = "driver_id IS NOT NULL AND status IN ('pending', 'accepted', 'en_route')"
+_OPEN_ORDER = _partial(OPEN_ORDER_PREDICATE)
+
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # "my active order" lookups filter on the party and the status together
+        Index("ix_orders_driver_id_status", "driver_id", "status"),
+        Index("ix_orders_customer_id_status", "customer_id", "status"),
+        # Order history pages walk (created_at, id) per party
+        Index("ix_orders_driver_id_created_at", "driver_id", "created_at"),
+        Index("ix_orders_customer_id_created_at", "customer_id", "created_at"),
+        # Earnings / completed-order totals over a date range
+        Index("ix_orders_driver_id_completed_at", "driver_id", "completed_at"),
+        # Dispatch picks up pending orders oldest first
+        Index("ix_orders_status_created_at", "status", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("users.id"))
     driver_id = Column(Integer, ForeignKey("users.id"))
     status = Column(String, default=OrderStatus.PENDING)
+    version = Column(Integer, default=1, nullable=False) # Bumped by every status transition (transitions.py)
     amount = Column(Float)
+    liters = Column(Integer, nullable=True) # Required volume; set for dispatched orders
     delivery_lat = Column(Float)
     delivery_lng = Column(Float)
     delivery_address = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+    # Set once the geofence has fired for this delivery (geofence.py)
+    approach_notified = Column(Boolean, default=False, nullable=False)
+    arrival_notified = Column(Boolean, default=False, nullable=False)
 
     customer = relationship("User", foreign_keys=[customer_id], back_populates="orders_placed")
     driver = relationship("User", foreign_keys=[driver_id], back_populates="orders_received")
     review = relationship("Review", back_populates="order", uselist=False)
 
+if _OPEN_ORDER:
+    # At most one open order per driver, so two customers booking the same
+    # driver at once can't both get through (routers/orders.py)
+    Index("ix_orders_open_driver", Order.driver_id, unique=True, **_OPEN_ORDER)
+
+class DriverDailyStats(Base):
+    # Per-driver, per-UTC-day rollup kept up to date by driver_stats.py
+    __tablename__ = "driver_daily_stats"
+
+    driver_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    orders_count = Column(Integer, default=0, nullable=False)
+    earnings = Column(Float, default=0.0, nullable=False)
+    online_seconds = Column(Float, default=0.0, nullable=False)
+
+_OPEN_OFFER = _partial("status = 'offered'")
+
+class OrderOffer(Base):
+    # A dispatched order offered to one driver until expires_at (dispatch.py)
+    __tablename__ = "order_offers"
+    __table_args__ = (
+        # At most one open offer per order and per driver, across workers
+        Index("ix_order_offers_open_order", "order_id", unique=True, **_OPEN_OFFER),
+        Index("ix_order_offers_open_driver", "driver_id", unique=True, **_OPEN_OFFER),
+        Index("ix_order_offers_order_id", "order_id"),
+        Index("ix_order_offers_status_expires_at", "status", "expires_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    driver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    status = Column(String, default=OfferStatus.OFFERED, nullable=False)
+    distance_km = Column(Float)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
 class Review(Base):
     __tablename__ = "reviews"
+    __table_args__ = (
+        Index("ix_reviews_driver_id_created_at", "driver_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), unique=True, index=True) # One review per order
     driver_id = Column(Integer, ForeignKey("users.id"))
     rating = Column(Integer) # 1-5
     comment = Column(String, nullable=True)
@@ -85,8 +181,13 @@ class MessageType(str, enum.Enum):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Chat history is read per order in send order
+        Index("ix_messages_order_id_created_at", "order_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    uid = Column(String, unique=True, index=True, nullable=True) # Assigned before the row is written (chat_writer.py)
     order_id = Column(Integer, ForeignKey("orders.id"))
     sender_id = Column(Integer, ForeignKey("users.id"))
     content = Column(String) # Text content or URL to media
@@ -102,6 +203,9 @@ Order.messages = relationship("Message", back_populates="order", order_by="Messa
 
 class Notification(Base):
     __tablename__ = "notifications"
+    __table_args__ = (
+        Index("ix_notifications_user_id_created_at", "user_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -116,9 +220,20 @@ class NotificationSubscription(Base):
     __tablename__ = "notification_subscriptions"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     endpoint = Column(String)
     p256dh = Column(String)
     auth = Column(String)
     
     user = relationship("User")
+
+class RefreshToken(Base):
+    # One row per issued refresh token (tokens.py). Only the SHA-256 of the
+    # token is stored; rotations of one login share a family.
+    __tablename__ = "refresh_tokens"
+
+    token_hash = Column(LargeBinary(32), primary_key=True)
+    family = Column(LargeBinary(16), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False)
+    revoked = Column(Boolean, default=False, nullable=False) # Rotated away or logged out
@@ -0,0 +1,85 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, Query
+from sqlalchemy import tuple_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# Keyset pagination over (created_at, id).
+#
+#   no cursor        -> the newest `limit` rows
+#   before=<cursor>  -> the `limit` rows just older than the cursor
+#   after=<cursor>   -> the `limit` rows just newer than the cursor
+#
+# next_cursor continues in the same direction. Paging back it is None once the
+# oldest row has been returned; paging forward it is always set (to the newest
+# row seen) so a client can keep polling for new rows.
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    raw = f"{created_at.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class PageParams:
+    # Query parameters shared by every paginated listing (use as a dependency)
+    def __init__(
+        self,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        before: Optional[str] = Query(None, description="next_cursor of the previous page"),
+        after: Optional[str] = Query(None, description="Cursor to fetch newer rows from"),
+    ):
+        if before and after:
+            raise HTTPException(status_code=400, detail="Use either before or after, not both")
+        self.limit = limit
+        self.before = decode_cursor(before) if before else None
+        self.after = decode_cursor(after) if after else None
+        self.after_cursor = after
+
+
+def paginate(stmt, created_at, id, params: PageParams):
+    # Narrow and order `stmt` for one page; fetches one extra row to tell whether more exist
+    key = tuple_(created_at, id)
+    if params.after:
+        stmt = stmt.where(key > tuple_(*params.after)).order_by(created_at.asc(), id.asc())
+    else:
+        if params.before:
+            stmt = stmt.where(key < tuple_(*params.before))
+        stmt = stmt.order_by(created_at.desc(), id.desc())
+    return stmt.limit(params.limit + 1)
+
+
+def _created_at_id(item) -> Tuple[datetime, int]:
+    return item.created_at, item.id
+
+
+def page(items: List[Any], params: PageParams, newest_first: bool = True, key=_created_at_id) -> dict:
+    # Build {"items", "next_cursor"} from the rows fetched with paginate(), in
+    # fetch order. `key` returns an item's (created_at, id).
+    more = len(items) > params.limit
+    items = items[:params.limit]
+    if items:
+        next_cursor = encode_cursor(*key(items[-1]))
+    else:
+        next_cursor = None
+    if params.after:
+        next_cursor = next_cursor or params.after_cursor
+    elif not more:
+        next_cursor = None
+    # Fetched newest first unless paging forward
+    if newest_first == bool(params.after):
+        items.reverse()
+    return {"items": items, "next_cursor": next_cursor}
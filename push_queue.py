@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import models
+
+logger = logging.getLogger(__name__)
+
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "8"))
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "100"))
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "4"))
+PUSH_BACKOFF = float(os.getenv("PUSH_BACKOFF", "1.0"))
+PUSH_PER_ENDPOINT = int(os.getenv("PUSH_PER_ENDPOINT", "2"))
+
+# Push service answers meaning the subscription is gone for good
+GONE_STATUSES = (404, 410)
+# Answers worth retrying later
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class PushError(Exception):
+    def __init__(self, status_code: Optional[int], message: str = ""):
+        super().__init__(message or f"push failed with status {status_code}")
+        self.status_code = status_code
+
+
+class NotificationJob(NamedTuple):
+    user_id: int
+    title: str
+    body: str
+    enqueued_at: float
+
+
+class Delivery(NamedTuple):
+    subscription_id: int
+    subscription_info: dict
+    data: str
+    user_id: int
+    attempt: int
+    enqueued_at: float
+
+
+# sender(subscription_info, data) delivers one push or raises PushError
+Sender = Callable[[dict, str], None]
+# on_saved(notification) is called for each stored notification after commit,
+# with its id, user_id, title, body and created_at
+SavedHook = Callable[[dict], None]
+
+
+class PushDispatcher:
+    # Handlers call enqueue(); a batcher thread persists Notification rows and
+    # looks up subscriptions for a whole batch at once, then a worker pool
+    # delivers each push with retries, per-endpoint limits and pruning.
+
+    def __init__(
+        self,
+        sender: Sender,
+        workers: int = PUSH_WORKERS,
+        batch_size: int = PUSH_BATCH_SIZE,
+        max_retries: int = PUSH_MAX_RETRIES,
+        backoff: float = PUSH_BACKOFF,
+        per_endpoint: int = PUSH_PER_ENDPOINT,
+        session_factory=None,
+        on_saved: Optional[SavedHook] = None,
+    ):
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.per_endpoint = per_endpoint
+        self.session_factory = session_factory
+        self.on_saved = on_saved
+        self.stats = Counter()
+        # Enqueue-to-delivered latency of successful pushes, newest last
+        self.latencies: List[float] = []
+
+        self._jobs: "queue.Queue[Optional[NotificationJob]]" = queue.Queue()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._batcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, int] = {}
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        self._timers: set = set()
+
+    # --- Lifecycle ---
+    def start(self):
+        with self._lock:
+            if self._batcher is not None:
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="push")
+            self._batcher = threading.Thread(target=self._run_batcher, name="push-batcher", daemon=True)
+            self._batcher.start()
+
+    def stop(self, timeout: float = 10.0):
+        # Deliver what is already queued (within timeout), then shut down
+        if self._batcher is None:
+            return
+        self.join(timeout)
+        self._jobs.put(None)
+        self._batcher.join(timeout)
+        for timer in list(self._timers):
+            timer.cancel()
+        self._pool.shutdown(wait=True)
+        self._batcher = None
+        self._pool = None
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        # Wait until every enqueued notification has been fully processed
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def enqueue(self, user_id: int, title: str, body: str):
+        self.start()
+        self._add_pending(1)
+        self._jobs.put(NotificationJob(user_id, title, body, time.monotonic()))
+        self._count("enqueued")
+
+    # --- Internals ---
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _add_pending(self, n: int):
+        with self._idle:
+            self._pending += n
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _session(self):
+        if self.session_factory is None:
+            from database import SessionLocal
+            self.session_factory = SessionLocal
+        return self.session_factory()
+
+    def _run_batcher(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._jobs.put(None)
+                    break
+                batch.append(job)
+            try:
+                self._process_batch(batch)
+            except Exception:
+                logger.exception("Push batch of %d failed", len(batch))
+                self._count("batch_failed")
+            finally:
+                self._add_pending(-len(batch))
+
+    def _process_batch(self, batch: List[NotificationJob]):
+        db = self._session()
+        try:
+            # 1. In-app history, one INSERT round for the whole batch
+            rows = [models.Notification(user_id=j.user_id, title=j.title, body=j.body) for j in batch]
+            db.add_all(rows)
+            saved = []
+            if self.on_saved is not None:
+                # Ids are read before commit expires the rows
+                db.flush()
+                saved = [
+                    {"id": r.id, "user_id": r.user_id, "title": r.title, "body": r.body, "created_at": r.created_at}
+                    for r in rows
+                ]
+            db.commit()
+            for notification in saved:
+                try:
+                    self.on_saved(notification)
+                except Exception:
+                    logger.exception("on_saved hook failed for notification %s", notification["id"])
+
+            # 2. Subscriptions of every recipient in a single query
+            user_ids = {j.user_id for j in batch}
+            subs = db.query(models.NotificationSubscription).filter(
+                models.NotificationSubscription.user_id.in_(user_ids)
+            ).all()
+        finally:
+            db.close()
+
+        by_user: Dict[int, list] = {}
+        for sub in subs:
+            by_user.setdefault(sub.user_id, []).append(sub)
+        for job in batch:
+            data = json.dumps({"title": job.title, "body": job.body})
+            for sub in by_user.get(job.user_id, ()):
+                info = {"endpoint": sub.endpoint, "keys": {"p256dh": sub.p256dh, "auth": sub.auth}}
+                self._submit(Delivery(sub.id, info, data, job.user_id, 0, job.enqueued_at))
+
+    def _submit(self, delivery: Delivery):
+        pool = self._pool
+        if pool is None:
+            return
+        self._add_pending(1)
+        try:
+            pool.submit(self._deliver, delivery)
+        except RuntimeError:
+            # Pool already shut down
+            self._add_pending(-1)
+
+    def _schedule(self, delivery: Delivery, delay: float):
+        self._add_pending(1)
+
+        def fire():
+            self._timers.discard(timer)
+            try:
+                self._submit(delivery)
+            finally:
+                self._add_pending(-1)
+
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        self._timers.add(timer)
+        timer.start()
+
+    def _deliver(self, delivery: Delivery):
+        try:
+            endpoint = delivery.subscription_info["endpoint"]
+            with self._lock:
+                busy = self._in_flight.get(endpoint, 0) >= self.per_endpoint
+                if not busy:
+                    self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+            if busy:
+                # Endpoint already has its share of requests in flight; come back shortly
+                self._count("throttled")
+                self._schedule(delivery, 0.05)
+                return
+            try:
+                self.sender(delivery.subscription_info, delivery.data)
+            except PushError as ex:
+                self._handle_failure(delivery, ex.status_code, ex)
+            except Exception as ex:
+                self._handle_failure(delivery, None, ex)
+            else:
+                with self._lock:
+                    self.stats["sent"] += 1
+                    self.latencies.append(time.monotonic() - delivery.enqueued_at)
+                    del self.latencies[:-10000]
+            finally:
+                with self._lock:
+                    left = self._in_flight[endpoint] - 1
+                    if left:
+                        self._in_flight[endpoint] = left
+                    else:
+                        del self._in_flight[endpoint]
+        finally:
+            self._add_pending(-1)
+
+    def _handle_failure(self, delivery: Delivery, status_code: Optional[int], ex: Exception):
+        if status_code in GONE_STATUSES:
+            self._count("pruned")
+            self._prune(delivery.subscription_id)
+        elif (status_code is None or status_code in RETRY_STATUSES) and delivery.attempt < self.max_retries:
+            self._count("retried")
+            self._schedule(delivery._replace(attempt=delivery.attempt + 1), self.backoff * 2 ** delivery.attempt)
+        else:
+            self._count("failed")
+            logger.error("Push failed for user %s: %s", delivery.user_id, ex)
+
+    def _prune(self, subscription_id: int):
+        db = self._session()
+        try:
+            db.query(models.NotificationSubscription).filter(
+                models.NotificationSubscription.id == subscription_id
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            logger.exception("Could not prune subscription %s", subscription_id)
+            db.rollback()
+        finally:
+            db.close()
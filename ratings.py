@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import func, or_, select, update
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Driver ratings are integer aggregates on driver_profiles (rating_sum,
+# rating_count), moved by one atomic increment per review; the average is
+# derived on read (DriverProfile.average_rating). Concurrent reviews can't
+# overwrite each other and integers don't drift. reconcile() recomputes both
+# from the reviews table, so an increment that went missing (a manual edit,
+# a review landing mid-pass) is corrected on the next run.
+
+RATING_RECONCILE_INTERVAL = float(os.getenv("RATING_RECONCILE_INTERVAL", "3600"))
+
+_profiles = models.DriverProfile.__table__
+_reviews = models.Review.__table__
+
+
+def record(driver_id: int, rating: int):
+    # UPDATE driver_profiles SET rating_sum = rating_sum + :rating, rating_count = rating_count + 1
+    return (
+        update(_profiles)
+        .where(_profiles.c.user_id == driver_id)
+        .values(rating_sum=_profiles.c.rating_sum + rating, rating_count=_profiles.c.rating_count + 1)
+    )
+
+
+def reconcile(conn) -> int:
+    # Recompute every profile's aggregates from reviews in one statement,
+    # touching only the rows that disagree. Returns how many were fixed.
+    by_driver = _reviews.c.driver_id == _profiles.c.user_id
+    total = select(func.coalesce(func.sum(_reviews.c.rating), 0)).where(by_driver).scalar_subquery()
+    count = select(func.count()).select_from(_reviews).where(by_driver).scalar_subquery()
+    return conn.execute(
+        update(_profiles)
+        .where(or_(_profiles.c.rating_sum.is_distinct_from(total), _profiles.c.rating_count.is_distinct_from(count)))
+        .values(rating_sum=total, rating_count=count)
+    ).rowcount
+
+
+def reconcile_now() -> int:
+    from database import engine
+    with engine.begin() as conn:
+        fixed = reconcile(conn)
+    if fixed:
+        logger.warning("Reconciled rating aggregates of %d drivers", fixed)
+    return fixed
+
+
+async def run_reconciler(interval: float = RATING_RECONCILE_INTERVAL):
+    from starlette.concurrency import run_in_threadpool
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(reconcile_now)
+        except Exception:
+            logger.exception("Rating reconciliation failed")
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+import geo
+from broker import broker
+from cache import TTLCache
+
+# Per-user event stream (routers/events.py). Every event is a JSON object
+#   {"type": ..., "data": {...}, "ts": <unix seconds>}
+# published on the user's broker channel, so it reaches the user's sockets on
+# whichever worker holds them.
+#
+#   order.status_changed  {"order_id", "status"}
+#   driver.location       {"order_id", "driver_id", "key", "lat", "lng"}   keyframe
+#                         {"order_id", "driver_id", "key", "d": [dlat, dlng]}
+#                         delta from keyframe `key`, in 1e-5 degree units
+#   notification.created  {"id", "title", "body", "created_at"}
+#   order.geofence        {"order_id", "fence", "state": "enter" | "exit"}   (geofence.py)
+
+EVENTS_PREFIX = "events"
+
+LOCATION_EVENT_INTERVAL = float(os.getenv("LOCATION_EVENT_INTERVAL", "2")) # Seconds between events per driver
+LOCATION_EVENT_MIN_METERS = float(os.getenv("LOCATION_EVENT_MIN_METERS", "5"))
+LOCATION_KEYFRAME_EVERY = int(os.getenv("LOCATION_KEYFRAME_EVERY", "10"))
+DELTA_SCALE = 100000
+MAX_DELTA = 32767
+
+# Loop that owns the broker, for publishing from threads (push dispatcher, sync handlers)
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_pending: set = set()
+
+
+def bind_loop(loop: asyncio.AbstractEventLoop):
+    global _loop
+    _loop = loop
+
+
+def channel(user_id: int) -> str:
+    return f"{EVENTS_PREFIX}:{user_id}"
+
+
+def encode(event_type: str, data: dict) -> str:
+    return json.dumps({"type": event_type, "data": data, "ts": round(time.time(), 3)}, separators=(",", ":"))
+
+
+async def publish(user_id: int, event_type: str, data: dict):
+    await broker.publish(channel(user_id), encode(event_type, data))
+
+
+def publish_nowait(user_id: int, event_type: str, data: dict):
+    # Fire-and-forget from any thread; dropped when no loop is serving events
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        task = loop.create_task(publish(user_id, event_type, data))
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+    elif _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(publish(user_id, event_type, data), _loop)
+
+
+# --- Driver location ---
+class LocationThrottle:
+    # Decides which fixes become driver.location events and encodes them.
+    # At most one event per `interval` per (driver, recipient), none while the
+    # driver stands still, and a keyframe every `keyframe_every` events.
+    # Deltas are taken from the keyframe, so a client that missed events only
+    # needs the keyframe to place the next one.
+
+    def __init__(
+        self,
+        interval: float = LOCATION_EVENT_INTERVAL,
+        min_meters: float = LOCATION_EVENT_MIN_METERS,
+        keyframe_every: int = LOCATION_KEYFRAME_EVERY,
+    ):
+        self.interval = interval
+        self.min_km = min_meters / 1000
+        self.keyframe_every = keyframe_every
+        # (driver_id, recipient_id) -> [key, base_lat, base_lng, sent, last_lat, last_lng, last_ts]
+        self._state = TTLCache(maxsize=100000, ttl=600)
+
+    def encode(self, driver_id: int, recipient_id: int, lat: float, lng: float, now: Optional[float] = None) -> Optional[dict]:
+        now = time.monotonic() if now is None else now
+        state = self._state.get((driver_id, recipient_id))
+        if state is not None:
+            key, base_lat, base_lng, sent, last_lat, last_lng, last_ts = state
+            if now - last_ts < self.interval or geo.haversine_km(last_lat, last_lng, lat, lng) < self.min_km:
+                return None
+            dlat = round((lat - base_lat) * DELTA_SCALE)
+            dlng = round((lng - base_lng) * DELTA_SCALE)
+            if sent < self.keyframe_every and abs(dlat) <= MAX_DELTA and abs(dlng) <= MAX_DELTA:
+                self._state.set((driver_id, recipient_id), [key, base_lat, base_lng, sent + 1, lat, lng, now])
+                return {"driver_id": driver_id, "key": key, "d": [dlat, dlng]}
+        key = uuid.uuid4().hex[:8]
+        self._state.set((driver_id, recipient_id), [key, lat, lng, 1, lat, lng, now])
+        return {"driver_id": driver_id, "key": key, "lat": lat, "lng": lng}
+
+    def keyframe(self, driver_id: int, recipient_id: int, lat: float, lng: float) -> dict:
+        # Restart the delta chain, e.g. for a client that just connected
+        self._state.pop((driver_id, recipient_id))
+        return self.encode(driver_id, recipient_id, lat, lng)
+
+
+location_throttle = LocationThrottle()
+
+
+async def driver_location(order_id: int, driver_id: int, customer_id: int, lat: float, lng: float):
+    data = location_throttle.encode(driver_id, customer_id, lat, lng)
+    if data is not None:
+        data["order_id"] = order_id
+        await publish(customer_id, "driver.location", data)
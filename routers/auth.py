@@ -1,24 +1,42 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
 from datetime import timedelta
-from typing import Annotated
+from typing import Annotated, Optional
+import asyncio
+import logging
+import os
+import time
 
-import models, schemas, security
-from database import get_db
+import hashing, models, schemas, security, tokens
+from broker import broker
+from cache import TTLCache
+from database import get_async_db
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
 
+logger = logging.getLogger(__name__)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login", auto_error=False)
+
+def _hashing_busy() -> HTTPException:
+    # Hashing pool is saturated: shed now instead of queueing
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server busy, try again shortly",
+        headers={"Retry-After": str(hashing.HASH_RETRY_AFTER)},
+    )
 
 @router.post("/register", response_model=schemas.UserOut)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     try:
-        db_user = db.query(models.User).filter(models.User.phone == user.phone).first()
-        if db_user:
+        if await db.scalar(select(models.User.id).where(models.User.phone == user.phone)):
             raise HTTPException(status_code=400, detail="Phone number already registered")
         
-        hashed_password = security.get_password_hash(user.password)
+        hashed_password = await hashing.pool.hash(user.password)
         new_user = models.User(
             full_name=user.full_name,
             phone=user.phone,
@@ -26,52 +44,219 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
             role=user.role
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.flush()
         
         # If driver, create empty profile
         if user.role == models.UserRole.DRIVER:
-            db_profile = models.DriverProfile(user_id=new_user.id, truck_type="Standard", capacity=10000, price=50.0)
-            db.add(db_profile)
-            db.commit()
+            db.add(models.DriverProfile(user_id=new_user.id, truck_type="Standard", capacity=10000, price=50.0))
+        await db.commit()
+        await db.refresh(new_user)
             
         return new_user
+    except HTTPException:
+        raise
+    except hashing.Busy:
+        raise _hashing_busy()
     except Exception as e:
-        print(f"REGISTER ERROR: {str(e)}") # Log to Railway console
+        logger.exception("Register failed")
         raise HTTPException(status_code=500, detail=f"Server Error: {str(e)}")
 
 @router.post("/login", response_model=schemas.Token)
-def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)):
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db)):
     # form_data.username will be the phone number
-    user = db.query(models.User).filter(models.User.phone == form_data.username).first()
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+    user = await db.scalar(select(models.User).where(models.User.phone == form_data.username))
+    valid, new_hash = False, None
+    if user:
+        try:
+            valid, new_hash = await hashing.pool.verify(form_data.password, user.hashed_password)
+        except hashing.Busy:
+            raise _hashing_busy()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect phone or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Stored hash used an older cost; replace it while we have the password
+        user.hashed_password = new_hash
     
+    await tokens.prune(db, user.id)
+    refresh_token = await tokens.issue(db, user.id)
+    await db.commit()
+    return _token_response(user, refresh_token)
+
+def _token_response(user: models.User, refresh_token: str) -> dict:
     access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
         data={"sub": user.phone, "role": user.role, "user_id": user.id, "full_name": user.full_name}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer", "role": user.role, "user_id": user.id, "full_name": user.full_name}
+    return {
+        "access_token": access_token, "token_type": "bearer", "expires_in": int(access_token_expires.total_seconds()),
+        "refresh_token": refresh_token, "role": user.role, "user_id": user.id, "full_name": user.full_name,
+    }
+
+@router.post("/refresh", response_model=schemas.Token)
+async def refresh(body: schemas.RefreshRequest, db: AsyncSession = Depends(get_async_db)):
+    # Trade a refresh token for a new access token and a new refresh token
+    invalid = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    try:
+        user_id, family, refresh_token = await tokens.rotate(db, body.refresh_token)
+    except tokens.InvalidRefreshToken:
+        raise invalid
+    # The one place a session meets the users table again
+    user = await db.get(models.User, user_id)
+    if user is None or not user.is_active:
+        await db.rollback()
+        await tokens.revoke_family(db, family)
+        await db.commit()
+        raise invalid
+    await db.commit()
+    return _token_response(user, refresh_token)
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    body: schemas.RefreshRequest,
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    await tokens.revoke(db, body.refresh_token)
+    await db.commit()
+    if token:
+        try:
+            await revoke_access_token(security.decode_access_token(token))
+        except security.JWTError:
+            pass
+
+@router.get("/jwks")
+async def jwks():
+    # Public keys for verifying access tokens without calling this service (ES256 only)
+    return security.public_jwks()
+
+# --- Current user ---
+# Snapshots of User rows keyed by id, so authenticated requests skip the users table
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Users deactivated while holding still-valid tokens
+deactivated_users = TTLCache(maxsize=USER_CACHE_SIZE, ttl=security.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# jti of access tokens revoked before their expiry (logout), each kept until
+# the token would have expired anyway. Shared with other workers through the broker.
+REVOKED_TOKENS_SIZE = int(os.getenv("REVOKED_TOKENS_SIZE", "100000"))
+REVOKED_CHANNEL = "auth.revoked"
+revoked_tokens = TTLCache(maxsize=REVOKED_TOKENS_SIZE, ttl=security.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# Committed changes to users, published so every worker drops its snapshot
+USER_CHANGED_CHANNEL = "auth.user_changed"
+# Loop that owns the broker, for publishing from sync sessions
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_pending: set = set()
+
+def _remember_revoked(jti: str, exp: float):
+    revoked_tokens.set(jti, True, ttl=max(0.0, exp - time.time()))
+
+def _on_revoked(channel: str, message: str):
+    jti, _, exp = message.partition(" ")
+    _remember_revoked(jti, float(exp))
+
+async def revoke_access_token(payload: dict):
+    if payload.get("jti"):
+        _remember_revoked(payload["jti"], payload["exp"])
+        await broker.publish(REVOKED_CHANNEL, f"{payload['jti']} {payload['exp']}")
+
+async def listen_for_revocations():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    await broker.subscribe(REVOKED_CHANNEL, _on_revoked)
+    await broker.subscribe(USER_CHANGED_CHANNEL, _on_user_changed)
+
+def invalidate_user(user_id: int, deactivated: bool = False):
+    user_cache.pop(user_id)
+    if deactivated:
+        deactivated_users.set(user_id, True)
+    else:
+        deactivated_users.pop(user_id)
+
+def _on_user_changed(channel: str, message: str):
+    user_id, _, deactivated = message.partition(" ")
+    invalidate_user(int(user_id), deactivated=deactivated == "1")
+
+def _publish_user_changed(message: str):
+    # Callable from any thread, like http_cache.invalidate
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        task = loop.create_task(broker.publish(USER_CHANGED_CHANNEL, message))
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+    elif _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(broker.publish(USER_CHANGED_CHANNEL, message), _loop)
+
+@event.listens_for(models.User, "after_update")
+def _user_changed(mapper, connection, target):
+    # Only noted here: the snapshots are dropped once the change is committed,
+    # so a concurrent request can't cache the pre-commit row again
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", {})[target.id] = not target.is_active
+
+@event.listens_for(Session, "after_commit")
+def _users_committed(session):
+    for user_id, deactivated in session.info.pop("changed_users", {}).items():
+        invalidate_user(user_id, deactivated=deactivated)
+        _publish_user_changed(f"{user_id} {int(deactivated)}")
+
+@event.listens_for(Session, "after_soft_rollback")
+def _users_rolled_back(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("changed_users", None)
+
+def _principal_from_user(user: models.User) -> schemas.Principal:
+    return schemas.Principal(
+        id=user.id, phone=user.phone, full_name=user.full_name, role=user.role, is_active=user.is_active
+    )
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def _decode_token(token: str) -> dict:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = security.jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
-        phone: str = payload.get("sub")
-        if phone is None:
-            raise credentials_exception
+        payload = security.decode_access_token(token)
     except security.JWTError:
         raise credentials_exception
-        
-    user = db.query(models.User).filter(models.User.phone == phone).first()
-    if user is None:
+    if payload.get("sub") is None or payload.get("user_id") is None or payload.get("role") is None:
+        raise credentials_exception
+    if payload.get("jti") in revoked_tokens:
+        raise credentials_exception
+    if payload["user_id"] in deactivated_users:
         raise credentials_exception
-    return user
+    return payload
+
+async def get_current_principal(token: str = Depends(oauth2_scheme)) -> schemas.Principal:
+    # Built from the verified claims alone; for endpoints that only need id and role
+    payload = _decode_token(token)
+    return schemas.Principal(
+        id=payload["user_id"], phone=payload["sub"], full_name=payload.get("full_name") or "", role=payload["role"]
+    )
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> schemas.Principal:
+    # Current state of the user, served from user_cache when possible
+    payload = _decode_token(token)
+    user_id = payload["user_id"]
+    principal = user_cache.get(user_id)
+    if principal is None:
+        user = await db.get(models.User, user_id)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        principal = _principal_from_user(user)
+        user_cache.set(user_id, principal)
+    if not principal.is_active:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Inactive user")
+    return principal
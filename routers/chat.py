@@ -1,85 +1,185 @@
 from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File
-from sqlalchemy.orm import Session
-from typing import List, Dict
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Optional
+import asyncio
+import json
+import logging
+import os
 import models, schemas
-from database import get_db
-from routers.auth import get_current_user
+from broker import Broker, broker
+from chat_writer import MessageWriter, new_message
+from database import get_async_db
+from pagination import PageParams, page, paginate
+from routers.auth import get_current_principal
 
 router = APIRouter(prefix="/chat", tags=["Chat"])
 
+logger = logging.getLogger(__name__)
+
 # --- WebSocket Manager ---
+# Messages for a room go through the broker so sockets held by other worker
+# processes receive them too. Each socket has its own bounded send queue and
+# sender task: a slow client only delays itself, and is dropped once its
+# queue overflows or a send stalls.
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "64"))
+CHAT_SEND_TIMEOUT = float(os.getenv("CHAT_SEND_TIMEOUT", "5"))
+
+# Close code sent to evicted slow consumers ("Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+class Connection:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=queue_size)
+        self.sender: Optional[asyncio.Task] = None
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {} # order_id: [websockets]
+    def __init__(self, broker: Broker, prefix: str = "chat", queue_size: int = CHAT_SEND_QUEUE_SIZE, send_timeout: float = CHAT_SEND_TIMEOUT):
+        self.broker = broker
+        self.prefix = prefix
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.active_connections: Dict[int, Dict[WebSocket, Connection]] = {} # room_id: {websocket: connection}
+        self.evicted = 0
+        self._evictions: set = set()
 
-    async def connect(self, websocket: WebSocket, order_id: int):
+    def _channel(self, room_id: int) -> str:
+        return f"{self.prefix}:{room_id}"
+
+    def connection_count(self) -> int:
+        # Sockets open on this worker
+        return sum(len(room) for room in list(self.active_connections.values()))
+
+    async def connect(self, websocket: WebSocket, room_id: int):
         await websocket.accept()
-        if order_id not in self.active_connections:
-            self.active_connections[order_id] = []
-        self.active_connections[order_id].append(websocket)
+        conn = Connection(websocket, self.queue_size)
+        conn.sender = asyncio.create_task(self._send_loop(conn, room_id))
+        room = self.active_connections.setdefault(room_id, {})
+        room[websocket] = conn
+        if len(room) == 1:
+            await self.broker.subscribe(self._channel(room_id), self._on_message)
+
+    async def disconnect(self, websocket: WebSocket, room_id: int):
+        room = self.active_connections.get(room_id)
+        conn = room.pop(websocket, None) if room else None
+        if conn is None:
+            return
+        if conn.sender is not asyncio.current_task():
+            conn.sender.cancel()
+            await asyncio.gather(conn.sender, return_exceptions=True)
+        if not room:
+            del self.active_connections[room_id]
+            await self.broker.unsubscribe(self._channel(room_id), self._on_message)
+
+    async def broadcast(self, message: str, room_id: int):
+        # Delivered to every socket in the room, on every worker
+        await self.broker.publish(self._channel(room_id), message)
 
-    def disconnect(self, websocket: WebSocket, order_id: int):
-        if order_id in self.active_connections:
-            self.active_connections[order_id].remove(websocket)
-            if not self.active_connections[order_id]:
-                del self.active_connections[order_id]
+    def send(self, websocket: WebSocket, room_id: int, message: str):
+        # Queue a message for one socket only, behind anything already queued for it
+        conn = self.active_connections.get(room_id, {}).get(websocket)
+        if conn is not None:
+            try:
+                conn.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+    def _on_message(self, channel: str, message: str):
+        room_id = int(channel.rsplit(":", 1)[1])
+        for conn in list(self.active_connections.get(room_id, {}).values()):
+            try:
+                conn.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                task = asyncio.create_task(self._evict(conn, room_id))
+                self._evictions.add(task)
+                task.add_done_callback(self._evictions.discard)
+
+    async def _send_loop(self, conn: Connection, room_id: int):
+        try:
+            while True:
+                message = await conn.queue.get()
+                async with asyncio.timeout(self.send_timeout):
+                    await conn.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Stalled or broken socket
+            await self._evict(conn, room_id)
 
-    async def broadcast(self, message: str, order_id: int):
-        if order_id in self.active_connections:
-            for connection in self.active_connections[order_id]:
-                await connection.send_text(message)
+    async def _evict(self, conn: Connection, room_id: int):
+        if self.active_connections.get(room_id, {}).get(conn.websocket) is not conn:
+            return
+        self.evicted += 1
+        await self.disconnect(conn.websocket, room_id)
+        try:
+            await asyncio.wait_for(conn.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE), self.send_timeout)
+        except Exception:
+            pass
+
+manager = ConnectionManager(broker)
+
+# Messages are broadcast as soon as they arrive and persisted in batches
+writer = MessageWriter()
+
+async def ingest_message(order_id: int, sender_id: int, data: str) -> dict:
+    try:
+        msg_in = json.loads(data)
+        content = msg_in.get("content")
+        msg_type = msg_in.get("type", "text")
+    except (ValueError, AttributeError):
+        content = data
+        msg_type = "text"
 
-manager = ConnectionManager()
+    message = new_message(order_id, sender_id, content, msg_type)
+    # Returns at once, or after the batch commits with CHAT_DURABILITY=group
+    await writer.submit(message)
+    await manager.broadcast(json.dumps({
+        "uid": message["uid"],
+        "content": message["content"],
+        "sender_id": message["sender_id"],
+        "message_type": message["message_type"],
+        "created_at": str(message["created_at"])
+    }), order_id)
+    return message
 
 # --- Endpoints ---
 
-@router.get("/{order_id}", response_model=List[schemas.MessageOut])
-def get_chat_history(order_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+@router.get("/{order_id}", response_model=schemas.Page[schemas.MessageOut])
+async def get_chat_history(
+    order_id: int,
+    params: PageParams = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Principal = Depends(get_current_principal)
+):
     # Verify access
-    order = db.query(models.Order).filter(models.Order.id == order_id).first()
+    order = await db.get(models.Order, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     if current_user.id != order.customer_id and current_user.id != order.driver_id:
         raise HTTPException(status_code=403, detail="Not allowed")
 
-    return order.messages
+    # Latest messages first; the page itself reads oldest to newest like the chat window
+    messages = (await db.scalars(paginate(
+        select(models.Message).where(models.Message.order_id == order_id),
+        models.Message.created_at, models.Message.id, params
+    ))).all()
+    return page(list(messages), params, newest_first=False)
 
 @router.websocket("/ws/{order_id}/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, order_id: int, user_id: int, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, order_id: int, user_id: int):
     # Note: WebSocket cannot easily use Depends(get_current_user) with headers, usually done via query param token
     # For simplicity here, we trust the connection or validate token manually if passed in query
     await manager.connect(websocket, order_id)
     try:
         while True:
             data = await websocket.receive_text()
-            import json
             try:
-                msg_in = json.loads(data)
-                content = msg_in.get("content")
-                msg_type = msg_in.get("type", "text")
-            except:
-                content = data
-                msg_type = "text"
-
-            # Save to DB
-            message = models.Message(
-                order_id=order_id,
-                sender_id=user_id,
-                content=content,
-                message_type=msg_type
-            )
-            db.add(message)
-            db.commit()
-            db.refresh(message)
-            
-            # Broadcast
-            msg_data = json.dumps({
-                "id": message.id,
-                "content": message.content,
-                "sender_id": message.sender_id,
-                "message_type": message.message_type,
-                "created_at": str(message.created_at)
-            })
-            await manager.broadcast(msg_data, order_id)
+                await ingest_message(order_id, user_id, data)
+            except Exception:
+                logger.exception("Chat message for order %s not saved", order_id)
+                await websocket.send_text(json.dumps({"error": "Message not saved"}))
     except WebSocketDisconnect:
-        manager.disconnect(websocket, order_id)
+        pass
+    finally:
+        await manager.disconnect(websocket, order_id)
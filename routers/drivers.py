@@ -1,150 +1,164 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
 from typing import List
-import models, schemas
-from database import get_db
-from routers.auth import get_current_user
+import math
+import models, schemas, geo, geofence, live_locations, driver_stats, realtime, http_cache
+from database import get_async_db
+from routers.auth import get_current_principal
 
 router = APIRouter(prefix="/drivers", tags=["Drivers"])
 
+async def _get_profile(db: AsyncSession, user_id: int) -> models.DriverProfile:
+    profile = await db.scalar(select(models.DriverProfile).where(models.DriverProfile.user_id == user_id))
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+def _invalidate_profile(user_id: int):
+    # Anything a driver list or profile view shows changed
+    http_cache.invalidate("nearby", f"profile:{user_id}")
+
 @router.get("/profile", response_model=schemas.DriverProfileOut)
-def get_my_profile(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_my_profile(request: Request, current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
     if current_user.role != models.UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Not a driver")
     
-    profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == current_user.id).first()
-    if not profile:
-        raise HTTPException(status_code=404, detail="Profile not found")
-    
-    profile.driver_name = current_user.full_name
-    return profile
+    # The stored profile is cached; the live position is laid over it per request
+    cache_key = http_cache.key(f"profile:{current_user.id}")
+    entry = http_cache.entries.get(cache_key)
+    if entry is None:
+        profile = await _get_profile(db, current_user.id)
+        profile.driver_name = current_user.full_name
+        entry = schemas.DriverProfileOut.model_validate(profile).model_dump(mode="json")
+        http_cache.entries.set(cache_key, entry, ttl=http_cache.PROFILE_CACHE_TTL)
+    fix = live_locations.store.get(current_user.id)
+    if fix:
+        entry = {**entry, "current_lat": fix.lat, "current_lng": fix.lng}
+    return http_cache.respond(request, http_cache.encode(entry), "private, no-cache")
 
 @router.put("/profile", response_model=schemas.DriverProfileOut)
-def update_profile(
+async def update_profile(
     profile_update: schemas.DriverProfileCreate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role != models.UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Not a driver")
     
-    profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == current_user.id).first()
+    profile = await _get_profile(db, current_user.id)
     
     profile.truck_type = profile_update.truck_type
     profile.capacity = profile_update.capacity
     profile.price = profile_update.price
     
-    db.commit()
-    db.refresh(profile)
+    await db.commit()
+    _invalidate_profile(current_user.id)
+    await db.refresh(profile)
     return profile
 
 @router.post("/status", response_model=schemas.DriverProfileOut)
-def toggle_status(
+async def toggle_status(
     is_available: bool,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role != models.UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Not a driver")
         
-    profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == current_user.id).first()
+    profile = await _get_profile(db, current_user.id)
     profile.is_available = is_available
-    db.commit()
-    db.refresh(profile)
+    # Online time is rolled up per day when a session ends
+    now = datetime.utcnow()
+    if is_available and profile.online_since is None:
+        profile.online_since = now
+    elif not is_available and profile.online_since is not None:
+        await driver_stats.record_online(db, current_user.id, profile.online_since, now)
+        profile.online_since = None
+    await db.commit()
+    _invalidate_profile(current_user.id)
+    await db.refresh(profile)
     return profile
 
 @router.post("/location")
-def update_location(
+async def update_location(
     location: schemas.LocationUpdate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role != models.UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Not a driver")
         
-    profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == current_user.id).first()
-    profile.current_lat = location.lat
-    profile.current_lng = location.lng
-    
-    profile.current_lat = location.lat
-    profile.current_lng = location.lng
-    db.commit()
+    # Held in the live store, written to driver_profiles in periodic batches.
+    # Pings that arrive too fast are refused, ones that barely moved are merged
+    # into the stored fix and skip the order lookup below.
+    result = live_locations.ingest.offer(current_user.id, location.lat, location.lng)
+    if result.outcome == live_locations.REJECTED:
+        raise HTTPException(
+            status_code=429,
+            detail="Location updates too frequent",
+            headers={"Retry-After": str(math.ceil(result.retry_after))}
+        )
+    if result.outcome == live_locations.COALESCED:
+        return {"status": "coalesced", "interval": result.retry_after}
 
-    # --- Proximity Check ---
     # Find active order
-    active_order = db.query(models.Order).filter(
+    active_order = await db.scalar(select(models.Order).where(
         models.Order.driver_id == current_user.id,
-        models.Order.status == models.OrderStatus.EN_ROUTE
-    ).first()
-
-    if active_order and active_order.delivery_lat and active_order.delivery_lng:
-        try:
-            from math import radians, cos, sin, asin, sqrt
-            
-            # Haversine formula
-            lon1, lat1, lon2, lat2 = map(radians, [location.lng, location.lat, active_order.delivery_lng, active_order.delivery_lat])
-            dlon = lon2 - lon1 
-            dlat = lat2 - lat1 
-            a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-            c = 2 * asin(sqrt(a)) 
-            r = 6371 # Radius of earth in kilometers
-            distance_km = c * r
-            
-            if distance_km < 0.5: # Less than 500 meters
-                # Check if we should notify (maybe add a field 'proximity_alert_sent' to order to avoid spam? 
-                # For MVP, let's just log or send. To avoid spam, we really should track it.
-                # Since I cannot easily add columns without migration steps in this env, I will skip persistent de-duplication 
-                # OR I can use a cache. But let's just send it. The User might find it annoying if it spans, 
-                # but "Mandatory Notifications" suggests they want it. 
-                # I'll just send it.
-                from routers.notifications import send_notification_to_user
-                send_notification_to_user(current_user.id, "اقتربت من الوجهة", "أنت على بعد أقل من 500 متر من العميل", db)
-
-        except Exception as e:
-            print(f"Proximity calc error: {e}")
-
-    return {"status": "updated"}
+        models.Order.status.in_([models.OrderStatus.ACCEPTED, models.OrderStatus.EN_ROUTE])
+    ).limit(1))
+
+    # Live position for the customer's event stream (throttled, delta-encoded)
+    if active_order:
+        await realtime.driver_location(active_order.id, current_user.id, active_order.customer_id, location.lat, location.lng)
+
+    # Approach / arrival alerts are evaluated in batches by the geofence engine
+    if active_order and active_order.status == models.OrderStatus.EN_ROUTE:
+        geofence.engine.submit(current_user.id, location.lat, location.lng)
+
+    return {"status": "updated", "interval": result.retry_after}
 
 @router.get("/nearby", response_model=List[schemas.DriverProfileOut])
-def get_nearby_drivers(lat: float, lng: float, db: Session = Depends(get_db)):
-    # Simple bounding box or just return all available for MVP
-    # Returning all available drivers
-    drivers = db.query(models.DriverProfile).all()
-    
+async def get_nearby_drivers(
+    request: Request,
+    lat: float,
+    lng: float,
+    radius_km: float = Query(25.0, gt=0, le=500),
+    limit: int = Query(50, ge=1, le=200),
+    available_only: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Searches are rounded to the center of their geohash cell, so every map
+    # refresh from around the same spot shares one cached result
+    cell = geo.encode(lat, lng, http_cache.NEARBY_CACHE_PRECISION)
+    cache_key = http_cache.key("nearby", cell, radius_km, limit, available_only)
+    cache_control = f"public, max-age={int(http_cache.NEARBY_CACHE_TTL)}"
+    response = http_cache.cached(request, cache_key, cache_control)
+    if response is not None:
+        return response
+    lat_lo, lat_hi, lng_lo, lng_hi = geo.decode_bounds(cell)
+
+    # Geohash-indexed proximity search, closest first
+    nearby = await geo.nearby_profiles(
+        db, (lat_lo + lat_hi) / 2, (lng_lo + lng_hi) / 2, radius_km, limit, available_only, live=live_locations.store
+    )
+
     # Enrich with names
     results = []
-    for d in drivers:
+    for d, distance_km in nearby:
         d.driver_name = d.user.full_name
         d.phone_number = d.user.phone
-        results.append(d)
-        
-    return results
+        d.distance_km = round(distance_km, 3)
+        results.append(schemas.DriverProfileOut.model_validate(d))
+
+    return http_cache.store(request, cache_key, results, cache_control, http_cache.NEARBY_CACHE_TTL)
 
 @router.get("/stats", response_model=schemas.DriverStatsOut)
-def get_driver_stats(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_driver_stats(current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
     if current_user.role != models.UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Not a driver")
     
-    # Calculate stats (simplified)
-    # Orders today (naive, ignoring timezone properly for now, just UTC date)
-    from datetime import date
-    today = datetime.utcnow().date()
-    
-    orders = db.query(models.Order).filter(
-        models.Order.driver_id == current_user.id,
-        models.Order.status == models.OrderStatus.COMPLETED
-    ).all()
-    
-    # Filter in python for date
-    orders_today = [o for o in orders if o.created_at.date() == today]
-    earnings = sum(o.amount for o in orders_today)
-    
-    # Get profile for rating
-    profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == current_user.id).first()
-    
-    return {
-        "orders_today": len(orders_today),
-        "earnings_today": earnings,
-        "total_rating": profile.average_rating if profile else 0.0,
-        "hours_online": 0.0 # Placeholder
-    }
+    # Today's (UTC) row of the daily rollup plus the open online session, if any
+    profile = await _get_profile(db, current_user.id)
+    return await driver_stats.today(db, profile)
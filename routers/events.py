@@ -0,0 +1,45 @@
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+import realtime, schemas
+from broker import broker
+from database import AsyncSessionLocal
+from routers.auth import get_current_principal
+from routers.chat import ConnectionManager
+from routers.orders import get_active_order
+
+router = APIRouter(prefix="/events", tags=["Events"])
+
+# Close code for a missing or invalid token ("Policy Violation")
+AUTH_FAILED_CLOSE_CODE = 1008
+
+# One room per user: everything published on realtime.channel(user_id) goes to
+# all of that user's sockets, on every worker
+manager = ConnectionManager(broker, prefix=realtime.EVENTS_PREFIX)
+
+@router.websocket("/ws")
+async def events_websocket(websocket: WebSocket, token: str = ""):
+    # Browsers cannot set headers on a WebSocket, so the access token comes as ?token=
+    try:
+        principal = await get_current_principal(token)
+    except HTTPException:
+        await websocket.close(code=AUTH_FAILED_CLOSE_CODE)
+        return
+
+    await manager.connect(websocket, principal.id)
+    try:
+        # Current state first, so the client needs no separate GET /orders/active
+        async with AsyncSessionLocal() as db:
+            order = await get_active_order(current_user=principal, db=db)
+            snapshot = {"order": schemas.OrderOut.model_validate(order).model_dump(mode="json") if order else None}
+        if order and order.driver_id and getattr(order, "driver_lat", None) is not None and principal.id == order.customer_id:
+            location = realtime.location_throttle.keyframe(order.driver_id, principal.id, order.driver_lat, order.driver_lng)
+            location["order_id"] = order.id
+            snapshot["driver_location"] = location
+        manager.send(websocket, principal.id, realtime.encode("snapshot", snapshot))
+
+        # Server-to-client only; incoming frames just keep the connection alive
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await manager.disconnect(websocket, principal.id)
@@ -1,12 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi import APIRouter, Depends, HTTPException, Body, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import List, Optional
-import models, schemas
-from database import get_db
-from routers.auth import get_current_user
-from pywebpush import webpush, WebPushException
-import logging
-import json
+import models, schemas, realtime, http_cache
+from database import get_db, get_async_db
+from pagination import PageParams, page, paginate
+from routers.auth import get_current_principal
+import threading
+from push_queue import PushDispatcher, PushError
 
 router = APIRouter(prefix="/notifications", tags=["Notifications"])
 
@@ -14,12 +16,16 @@ router = APIRouter(prefix="/notifications", tags=["Notifications"])
 VAPID_PRIVATE_KEY = "Z6aNQAJl07qi8ZXtmij0kvwfEJ2bpe54bnOgP7KF9DI"
 VAPID_CLAIMS = {"sub": "mailto:admin@example.com"}
 
+VAPID_PUBLIC_KEY = "BO_BbvrccfZ0z9DD5T1sGIhE8uPloM9-HwXgucungbLUSYwIbiC29ll-j9VSPlTFV-u32RipoRw3TYYF20IBbl8"
+_public_key_body = http_cache.encode({"publicKey": VAPID_PUBLIC_KEY})
+
 @router.get("/public_key")
-def get_public_key():
-    return {"publicKey": "BO_BbvrccfZ0z9DD5T1sGIhE8uPloM9-HwXgucungbLUSYwIbiC29ll-j9VSPlTFV-u32RipoRw3TYYF20IBbl8"}
+def get_public_key(request: Request):
+    # Fixed for the life of the deployment; clients revalidate once a day
+    return http_cache.respond(request, _public_key_body, "public, max-age=86400")
 
 @router.post("/subscribe")
-def subscribe(subscription: dict = Body(...), db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def subscribe(subscription: dict = Body(...), db: Session = Depends(get_db), current_user: schemas.Principal = Depends(get_current_principal)):
     # Check if exists
     existing = db.query(models.NotificationSubscription).filter(
         models.NotificationSubscription.user_id == current_user.id,
@@ -39,29 +45,56 @@ def subscribe(subscription: dict = Body(...), db: Session = Depends(get_db), cur
     
     return {"status": "success"}
 
-def send_notification_to_user(user_id: int, title: str, body: str, db: Session):
-    # 1. Save to database (in-app history)
-    notif = models.Notification(user_id=user_id, title=title, body=body)
-    db.add(notif)
-    db.commit()
+@router.get("/", response_model=schemas.Page[schemas.NotificationOut])
+async def list_notifications(
+    params: PageParams = Depends(),
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # In-app history written by the push dispatcher, newest first
+    notifications = (await db.scalars(paginate(
+        select(models.Notification).where(models.Notification.user_id == current_user.id),
+        models.Notification.created_at, models.Notification.id, params
+    ))).all()
+    return page(list(notifications), params)
+
+# One keep-alive HTTP session per delivery thread (requests.Session is not thread-safe)
+_http = threading.local()
+
+def _webpush_sender(subscription_info: dict, data: str):
+    # pywebpush (with requests, aiohttp and its crypto stack) is imported by
+    # the first delivery rather than on every worker boot
+    from pywebpush import webpush, WebPushException
+    import requests
+
+    session = getattr(_http, "session", None)
+    if session is None:
+        session = _http.session = requests.Session()
+    try:
+        webpush(
+            subscription_info=subscription_info,
+            data=data,
+            vapid_private_key=VAPID_PRIVATE_KEY,
+            vapid_claims=dict(VAPID_CLAIMS),
+            timeout=10,
+            requests_session=session
+        )
+    except WebPushException as ex:
+        status_code = ex.response.status_code if ex.response is not None else None
+        raise PushError(status_code, str(ex))
+
+def _publish_created(notification: dict):
+    # Runs on the dispatcher's batcher thread
+    realtime.publish_nowait(notification["user_id"], "notification.created", {
+        "id": notification["id"],
+        "title": notification["title"],
+        "body": notification["body"],
+        "created_at": notification["created_at"].isoformat(),
+    })
+
+# Background delivery: started with the app, request handlers only enqueue
+dispatcher = PushDispatcher(sender=_webpush_sender, on_saved=_publish_created)
 
-    # 2. Send Push
-    subs = db.query(models.NotificationSubscription).filter(models.NotificationSubscription.user_id == user_id).all()
-    for sub in subs:
-        try:
-            subscription_info = {
-                "endpoint": sub.endpoint,
-                "keys": {
-                    "p256dh": sub.p256dh,
-                    "auth": sub.auth
-                }
-            }
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps({"title": title, "body": body}),
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims=VAPID_CLAIMS
-            )
-        except WebPushException as ex:
-            logging.error(f"Push failed for user {user_id}: {ex}")
-            # Optionally remove invalid subscription here
+def send_notification_to_user(user_id: int, title: str, body: str):
+    # Saved to the in-app history and pushed to every subscription by the dispatcher
+    dispatcher.enqueue(user_id, title, body)
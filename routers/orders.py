@@ -1,32 +1,65 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
 from typing import List, Optional
-import models, schemas
-from database import get_db
-from routers.auth import get_current_user
+import logging
+import models, schemas, dispatch, geofence, live_locations, driver_stats, realtime, transitions
+from database import get_async_db
+from pagination import PageParams, page, paginate
+from routers.auth import get_current_principal
 
 router = APIRouter(prefix="/orders", tags=["Orders"])
 
+logger = logging.getLogger(__name__)
+
 @router.post("/", response_model=schemas.OrderOut)
-def create_order(
+async def create_order(
     order: schemas.OrderCreate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role != models.UserRole.CUSTOMER:
         raise HTTPException(status_code=403, detail="Only customers can order")
+
+    amount = order.amount
+    if order.driver_id is not None:
+        # Booking a specific driver: they must be free and big enough. The
+        # checks only give the usual answer early; ix_orders_open_driver is what
+        # keeps two concurrent bookings from both getting through
+        profile = await db.scalar(select(models.DriverProfile).where(models.DriverProfile.user_id == order.driver_id))
+        if not profile:
+            raise HTTPException(status_code=404, detail="Driver not found")
+        if not profile.is_available or await dispatch.driver_is_busy(db, order.driver_id):
+            raise HTTPException(status_code=409, detail="Driver is not available")
+        if order.liters and (profile.capacity or 0) < order.liters:
+            raise HTTPException(status_code=409, detail="Driver capacity too small")
+        if amount is None:
+            amount = profile.price
         
     new_order = models.Order(
         customer_id=current_user.id,
         driver_id=order.driver_id,
-        amount=order.amount,
+        amount=amount,
+        liters=order.liters,
         delivery_lat=order.delivery_lat,
         delivery_lng=order.delivery_lng,
         delivery_address=order.delivery_address
     )
     db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Driver is not available")
+    await db.refresh(new_order)
+    await _publish_status(new_order)
+
+    if order.driver_id is None:
+        # Dispatch mode: offered to the best available driver, who is notified then
+        dispatch.engine.wake()
+        return new_order
     
     # Send notification to driver
     try:
@@ -34,90 +67,203 @@ def create_order(
         send_notification_to_user(
             order.driver_id,
             "طلب جديد!",
-            f"لديك طلب جديد من {current_user.full_name} بقيمة {order.amount} د.ل",
-            db
+            f"لديك طلب جديد من {current_user.full_name} بقيمة {amount} د.ل"
         )
-    except Exception as e:
-        print(f"Notification error: {e}")
+    except Exception:
+        logger.exception("Notification error")
     
     return new_order
 
-@router.get("/my", response_model=List[schemas.OrderOut])
-def get_my_orders(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def _publish_status(order: models.Order):
+    # order.status_changed to both parties' event streams
+    data = {"order_id": order.id, "status": order.status}
+    for user_id in {order.customer_id, order.driver_id} - {None}:
+        await realtime.publish(user_id, "order.status_changed", data)
+
+@router.get("/my", response_model=schemas.Page[schemas.OrderOut])
+async def get_my_orders(
+    params: PageParams = Depends(),
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Counterpart's name comes from the same query, not one lazy load per order
     if current_user.role == models.UserRole.DRIVER:
-        orders = db.query(models.Order).filter(models.Order.driver_id == current_user.id).all()
-        # Enrich
-        for o in orders:
-             o.customer_name = o.customer.full_name
+        rows = await db.execute(paginate(
+            select(models.Order, models.User.full_name)
+            .outerjoin(models.User, models.User.id == models.Order.customer_id)
+            .where(models.Order.driver_id == current_user.id),
+            models.Order.created_at, models.Order.id, params
+        ))
+        orders = []
+        for o, name in rows:
+            o.customer_name = name
+            orders.append(o)
     else:
-        orders = db.query(models.Order).filter(models.Order.customer_id == current_user.id).all()
-        # Enrich
-        for o in orders:
-            o.driver_name = o.driver.full_name
+        rows = await db.execute(paginate(
+            select(models.Order, models.User.full_name)
+            .outerjoin(models.User, models.User.id == models.Order.driver_id)
+            .where(models.Order.customer_id == current_user.id),
+            models.Order.created_at, models.Order.id, params
+        ))
+        orders = []
+        for o, name in rows:
+            o.driver_name = name
+            orders.append(o)
             
-    return orders
+    return page(orders, params)
 
 @router.get("/active", response_model=Optional[schemas.OrderOut])
-def get_active_order(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_active_order(current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
     # Find active order (not completed or cancelled)
     statuses = [models.OrderStatus.PENDING, models.OrderStatus.ACCEPTED, models.OrderStatus.EN_ROUTE]
     
     if current_user.role == models.UserRole.CUSTOMER:
-        order = db.query(models.Order).filter(
-            models.Order.customer_id == current_user.id,
-            models.Order.status.in_(statuses)
-        ).first()
-        if order:
-             order.driver_name = order.driver.full_name
+        # Order, driver name and truck position in one round-trip
+        row = (await db.execute(
+            select(
+                models.Order,
+                models.User.full_name,
+                models.DriverProfile.current_lat,
+                models.DriverProfile.current_lng,
+                models.DriverProfile.capacity,
+            )
+            .outerjoin(models.User, models.User.id == models.Order.driver_id)
+            .outerjoin(models.DriverProfile, models.DriverProfile.user_id == models.Order.driver_id)
+            .where(
+                models.Order.customer_id == current_user.id,
+                models.Order.status.in_(statuses)
+            )
+            .limit(1)
+        )).first()
+        order = None
+        if row:
+             order, driver_name, driver_lat, driver_lng, driver_capacity = row
+             order.driver_name = driver_name
+             order.driver_lat = driver_lat
+             order.driver_lng = driver_lng
+             order.driver_capacity = driver_capacity
              if order.driver_id:
-                 profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == order.driver_id).first()
-                 if profile:
-                     order.driver_lat = profile.current_lat
-                     order.driver_lng = profile.current_lng
-                     order.driver_capacity = profile.capacity
+                 fix = live_locations.store.get(order.driver_id)
+                 if fix:
+                     order.driver_lat = fix.lat
+                     order.driver_lng = fix.lng
     else:
         # For driver
-        order = db.query(models.Order).filter(
-            models.Order.driver_id == current_user.id,
-            models.Order.status.in_(statuses)
-        ).first()
-        if order:
-            order.customer_name = order.customer.full_name
+        row = (await db.execute(
+            select(models.Order, models.User.full_name)
+            .outerjoin(models.User, models.User.id == models.Order.customer_id)
+            .where(
+                models.Order.driver_id == current_user.id,
+                models.Order.status.in_(statuses)
+            )
+            .limit(1)
+        )).first()
+        order = None
+        if row:
+            order, customer_name = row
+            order.customer_name = customer_name
             
     return order
 
+@router.get("/offers", response_model=List[schemas.OfferOut])
+async def get_my_offers(current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
+    # Dispatched orders currently offered to this driver (at most one)
+    if current_user.role != models.UserRole.DRIVER:
+        raise HTTPException(status_code=403, detail="Not a driver")
+    rows = await db.execute(
+        select(models.OrderOffer, models.Order.liters, models.Order.delivery_lat, models.Order.delivery_lng, models.Order.delivery_address)
+        .join(models.Order, models.Order.id == models.OrderOffer.order_id)
+        .where(
+            models.OrderOffer.driver_id == current_user.id,
+            models.OrderOffer.status == models.OfferStatus.OFFERED,
+            models.OrderOffer.expires_at > datetime.utcnow()
+        )
+    )
+    offers = []
+    for offer, liters, lat, lng, address in rows:
+        offer.liters, offer.delivery_lat, offer.delivery_lng, offer.delivery_address = liters, lat, lng, address
+        offers.append(offer)
+    return offers
+
+@router.post("/{order_id}/accept", response_model=schemas.OrderOut)
+async def accept_offer(order_id: int, current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
+    if current_user.role != models.UserRole.DRIVER:
+        raise HTTPException(status_code=403, detail="Not a driver")
+    order = await dispatch.accept(db, order_id, current_user.id)
+    if order is None:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Offer is no longer available")
+    await db.commit()
+    await _publish_status(order)
+
+    from routers.notifications import send_notification_to_user
+    send_notification_to_user(order.customer_id, "تم قبول طلبك", f"{current_user.full_name} في الطريق إليك قريباً")
+    return order
+
+@router.post("/{order_id}/decline")
+async def decline_offer(order_id: int, current_user: schemas.Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
+    if current_user.role != models.UserRole.DRIVER:
+        raise HTTPException(status_code=403, detail="Not a driver")
+    if not await dispatch.decline(db, order_id, current_user.id):
+        raise HTTPException(status_code=409, detail="Offer is no longer available")
+    await db.commit()
+    # Offer it to the next driver right away
+    dispatch.engine.wake()
+    return {"status": "declined"}
+
 @router.put("/{order_id}/status")
-def update_order_status(
+async def update_order_status(
     order_id: int,
     status_update: schemas.OrderStatusUpdate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    order = db.query(models.Order).filter(models.Order.id == order_id).first()
+    order = await db.get(models.Order, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
         
-    # Verify permission
+    # Verify permission: only the order's own parties
     if current_user.role == models.UserRole.DRIVER and order.driver_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not your order")
     if current_user.role == models.UserRole.CUSTOMER and order.customer_id != current_user.id:
-        # Customers can only cancel
-        if status_update.status != models.OrderStatus.CANCELLED:
-             raise HTTPException(status_code=403, detail="Customers can only cancel")
-             
-    order.status = status_update.status
-    db.commit()
+        raise HTTPException(status_code=403, detail="Not your order")
+
+    target = status_update.status
+    if not transitions.allowed(order.status, target, current_user.role):
+        raise HTTPException(status_code=409, detail=f"Cannot change order from {order.status} to {target.value}")
+    if status_update.version is not None and status_update.version != order.version:
+        raise HTTPException(status_code=409, detail="Order was modified, reload it")
+
+    # One conditional UPDATE on (status, version): of concurrent requests
+    # from the same state only the first one matches, the rest get a 409
+    values = {}
+    if target == models.OrderStatus.COMPLETED:
+        values["completed_at"] = datetime.utcnow()
+    version = await transitions.apply(db, order.id, order.status, target, order.version, values)
+    if version is None:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Order was modified, reload it")
+    if target == models.OrderStatus.COMPLETED and order.driver_id:
+        # Count it towards the driver's daily totals in the same transaction
+        await driver_stats.record_completed_order(db, order.driver_id, order.amount, values["completed_at"])
+    if target == models.OrderStatus.CANCELLED:
+        await dispatch.withdraw(db, order.id)
+    await db.commit()
+    await _publish_status(order)
+    if order.driver_id:
+        # Fences follow the driver's en-route order
+        geofence.engine.forget(order.driver_id)
 
     # --- Trigger Notification ---
     from routers.notifications import send_notification_to_user
     
     # Notify Customer
     if current_user.role == models.UserRole.DRIVER:
-        msg = f"تم تحديث حالة طلبك إلى: {status_update.status}"
-        send_notification_to_user(order.customer_id, "تحديث الطلب", msg, db)
+        msg = f"تم تحديث حالة طلبك إلى: {target.value}"
+        send_notification_to_user(order.customer_id, "تحديث الطلب", msg)
     
     # Notify Driver (if customer cancels)
-    elif current_user.role == models.UserRole.CUSTOMER and status_update.status == models.OrderStatus.CANCELLED:
-        send_notification_to_user(order.driver_id, "إلغاء الطلب", "قام العميل بإلغاء الطلب", db)
+    elif current_user.role == models.UserRole.CUSTOMER and target == models.OrderStatus.CANCELLED and order.driver_id:
+        send_notification_to_user(order.driver_id, "إلغاء الطلب", "قام العميل بإلغاء الطلب")
 
-    return {"status": "updated"}
+    return {"status": "updated", "version": version}
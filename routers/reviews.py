@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
-import models, schemas
+import http_cache, models, ratings, schemas
 from database import get_db
-from routers.auth import get_current_user
+from pagination import PageParams, page, paginate
+from routers.auth import get_current_principal
 
 router = APIRouter(prefix="/reviews", tags=["Reviews"])
 
@@ -11,7 +13,7 @@ router = APIRouter(prefix="/reviews", tags=["Reviews"])
 def create_review(
     order_id: int,
     review: schemas.ReviewCreate,
-    current_user: models.User = Depends(get_current_user),
+    current_user: schemas.Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
     # 1. Check if order exists
@@ -27,11 +29,7 @@ def create_review(
     if order.status != models.OrderStatus.COMPLETED:
         raise HTTPException(status_code=400, detail="Order must be completed to review")
 
-    # 4. Check if already reviewed
-    if db.query(models.Review).filter(models.Review.order_id == order_id).first():
-        raise HTTPException(status_code=400, detail="Already reviewed")
-
-    # 5. Create Review
+    # 4. Create Review (UNIQUE(order_id) turns a second one away, even when both race)
     new_review = models.Review(
         order_id=order_id,
         driver_id=order.driver_id,
@@ -39,20 +37,19 @@ def create_review(
         comment=review.comment
     )
     db.add(new_review)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Already reviewed")
     
-    # 6. Update Driver's Average Rating
-    driver_profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == order.driver_id).first()
-    if driver_profile:
-        # Calculate new average
-        # (old_avg * old_count + new_rating) / (old_count + 1)
-        current_total = driver_profile.average_rating * driver_profile.rating_count
-        driver_profile.rating_count += 1
-        driver_profile.average_rating = (current_total + review.rating) / driver_profile.rating_count
+    # 5. Add it to the driver's rating aggregates in place
+    db.execute(ratings.record(order.driver_id, review.rating))
     
-    db.commit()
-    db.refresh(new_review)
-    
-    return {
+    # Read before the commit expires them: reloading afterwards would hold a
+    # connection while the response is serialized on the threadpool, which
+    # deadlocks once every thread is waiting on the pool
+    result = {
         "id": new_review.id,
         "rating": new_review.rating,
         "comment": new_review.comment,
@@ -60,17 +57,30 @@ def create_review(
         "customer_name": current_user.full_name,
         "created_at": new_review.created_at
     }
+    db.commit()
+    # The driver's review list, profile and rating in driver lists all changed
+    http_cache.invalidate(f"reviews:{result['driver_id']}", f"profile:{result['driver_id']}", "nearby")
+    return result
+
+@router.get("/driver/{driver_id}", response_model=schemas.Page[schemas.ReviewOut])
+def get_driver_reviews(request: Request, driver_id: int, params: PageParams = Depends(), db: Session = Depends(get_db)):
+    cache_key = http_cache.key(f"reviews:{driver_id}", params.limit, params.before, params.after)
+    response = http_cache.cached(request, cache_key, "public, no-cache")
+    if response is not None:
+        return response
 
-@router.get("/driver/{driver_id}", response_model=List[schemas.ReviewOut])
-def get_driver_reviews(driver_id: int, db: Session = Depends(get_db)):
-    reviews = db.query(models.Review).filter(models.Review.driver_id == driver_id).all()
+    # Customer name is reached through the order; join both instead of two lookups per review
+    rows = db.execute(paginate(
+        select(models.Review, models.User.full_name)
+        .outerjoin(models.Order, models.Order.id == models.Review.order_id)
+        .outerjoin(models.User, models.User.id == models.Order.customer_id)
+        .where(models.Review.driver_id == driver_id),
+        models.Review.created_at, models.Review.id, params
+    )).all()
     
     results = []
-    for r in reviews:
-        # Fetch customer name manually since it's via order relation
-        # Or simplistic approach:
-        customer = db.query(models.User).filter(models.User.id == r.order.customer_id).first()
-        customer_name = customer.full_name if customer else "Unknown"
+    for r, customer_name in rows:
+        customer_name = customer_name or "Unknown"
         
         results.append({
             "id": r.id,
@@ -81,4 +91,5 @@ def get_driver_reviews(driver_id: int, db: Session = Depends(get_db)):
             "created_at": r.created_at
         })
         
-    return results
+    result = schemas.Page[schemas.ReviewOut].model_validate(page(results, params, key=lambda r: (r["created_at"], r["id"])))
+    return http_cache.store(request, cache_key, result, "public, no-cache", http_cache.REVIEWS_CACHE_TTL)
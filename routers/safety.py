@@ -1,17 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-import models, schemas
+import logging
+import schemas
 from database import get_db
-from routers.auth import get_current_user
+from routers.auth import get_current_principal
 from routers.notifications import send_notification_to_user
 
 router = APIRouter(prefix="/safety", tags=["Safety"])
 
+logger = logging.getLogger(__name__)
+
 @router.post("/sos")
 def trigger_sos(
     lat: float, 
     lng: float, 
-    current_user: models.User = Depends(get_current_user),
+    current_user: schemas.Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
     # Log the SOS
@@ -19,10 +22,10 @@ def trigger_sos(
     # OR since we don't have Admin panel yet, we will just Log it and maybe notify the user "Help requested"
     
     # Send notification to User confirming
-    # send_notification_to_user(current_user.id, "تم استلام استغاثة", "تم إبلاغ فريق الدعم وسنتواصل معك فوراً", db)
+    # send_notification_to_user(current_user.id, "تم استلام استغاثة", "تم إبلاغ فريق الدعم وسنتواصل معك فوراً")
     
     # In real app: Notify Admin, Send SMS, etc.
-    # For now: Log to console
-    print(f"SOS TRIGGERED by User {current_user.id} ({current_user.full_name}) at {lat}, {lng}")
+    # For now: Log it
+    logger.warning("SOS TRIGGERED by User %s (%s) at %s, %s", current_user.id, current_user.full_name, lat, lng)
     
     return {"status": "sos_received", "message": "تم إرسال طلب الاستغاثة بنجاح"}
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, model_validator
+from typing import Generic, Optional, List, TypeVar
 from datetime import datetime
 from models import UserRole, OrderStatus
 
@@ -23,13 +23,33 @@ class UserOut(UserBase):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    expires_in: int # Access token lifetime, seconds
+    refresh_token: str
     role: str
     user_id: int
     full_name: str
 
+T = TypeVar("T")
+
+class Page(BaseModel, Generic[T]):
+    # One page of a cursor-paginated listing (see pagination.py)
+    items: List[T]
+    next_cursor: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class TokenData(BaseModel):
     phone: Optional[str] = None
 
+class Principal(BaseModel):
+    # The authenticated caller, as seen by route handlers
+    id: int
+    phone: str
+    full_name: str
+    role: str
+    is_active: bool = True
+
 # --- Driver Schemas ---
 class DriverProfileBase(BaseModel):
     truck_type: str
@@ -49,6 +69,7 @@ class DriverProfileOut(DriverProfileBase):
     rating_count: int = 0
     driver_name: Optional[str] = None # Enriched field
     phone_number: Optional[str] = None # Enriched field
+    distance_km: Optional[float] = None # Enriched field (nearby search)
 
     class Config:
         from_attributes = True
@@ -59,19 +80,27 @@ class LocationUpdate(BaseModel):
 
 # --- Order Schemas ---
 class OrderBase(BaseModel):
-    driver_id: int
-    amount: float
+    driver_id: Optional[int] = None # None while a dispatched order has no driver yet
+    amount: Optional[float] = None # Dispatched orders take the accepting driver's price
+    liters: Optional[int] = None
     delivery_lat: float
     delivery_lng: float
     delivery_address: Optional[str] = None
 
 class OrderCreate(OrderBase):
-    pass
+    # With driver_id: book that driver. Without: dispatch to the best available
+    # driver with at least `liters` capacity.
+    @model_validator(mode="after")
+    def _dispatch_needs_liters(self):
+        if self.driver_id is None and not self.liters:
+            raise ValueError("liters is required when no driver_id is given")
+        return self
 
 class OrderOut(OrderBase):
     id: int
     customer_id: int
     status: str
+    version: Optional[int] = None
     created_at: datetime
     customer_name: Optional[str] = None # Enriched
     driver_name: Optional[str] = None # Enriched
@@ -89,7 +118,22 @@ class DriverStatsOut(BaseModel):
     hours_online: float
 
 class OrderStatusUpdate(BaseModel):
+    status: OrderStatus
+    version: Optional[int] = None # When given, the update fails with 409 unless the order is still at this version
+
+class OfferOut(BaseModel):
+    id: int
+    order_id: int
     status: str
+    distance_km: Optional[float] = None
+    expires_at: datetime
+    liters: Optional[int] = None # Enriched
+    delivery_lat: Optional[float] = None # Enriched
+    delivery_lng: Optional[float] = None # Enriched
+    delivery_address: Optional[str] = None # Enriched
+
+    class Config:
+        from_attributes = True
 
 # --- Review Schemas ---
 class ReviewCreate(BaseModel):
@@ -112,6 +156,7 @@ class MessageCreate(BaseModel):
 
 class MessageOut(MessageCreate):
     id: int
+    uid: Optional[str] = None
     order_id: int
     sender_id: int
     created_at: datetime
@@ -1,29 +1,89 @@
+import hashlib
+import os
+import uuid
 from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
+from typing import Optional, Tuple
+from jose import JWTError, jwk, jwt
 from passlib.context import CryptContext
 
 # SECRET KEY should be in env var for prod, hardcoded for demo/MVP ease
-SECRET_KEY = "supersecretkey_boti_zintan_2025"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 1 week
+SECRET_KEY = os.getenv("SECRET_KEY", "supersecretkey_boti_zintan_2025")
+# Access tokens are short-lived; sessions go on through rotating refresh
+# tokens (see tokens.py), which is where the users table is consulted.
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Signing: HS256 with SECRET_KEY unless JWT_PRIVATE_KEY holds an EC P-256
+# private key (PEM, or a path to a PEM file). Tokens are then ES256 and other
+# services verify them with the public key alone (GET /auth/jwks).
+def _load_private_key(value: Optional[str]) -> Optional[str]:
+    if value and not value.lstrip().startswith("-----BEGIN"):
+        with open(value) as f:
+            value = f.read()
+    return value or None
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def _public_pem(private_pem: str) -> str:
+    from cryptography.hazmat.primitives import serialization
+    key = serialization.load_pem_private_key(private_pem.encode(), password=None)
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
 
-def get_password_hash(password):
+_private_key = _load_private_key(os.getenv("JWT_PRIVATE_KEY"))
+if _private_key:
+    ALGORITHM = "ES256"
+    SIGNING_KEY = _private_key
+    VERIFY_KEY = _public_pem(_private_key)
+    KEY_ID = hashlib.sha256(VERIFY_KEY.encode()).hexdigest()[:16]
+else:
+    ALGORITHM = "HS256"
+    SIGNING_KEY = VERIFY_KEY = SECRET_KEY
+    KEY_ID = None
+
+# bcrypt cost (log2 of the iterations). Hashes made with another cost are
+# re-hashed on the next successful login (verify_and_update).
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# These are CPU-bound (tens to hundreds of ms each); request handlers go
+# through hashing.pool instead of calling them directly.
+
+def _truncate(password: str) -> str:
     # Bcrypt has a 72 byte limit. We must truncate BYTES, not characters.
     # Provide a decoded string that fits in 72 bytes.
-    return pwd_context.hash(password.encode('utf-8')[:70].decode('utf-8', 'ignore'))
+    return password.encode('utf-8')[:70].decode('utf-8', 'ignore')
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(_truncate(plain_password), hashed_password)
+
+def verify_and_update(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    # (valid, new hash when the stored one uses an outdated scheme or cost)
+    return pwd_context.verify_and_update(_truncate(plain_password), hashed_password)
+
+def get_password_hash(password):
+    return pwd_context.hash(_truncate(password))
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # jti: lets a single token be revoked before it expires
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    headers = {"kid": KEY_ID} if KEY_ID else None
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM, headers=headers)
     return encoded_jwt
+
+def decode_access_token(token: str) -> dict:
+    # Raises JWTError on a bad signature or an expired token
+    return jwt.decode(token, VERIFY_KEY, algorithms=[ALGORITHM])
+
+def public_jwks() -> dict:
+    # JSON Web Key Set for verifying tokens elsewhere; empty with HS256
+    if KEY_ID is None:
+        return {"keys": []}
+    key = jwk.construct(VERIFY_KEY, ALGORITHM).to_dict()
+    key.update({"kid": KEY_ID, "use": "sig"})
+    return {"keys": [key]}
@@ -16,10 +16,62 @@ function showToast(msg, type = 'info') {
 }
 
 function logout() {
+    const refreshToken = localStorage.getItem('refreshToken');
+    if (refreshToken) {
+        // Revoke the session server-side; keepalive lets it finish during navigation
+        fetch(`${API_URL}/auth/logout`, {
+            method: 'POST',
+            keepalive: true,
+            headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${localStorage.getItem('token')}` },
+            body: JSON.stringify({ refresh_token: refreshToken })
+        }).catch(() => {});
+    }
     localStorage.clear();
     window.location.href = 'index.html';
 }
 
+// AUTHENTICATED REQUESTS
+// Access tokens live minutes; on a 401 the refresh token is traded for a new
+// pair once and the request retried. Concurrent 401s share one refresh.
+let refreshing = null;
+
+function refreshSession() {
+    if (!refreshing) {
+        const refreshToken = localStorage.getItem('refreshToken');
+        refreshing = fetch(`${API_URL}/auth/refresh`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ refresh_token: refreshToken })
+        }).then(async (res) => {
+            if (res.ok) {
+                const data = await res.json();
+                localStorage.setItem('token', data.access_token);
+                localStorage.setItem('refreshToken', data.refresh_token);
+                return true;
+            }
+            // Another tab may have rotated it first
+            return localStorage.getItem('refreshToken') !== refreshToken;
+        }).catch(() => false).finally(() => { refreshing = null; });
+    }
+    return refreshing;
+}
+
+async function authFetch(url, options = {}) {
+    const send = () => fetch(url, {
+        ...options,
+        headers: { ...(options.headers || {}), 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+    });
+    let res = await send();
+    if (res.status === 401) {
+        if (!(await refreshSession())) {
+            logout();
+            return res;
+        }
+        res = await send();
+    }
+    return res;
+}
+
 // LOGIN & REGISTER FUNCTIONS
 document.getElementById('loginForm')?.addEventListener('submit', async (e) => {
     e.preventDefault();
@@ -36,6 +88,7 @@ document.getElementById('loginForm')?.addEventListener('submit', async (e) => {
         if (res.ok) {
             const data = await res.json();
             localStorage.setItem('token', data.access_token);
+            localStorage.setItem('refreshToken', data.refresh_token);
             localStorage.setItem('role', data.role);
             localStorage.setItem('userName', data.full_name);
             localStorage.setItem('userId', data.user_id);
@@ -112,6 +165,8 @@ async function initDashboard() {
         }, 100);
     }
 
+    connectEvents();
+
     // Register service worker for notifications
     if ('serviceWorker' in navigator) {
         navigator.serviceWorker.register('/static/sw.js').then(async (registration) => {
@@ -119,9 +174,9 @@ async function initDashboard() {
                 userVisibleOnly: true,
                 applicationServerKey: urlBase64ToUint8Array(await fetch(`${API_URL}/notifications/vapid-public-key`).then(r => r.text()))
             });
-            await fetch(`${API_URL}/notifications/subscribe`, {
+            await authFetch(`${API_URL}/notifications/subscribe`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+                headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify(subscription)
             });
         }).catch(err => console.log('SW registration failed:', err));
@@ -169,11 +224,8 @@ function initMap() {
 }
 
 async function loadNearbyDrivers(lat, lng) {
-    const token = localStorage.getItem('token');
     try {
-        const res = await fetch(`${API_URL}/drivers/nearby?lat=${lat}&lng=${lng}`, {
-            headers: { 'Authorization': `Bearer ${token}` }
-        });
+        const res = await authFetch(`${API_URL}/drivers/nearby?lat=${lat}&lng=${lng}`);
         const drivers = await res.json();
         const list = document.getElementById('driversList');
         const countEl = document.getElementById('driverCount');
@@ -309,12 +361,9 @@ function closeChatModal() {
 }
 
 async function loadChatHistory(orderId) {
-    const token = localStorage.getItem('token');
     try {
-        const res = await fetch(`${API_URL}/chat/${orderId}`, {
-            headers: { 'Authorization': `Bearer ${token}` }
-        });
-        const messages = await res.json();
+        const res = await authFetch(`${API_URL}/chat/${orderId}`);
+        const { items: messages } = await res.json(); // latest page, oldest first
         const container = document.getElementById('chatMessages');
         container.innerHTML = '';
         messages.forEach(msg => appendMessage(msg));
@@ -377,12 +426,66 @@ function scrollToBottom() {
     container.scrollTop = container.scrollHeight;
 }
 
-async function loadCustomerOrders() {
+// EVENT STREAM
+// One socket per user: order status, the driver's position and new
+// notifications are pushed as they happen instead of polled
+let eventsWs = null;
+let driverMarker = null;
+let locationKeyframes = {};
+
+function connectEvents() {
     const token = localStorage.getItem('token');
-    const res = await fetch(`${API_URL}/orders/my`, {
-        headers: { 'Authorization': `Bearer ${token}` }
-    });
-    const orders = await res.json();
+    const wsUrl = `${window.location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}/events/ws?token=${encodeURIComponent(token)}`;
+    eventsWs = new WebSocket(wsUrl);
+
+    eventsWs.onmessage = (event) => {
+        const { type, data } = JSON.parse(event.data);
+        if (type === 'snapshot') {
+            if (data.driver_location) showDriverLocation(data.driver_location);
+        } else if (type === 'order.status_changed') {
+            if (document.getElementById('customerOrdersList')) loadCustomerOrders();
+        } else if (type === 'driver.location') {
+            showDriverLocation(data);
+        } else if (type === 'order.offer') {
+            showToast(`طلب جديد: ${data.liters} لتر على بعد ${data.distance_km} كم`);
+        } else if (type === 'notification.created') {
+            showToast(`${data.title}: ${data.body}`);
+        }
+    };
+    eventsWs.onclose = async (event) => {
+        // 1008: token rejected; usually just expired, so refresh and reconnect
+        if (event.code !== 1008) {
+            setTimeout(connectEvents, 3000);
+        } else if (await refreshSession()) {
+            connectEvents();
+        } else {
+            logout();
+        }
+    };
+}
+
+function showDriverLocation(loc) {
+    // Keyframes carry lat/lng; deltas carry d = [dlat, dlng] in 1e-5 degrees from keyframe `key`
+    let lat = loc.lat, lng = loc.lng;
+    if (loc.d) {
+        const base = locationKeyframes[loc.key];
+        if (!base) return;
+        lat = base[0] + loc.d[0] / 1e5;
+        lng = base[1] + loc.d[1] / 1e5;
+    } else {
+        locationKeyframes = { [loc.key]: [lat, lng] };
+    }
+    if (!map) return;
+    if (!driverMarker) {
+        driverMarker = L.marker([lat, lng]).addTo(map).bindPopup('<b>السائق</b>');
+    } else {
+        driverMarker.setLatLng([lat, lng]);
+    }
+}
+
+async function loadCustomerOrders() {
+    const res = await authFetch(`${API_URL}/orders/my`);
+    const { items: orders } = await res.json(); // newest page only
     const container = document.getElementById('customerOrdersList');
     container.innerHTML = '';
 
@@ -433,16 +536,14 @@ function openBookingModal(driverId, driverName, price) {
     btn.parentNode.replaceChild(newBtn, btn);
 
     newBtn.addEventListener('click', async () => {
-        const token = localStorage.getItem('token');
         const deliveryDetails = document.getElementById('deliveryDetails').value;
         const center = map.getCenter();
 
         try {
-            const res = await fetch(`${API_URL}/orders/`, {
+            const res = await authFetch(`${API_URL}/orders/`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${token}`
+                    'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     driver_id: driverId,
@@ -504,15 +605,13 @@ function setRating(n) {
 async function submitRating() {
     if (!currentRating || !ratingOrderId) return showToast('الرجاء اختيار التقييم', 'error');
 
-    const token = localStorage.getItem('token');
     const comment = document.getElementById('ratingComment').value;
 
     try {
-        const res = await fetch(`${API_URL}/reviews/${ratingOrderId}`, {
+        const res = await authFetch(`${API_URL}/reviews/${ratingOrderId}`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${token}`
+                'Content-Type': 'application/json'
             },
             body: JSON.stringify({ rating: currentRating, comment })
         });
@@ -538,13 +637,11 @@ async function triggerSOS() {
     }
 
     navigator.geolocation.getCurrentPosition(async (position) => {
-        const token = localStorage.getItem('token');
         try {
-            const res = await fetch(`${API_URL}/safety/sos`, {
+            const res = await authFetch(`${API_URL}/safety/sos`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${token}`
+                    'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     lat: position.coords.latitude,
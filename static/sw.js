@@ -1,3 +1,40 @@
+// App shell, filled in by assets.py when static/ is built
+const SHELL_VERSION = 'dev';
+const SHELL_ASSETS = [];
+const SHELL_CACHE = `boti-shell-${SHELL_VERSION}`;
+
+self.addEventListener('install', function (event) {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.addAll(SHELL_ASSETS))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', function (event) {
+    // Drop shells of previous builds
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys
+                .filter(key => key.startsWith('boti-shell-') && key !== SHELL_CACHE)
+                .map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', function (event) {
+    // Shell files come from the cache (they change only with a new sw.js);
+    // everything else, the API included, goes to the network
+    if (event.request.method !== 'GET') return;
+    const url = new URL(event.request.url);
+    if (url.origin !== self.location.origin || !SHELL_ASSETS.includes(url.pathname)) return;
+    event.respondWith(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.match(url.pathname))
+            .then(cached => cached || fetch(event.request))
+    );
+});
+
 self.addEventListener('push', function (event) {
     let data = { title: "إشعار جديد", body: "لديك تحديث جديد" };
     if (event.data) {
@@ -0,0 +1,73 @@
+import hashlib
+import secrets
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+import security
+
+# Refresh tokens are opaque random strings handed out next to each access
+# token. Using one rotates it: the presented token is revoked and a new one
+# of the same family issued, in one conditional UPDATE. Presenting a token
+# that was already rotated means it was copied: the whole family is revoked
+# and that login has to start over. Callers commit.
+
+_table = models.RefreshToken.__table__
+
+
+class InvalidRefreshToken(Exception):
+    pass
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+async def issue(db: AsyncSession, user_id: int, family: Optional[bytes] = None) -> str:
+    token = secrets.token_urlsafe(32)
+    await db.execute(insert(_table).values(
+        token_hash=_digest(token),
+        family=family or uuid.uuid4().bytes,
+        user_id=user_id,
+        expires_at=datetime.utcnow() + timedelta(days=security.REFRESH_TOKEN_EXPIRE_DAYS),
+        revoked=False,
+    ))
+    return token
+
+
+async def rotate(db: AsyncSession, token: str) -> Tuple[int, bytes, str]:
+    # (user_id, family, replacement token); raises InvalidRefreshToken
+    digest = _digest(token)
+    row = (await db.execute(
+        update(_table)
+        .where(_table.c.token_hash == digest, _table.c.revoked.is_(False), _table.c.expires_at > datetime.utcnow())
+        .values(revoked=True)
+        .returning(_table.c.user_id, _table.c.family)
+    )).first()
+    if row is None:
+        reused = await db.scalar(select(_table.c.family).where(_table.c.token_hash == digest, _table.c.revoked.is_(True)))
+        if reused is not None:
+            await revoke_family(db, reused)
+            await db.commit()
+        raise InvalidRefreshToken()
+    user_id, family = row
+    return user_id, family, await issue(db, user_id, family)
+
+
+async def revoke(db: AsyncSession, token: str):
+    family = await db.scalar(select(_table.c.family).where(_table.c.token_hash == _digest(token)))
+    if family is not None:
+        await revoke_family(db, family)
+
+
+async def revoke_family(db: AsyncSession, family: bytes):
+    await db.execute(update(_table).where(_table.c.family == family, _table.c.revoked.is_(False)).values(revoked=True))
+
+
+async def prune(db: AsyncSession, user_id: int):
+    # Expired rows are kept no longer than the user's next login
+    await db.execute(delete(_table).where(_table.c.user_id == user_id, _table.c.expires_at < datetime.utcnow()))
@@ -0,0 +1,60 @@
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+S = models.OrderStatus
+R = models.UserRole
+
+
+def _roles(*roles: R) -> FrozenSet[str]:
+    return frozenset(r.value for r in roles)
+
+
+# Order status machine: (from, to) -> roles that may make the move.
+#   pending -> accepted -> en_route -> completed, cancellable before en_route.
+# Dispatched orders reach accepted through dispatch.accept instead.
+# Keys are plain strings: enum members hash by name, not by value.
+TRANSITIONS: Dict[Tuple[str, str], FrozenSet[str]] = {
+    (S.PENDING.value, S.ACCEPTED.value): _roles(R.DRIVER, R.ADMIN),
+    (S.ACCEPTED.value, S.EN_ROUTE.value): _roles(R.DRIVER, R.ADMIN),
+    (S.EN_ROUTE.value, S.COMPLETED.value): _roles(R.DRIVER, R.ADMIN),
+    (S.PENDING.value, S.CANCELLED.value): _roles(R.CUSTOMER, R.DRIVER, R.ADMIN),
+    (S.ACCEPTED.value, S.CANCELLED.value): _roles(R.CUSTOMER, R.DRIVER, R.ADMIN),
+}
+
+
+def _value(v) -> str:
+    return v.value if isinstance(v, (S, R)) else v
+
+
+def allowed(current: str, target: str, role: str) -> bool:
+    return _value(role) in TRANSITIONS.get((_value(current), _value(target)), ())
+
+
+async def apply(
+    db: AsyncSession,
+    order_id: int,
+    current: str,
+    target: str,
+    version: Optional[int] = None,
+    values: Optional[dict] = None,
+    where: Iterable = (),
+) -> Optional[int]:
+    # Moves the order from `current` to `target` in one conditional UPDATE,
+    # bumping its version. Returns the new version, or None when the row no
+    # longer matches (another request changed it first); the caller should
+    # then roll back and report a conflict. No row lock is taken: losers
+    # simply match nothing.
+    order = models.Order
+    criteria = [order.id == order_id, order.status == current, *where]
+    if version is not None:
+        criteria.append(order.version == version)
+    return await db.scalar(
+        update(order)
+        .where(*criteria)
+        .values(status=target, version=order.version + 1, **(values or {}))
+        .returning(order.version)
+    )